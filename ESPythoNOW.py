@@ -6,7 +6,22 @@ import struct
 import sys
 import json
 import re
+import os
+import errno
+import ctypes
+import mmap
+import select
+import socket
+import queue
+import multiprocessing
+import asyncio
+import concurrent.futures
+import bisect
+import http.server
 import subprocess
+import gzip
+import bz2
+import lzma
 
 try:
   from Crypto.Cipher import AES
@@ -20,15 +35,99 @@ try:
 except:
   HAVE_PAHO = False
 
+try:
+  import numpy as np
+  HAVE_NUMPY = True
+except:
+  HAVE_NUMPY = False
+
+# sendmmsg, for batched transmit
+try:
+  libc          = ctypes.CDLL(None, use_errno=True)
+  libc.sendmmsg.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_uint, ctypes.c_int]
+  HAVE_SENDMMSG = True
+except:
+  HAVE_SENDMMSG = False
+
+UIO_MAXIOV = 1024 # Most messages the kernel will take in one sendmmsg call
+
+class iovec(ctypes.Structure):
+  _fields_ = [("iov_base", ctypes.c_void_p), ("iov_len", ctypes.c_size_t)]
+
+class msghdr(ctypes.Structure):
+  _fields_ = [("msg_name", ctypes.c_void_p), ("msg_namelen", ctypes.c_uint32), ("msg_iov", ctypes.POINTER(iovec)), ("msg_iovlen", ctypes.c_size_t),
+              ("msg_control", ctypes.c_void_p), ("msg_controllen", ctypes.c_size_t), ("msg_flags", ctypes.c_int)]
+
+class mmsghdr(ctypes.Structure):
+  _fields_ = [("msg_hdr", msghdr), ("msg_len", ctypes.c_uint)]
+
+VALID_RATES            = [1, 2, 5.5, 11, 6, 9, 12, 18, 24, 36, 48, 54]                                       # Supported PHY rates, Mbps
+ESPNOW_V1_HEADERS      = [bytes([0xDD, 5+size, 0x18, 0xfe, 0x34, 0x04, 0x01]) for size in range(251)]        # v1.0 vendor element header, by message size
+ESPNOW_V2_MORE_HEADER  = bytes([0xDD, 255, 0x18, 0xfe, 0x34, 0x04, 0x12])                                    # v2.0 vendor element header, full 250 bytes with more to follow
+ESPNOW_V2_LAST_HEADERS = [bytes([0xDD, 5+size, 0x18, 0xfe, 0x34, 0x04, 0x02]) for size in range(251)]        # v2.0 vendor element header for the last element, by size
+SEQUENCE_CONTROL       = struct.Struct("<H")
+ESPNOW_HEADER          = struct.Struct("<4sI")
+FCS                    = struct.Struct("<I")
+ENCRYPTED_PLACEHOLDER  = b"\x7f\x18\xfe\x34%s" + ESPNOW_V1_HEADERS[17] + b"Encrypted Message"                      # Delivered in place of a message that can't be decrypted, random value added
+PRIORITY_CONTROL       = 0                                                                                   # send_queued priority classes, lower goes first
+PRIORITY_NORMAL        = 1
+PRIORITY_BULK          = 2
+FRAGMENT_MAGIC         = b"\xfa\x17"                                                                         # FragmentTransport messages start with this
+FRAGMENT_HEADER        = struct.Struct("<2sBHHH")                                                            # magic, kind, blob id, fragment index, fragment count
+FRAGMENT_DATA          = 1
+FRAGMENT_NACK          = 2                                                                                   # Followed by the missing fragment indexes, u16 each
+FRAGMENT_DONE          = 3
+FEC_MAGIC              = b"\xfa\x18"                                                                         # FecStream messages start with this
+FEC_HEADER             = struct.Struct("<2sBHB")                                                             # magic, kind, group id, data index (or data count for parity)
+FEC_DATA               = 1
+FEC_PARITY             = 2                                                                                   # XOR of the group's data messages, each length prefixed and zero padded
+MQTT_SPILL_HEADER      = struct.Struct("<HIB")                                                              # MqttPublisher spill file record: topic length, payload length, QoS
+ENVELOPE_MAGIC         = b"\xfa\x19"                                                                         # Compact MQTT frame envelopes start with this
+ENVELOPE_VERSION       = 1
+ENVELOPE_HEADER        = struct.Struct("<2sBdH")                                                             # magic, version, base timestamp, frame count
+ENVELOPE_FRAME         = struct.Struct("<I6s6sbH")                                                           # microseconds after base, src, dst, RSSI (-128 unknown), message length
+COORDINATOR_HEADER     = struct.Struct("<IB")                                                                # Radio worker <-> coordinator record: length after the header, kind
+COORDINATOR_FRAME      = 1                                                                                   # Worker to coordinator, COORDINATOR_MESSAGE followed by the ESP-NOW data
+COORDINATOR_SEND       = 2                                                                                   # Coordinator to worker, destination MAC followed by the message
+COORDINATOR_TRACKED    = 3                                                                                   # Coordinator to worker, COORDINATOR_REQUEST followed by the message, answered with COORDINATOR_RESULT
+COORDINATOR_RESULT     = 4                                                                                   # Worker to coordinator, COORDINATOR_OUTCOME once the tracked message is delivered or failed
+COORDINATOR_MESSAGE    = struct.Struct("<6s6sb")                                                             # src, dst, RSSI (-128 unknown)
+COORDINATOR_REQUEST    = struct.Struct("<I6s")                                                               # request id, dst
+COORDINATOR_OUTCOME    = struct.Struct("<IB")                                                                # request id, delivered
+COORDINATOR_MAX        = 2346                                                                                # Largest record body accepted, the largest 802.11 frame
+PCAPNG_SHB             = struct.Struct("<IIIHHqI")                                                           # Section header block: type, length, byte order magic, version, section length, length
+PCAPNG_IDB             = struct.Struct("<IIHHII")                                                            # Interface description block: type, length, linktype, reserved, snaplen, length
+PCAPNG_EPB             = struct.Struct("<IIIIIII")                                                           # Enhanced packet block: type, length, interface, timestamp high/low (us), captured and original length
+PCAPNG_LEN             = struct.Struct("<I")                                                                 # Block length, repeated at the end of each block
+CCM_COUNTERS           = {}                                                                                  # Cache of CTR counter block multipliers, by block count
+
+# Linux packet socket constants, for the TPACKET_V3 receive ring
+SOL_PACKET           = 263
+PACKET_RX_RING       = 5
+PACKET_STATISTICS    = 6
+PACKET_VERSION       = 10
+TPACKET_V3           = 2
+TP_STATUS_KERNEL     = 0
+TP_STATUS_USER       = 1
+TPACKET_BLOCK_STATUS = struct.Struct("<I")            # tpacket_hdr_v1 block_status
+TPACKET_BLOCK_PKTS   = struct.Struct("<II")           # tpacket_hdr_v1 num_pkts, offset_to_first_pkt
+TPACKET3_HDR         = struct.Struct("<I8xI8xH")      # tpacket3_hdr tp_next_offset, tp_snaplen, tp_mac
+
 
 
 
 
 class ESPythoNow:
 
-  def __init__(self, interface, set_interface=True, mtu=1500, rate=0, channel=0, mac="", callback=None, send_raw=False, no_wait=False, retry_limit=0, repeat=0, accept_broadcast=True, accept_all=False, accept_ack=False, block_on_send=False, pmk="", lmk="", decoders={}, mqtt_config={}):
+  def __init__(self, interface, set_interface=True, mtu=1500, rate=0, channel=0, mac="", callback=None, send_raw=False, recv_raw=False, recv_ring=False, ring_size=4194304, ring_timeout=10, rx_workers=0, rx_worker_mode="thread", rx_queue_size=1024, no_wait=False, retry_limit=0, repeat=0, accept_broadcast=True, accept_all=False, accept_ack=False, block_on_send=False, delivery_peer_quota=8, delivery_retries=0, tx_queue_size=1024, pcap_file="", pcap_speed=0, capture_file="", capture_mode="all", capture_rotate_size=0, capture_rotate_time=0, capture_compress="", pmk="", lmk="", peers={}, decoders={}, mqtt_config={}, l2_socket=None, stats_port=0, stats_interval=0, coordinator="", coordinator_listen="", coordinator_window=.02):
 
-    if set_interface:
+    # A list of interfaces, with a channel each or one for all, is one radio per interface feeding this object's receive pipeline
+    interfaces = list(interface) if isinstance(interface, (list, tuple)) else []
+    channels   = list(channel) if isinstance(channel, (list, tuple)) else [channel] * len(interfaces)
+    if interfaces:
+      interface, channel = "", 0
+
+    if set_interface and not (pcap_file or coordinator_listen or interfaces):
       self.prep_interface(interface, channel, mtu=mtu, retry_limit=retry_limit)
 
     self.interface           = interface                                 # Wireless interface to use
@@ -39,6 +138,13 @@ class ESPythoNow:
     self.local_mac           = mac.upper() if mac else None              # Local ESP-NOW peer MAC, does not need to match actual hw MAC
     self.esp_now_rx_callback = callback                                  # Callback function to execute on packet RX
     self.send_raw            = send_raw                                  # Send packets with raw socket instead of scapy, can be faster and unstable
+    self.recv_raw            = recv_raw                                  # Receive packets with raw socket instead of scapy sniffer, parses frames without scapy dissection
+    self.recv_ring           = recv_ring                                 # Receive packets with memory mapped TPACKET_V3 ring, parses frames in place block by block
+    self.ring_size           = ring_size                                 # Size in bytes of the receive ring, rounded to whole blocks
+    self.ring_timeout        = ring_timeout                              # Receive ring block timeout in ms, how long a partially filled block waits before being handed over
+    self.rx_workers          = rx_workers                                # Number of receive workers, messages are sharded by source MAC. 0 processes on the capture thread
+    self.rx_worker_mode      = rx_worker_mode                            # Receive workers as "thread" or "process" (forked, for decrypt/decode/callback across CPU cores)
+    self.rx_queue_size       = rx_queue_size                             # Messages each receive worker queue holds before new messages are dropped
     self.no_wait             = no_wait                                   # Don't wait for receiver to confirm sent messages. faster unicast messages. no automatic retransmit.
     self.retry_limit         = retry_limit                               # The limit of how many times a packet will automatically be resent if delivery not confirmed
     self.repeat              = repeat                                    # The number of times to force packet resend
@@ -46,24 +152,91 @@ class ESPythoNow:
     self.accept_all          = accept_all                                # Accept ESP-NOW packets, no matter the destination MAC
     self.accept_ack          = accept_ack                                # Pass delivery confirmation to callback
     self.delivery_block      = block_on_send                             # Block on send, wait for delivery or timeout
+    self.delivery_peer_quota = delivery_peer_quota                       # Messages per peer in the ACK clocked transmit order at a time, when blocking or with send_async
+    self.delivery_retries    = delivery_retries                          # Times a message is resent when delivery is not confirmed in time, when blocking or with send_async
+    self.tx_queue_size       = tx_queue_size                             # Messages each destination's send_queued queue holds before new messages are rejected
+    self.pcap_file           = pcap_file                                 # Receive from a RadioTap pcap/pcapng capture file instead of the interface. Without an interface nothing can be sent
+    self.pcap_speed          = pcap_speed                                # Capture file replay speed, 1 original timing, 2 twice as fast, 0 as fast as possible
+    self.capture_file        = capture_file                              # Write received frames to this pcapng file, from a background thread
+    self.capture_mode        = capture_mode                              # Received frames to write: "accepted", "rejected" (by filtering or parsing) or "all"
+    self.capture_rotate_size = capture_rotate_size                       # Start a new capture file after this many bytes, 0 never
+    self.capture_rotate_time = capture_rotate_time                       # Start a new capture file after this many seconds, 0 never
+    self.capture_compress    = capture_compress                          # Capture file compression: "", "gzip", "bz2" or "lzma"
+    self.capture_writer      = None                                      # Capture writer thread and queue, created by prepare() when capture_file is set
+    self.stats_port          = stats_port                                # Serve stats on this HTTP port, Prometheus text on /metrics and JSON on /stats. 0 disables
+    self.stats_interval      = stats_interval                            # Publish stats as JSON to MQTT base_topic/stats every this many seconds. 0 disables
+    self.stats_server        = None                                      # Stats HTTP server, started by prepare() when stats_port is set
+    self.metrics             = Metrics()                                 # Send and receive counters and latency histograms, see stats()
+    self.coordinator         = coordinator                               # Radio worker, forward received messages to the coordinator at this Unix socket path or host:port, and send what it routes here
+    self.coordinator_listen  = coordinator_listen                        # Coordinator, receive from radio workers on this Unix socket path or host:port instead of an interface
+    self.coordinator_window  = coordinator_window                        # Seconds the coordinator waits for copies of a message from other radios, keeping the best RSSI
+    self.coordinator_link    = None                                      # Connection to the coordinator, created by prepare() when coordinator is set
+    self.radio_coordinator   = None                                      # Coordinator server, created by prepare() when coordinator_listen is set or with several interfaces
+    self.radios              = []                                        # One ESPythoNow per interface when given a list, sharing keys, metrics and capture writer
     self.pmk                 = pmk                                       # Primary Master Key, used to encrypt Local Master Key
     self.lmk                 = lmk                                       # Local Master Key, used to encrypt ESP-NOW messages
-    self.decoders            = decoders                                  # Known message decoders
+    self.decoders            = DecoderTable(decoders)                    # Known message decoders. Assigning a plain dict works too, it is wrapped on first use
     self.mqtt_config         = mqtt_config                               # Configuration dict for MQTT connection
     self.key                 = None                                      # The PMK encrypted LMK
+    self.ccm                 = None                                      # Cached AES-CCM context for the key
+    self.peers               = {}                                        # Per peer LMK, CCM key and context by MAC, used instead of the default LMK
+    self.lmk_contexts        = {}                                        # CCM contexts by LMK, each key is derived once and shared by peers with the same LMK
+    self.frame_templates     = {}                                        # Preallocated send frames by destination MAC, PHY rate and NOACK setting
     self.encrypted           = False                                     # ESP-NOW messages will be encrypted
     self.delivery_confirmed  = False                                     # Have received a delivery confirmation since the last send
+    self.sequence            = 0                                         # 802.11 sequence number of the last sent packet, also the CCMP packet number
     self.delivery_event      = scapy.threading.Event()                   # Used with block on send
     self.delivery_timeout    = .025                                      # How long to wait for delivery confirmation when blocking
+    self.delivery_callback   = None                                      # Function called with the destination MAC on every accepted ACK
+    self.ack_forward         = None                                      # Function passing ACKs to the multi-interface ESPythoNow this radio belongs to
+    self.delivery_tracker    = None                                      # Messages waiting for delivery confirmation, created on first confirmed send
+    self.send_lock           = scapy.threading.Lock()                    # Serialize building frames between sending threads, frame templates and sequence number are shared
+    self.tx_scheduler        = None                                      # TX worker thread and per destination queues for send_queued, created on first use
+    self.pacer               = Pacer()                                   # Send rate limits, overall and per destination
+    self.decoder_index       = None                                      # Compiled decoder signatures, rebuilt when decoders are added or replaced
+    self.compiled_decoders   = {}                                        # Compiled struct and field mapping by decoder, see compile_decoder
     self.startup_event       = scapy.threading.Event()                   # Used with starting Scapy listener
     self.recent_rand_values  = collections.deque(maxlen=10)              # Ring buffer of recent packet randvalues used to filter packets
-    self.listener            = None                                      # Scapy sniffer
-    self.l2_socket           = scapy.conf.L2socket(iface=self.interface) # L2 socket, for reuse
-    self.packet              = None                                      # Scapy packet of the most recent received valid ESP-NOW message
-    self.local_hw_mac        = self.hw_mac_as_str(self.interface)        # Interface's actual HW MAC
+    self.listener            = None                                      # Scapy sniffer, or raw socket receive thread
+    self.l2_socket           = l2_socket                                 # L2 socket, for reuse. Opened on the interface unless given
+    self.packet              = None                                      # Scapy packet (or raw frame bytes if recv_raw) of the most recent received valid ESP-NOW message
+    self.rssi                = None                                      # RSSI (dBm) of the most recent received valid ESP-NOW message, if reported by the driver
+    self.local_hw_mac        = None                                      # Interface's actual HW MAC
     self.block_on_broadcast  = False                                     # Enable block on BROADCAST send, disabled by default. Some ESP-NOW versions will send ACK when receiving BROADCAST
     self.prepared            = False                                     # Required tasks have been completed, or not
     self.use_mqtt            = False                                     # MQTT will be used
+    self.ring_block_size     = 1 << 18                                   # Size in bytes of each receive ring block
+    self.ring_socket         = None                                      # Receive ring socket, used for kernel statistics
+    self.ring_stats_lock     = scapy.threading.Lock()                    # Serialize reading of kernel statistics, reading resets the kernel counters
+    self.ring_packets        = 0                                         # Packets passed by BPF filter to receive ring, from kernel statistics
+    self.ring_drops          = 0                                         # Packets dropped by kernel with receive ring full, from kernel statistics
+    self.ring_freezes        = 0                                         # Times the receive ring was frozen with all blocks full, from kernel statistics
+    self.rx_queues           = []                                        # Receive worker queues, one per worker
+    self.rx_queued           = []                                        # Messages handed to each receive worker
+    self.rx_queue_drops      = []                                        # Messages dropped with each receive worker queue full
+    self.rx_worker_pool      = []                                        # Receive worker threads or processes
+    self.in_worker_process   = False                                     # Running in a forked receive worker process
+    self.mqtt_relay_queue    = None                                      # MQTT publishes from receive worker processes, published by the parent
+    self.mqtt_batcher        = None                                      # Compact MQTT envelope batcher, in each receive worker process too
+    self.mqtt_send_routes    = {}                                        # Parsed MQTT send topics, (MAC or "batch", request id), False if invalid
+    self.decoder_lock        = scapy.threading.Lock()                    # Serialize decoder duplicate filtering between receive worker threads
+
+    # Open the L2 socket on the interface, unless given one. No interface needed to replay a capture file, or to coordinate radio workers
+    if not self.l2_socket and (interface or not (pcap_file or coordinator_listen or interfaces)):
+      self.l2_socket = scapy.conf.L2socket(iface=self.interface)
+
+    if interface or not (pcap_file or l2_socket or coordinator_listen or interfaces):
+      self.local_hw_mac = self.hw_mac_as_str(self.interface)
+
+    for mac, lmk in peers.items():
+      self.add_peer(mac, lmk)
+
+    # One radio per interface. Only receiving and sending happen there, decoders, callback and MQTT stay here
+    # All radios are one ESP-NOW node, using mac, or the first radio's MAC
+    for interface_, channel_ in zip(interfaces, channels):
+      self.radios.append(ESPythoNow(interface_, set_interface, mtu, rate, channel_, mac or (self.radios[0].local_hw_mac if self.radios else ""), send_raw=send_raw, recv_raw=recv_raw, recv_ring=recv_ring, ring_size=ring_size, ring_timeout=ring_timeout, no_wait=no_wait, retry_limit=retry_limit, repeat=repeat, accept_broadcast=accept_broadcast, accept_all=accept_all, delivery_peer_quota=delivery_peer_quota, delivery_retries=delivery_retries, tx_queue_size=tx_queue_size, pmk=pmk, lmk=lmk))
+    if self.radios:
+      self.local_hw_mac = self.radios[0].local_hw_mac
 
 
 
@@ -173,18 +346,26 @@ class ESPythoNow:
     if not self.local_mac:
       self.local_mac = self.local_hw_mac
 
+    # Compile decoder signatures for matching, and decoders with a struct for decoding
+    if not isinstance(self.decoders, DecoderTable):
+      self.decoders = DecoderTable(self.decoders)
+    self.decoder_index = DecoderIndex(self.decoders)
+    for dec in self.decoders.values():
+      if "struct" in dec:
+        self.compile_decoder(dec)
+
     # If PMK and LMK are valid length, create CCMP key
     if self.pmk and self.lmk and len(self.pmk)==16 and len(self.lmk)==16:
 
       # Check for library required for encrypted ESP-NOW
       if HAVE_PYCRYPTODOME:
         try:
-          # Convert PMK and LMK to bytes if needed
-          self.pmk = str.encode(self.pmk) if isinstance(self.pmk, str) else self.pmk
+          # Convert LMK to bytes if needed
           self.lmk = str.encode(self.lmk) if isinstance(self.lmk, str) else self.lmk
 
           # Create CCM KEY by encrypting LMK with PMK
-          self.key       = AES.new(self.pmk, AES.MODE_ECB).encrypt(self.lmk)
+          self.ccm       = self.lmk_context(self.lmk)
+          self.key       = self.ccm.key
           self.encrypted = True
 
         except Exception as e:
@@ -195,36 +376,9 @@ class ESPythoNow:
         print("Error! PyCryptoDome missing, encryption can not be enabled.")
         self.encrypted = False
 
-    # Prepare the send packet ahead of time. Reuses packet for better performance
-    VALID_RATES = [1, 2, 5.5, 11, 6, 9, 12, 18, 24, 36, 48, 54]
-    kwargs = {}
-    present = []
-    txflags = []
-
-    if self.rate in VALID_RATES:
-      present.append("Rate")
-      present.append("Flags")
-      kwargs["Rate"]  = self.rate
-    elif self.rate != 0:
+    if self.rate and self.rate not in VALID_RATES:
       print("Invalid rate", VALID_RATES)
 
-    if self.no_wait:
-      present.append("TXFlags")
-      txflags.append("NOACK")
-
-    if txflags:
-      kwargs["TXFlags"] = "+".join(txflags)
-
-    if present:
-      kwargs["present"] = "+".join(present)
-
-    self.esp_now_send_packet           = scapy.RadioTap(**kwargs) / scapy.Dot11FCS(type=0, subtype=13,                      addr1=self.local_mac, addr2=self.local_mac, addr3="FF:FF:FF:FF:FF:FF") / scapy.Raw(load=None)
-    self.esp_now_send_packet_encrypted = scapy.RadioTap(**kwargs) / scapy.Dot11FCS(type=0, subtype=13, FCfield='protected', addr1=self.local_mac, addr2=self.local_mac, addr3="FF:FF:FF:FF:FF:FF") / scapy.Raw(load=None)
-
-    self.esp_now_send_packet_raw       = bytearray(scapy.raw(self.esp_now_send_packet))                        # Store a raw version of the unencrypted packet
-    self.raw_packet_index              = self.esp_now_send_packet_raw.index(self.mac_as_bytes(self.local_mac)) # The raw packet index of start of addr1
-    self.raw_packet_fc_index           = int.from_bytes(self.esp_now_send_packet_raw[2:4], 'little')           # The raw packet index of FC flags
-
     # Create kernel level BPF (Berkeley Packet Filter) for effiecent filtering of received packets
     if self.accept_broadcast:
       # Filter for local MAC, and BROADCAST MAC
@@ -234,14 +388,32 @@ class ESPythoNow:
       # Filter for just local MAC
       self_mac_filter = "" if self.accept_all else " and (wlan addr1 %s)" % self.local_mac
 
-    if self.encrypted:
+    if self.encrypted or self.peers or (HAVE_PYCRYPTODOME and self.pmk and len(self.pmk)==16):
       # Filter for all managment/action frames. Adds detection of encrypted ESP-NOW messages at the cost of downstream filtering
+      # Any valid PMK enables this, so peers added after start() are received
       self.filter = "((type 0 subtype 0xd0%s) or (type 4 subtype 0xd0 and wlan addr1 %s)) and wlan src ! %s" % (self_mac_filter, self.local_mac, self.local_mac)
 
     else:
       # Filter for all unencrypted ESP-NOW messages and ESP-NOW ACK
       self.filter = "((type 0 subtype 0xd0 and wlan[24:4]=0x7f18fe34%s) or (type 4 subtype 0xd0 and wlan addr1 %s)) and wlan src ! %s" % (self_mac_filter, self.local_mac, self.local_mac)
 
+    # Capture writer thread
+    if self.capture_file and not self.capture_writer:
+      self.capture_writer = CaptureWriter(self.capture_file, self.capture_mode, self.capture_rotate_size, self.capture_rotate_time, self.capture_compress)
+
+    # Radio worker connection to the coordinator, or the coordinator server
+    if self.coordinator and not self.coordinator_link:
+      self.coordinator_link = CoordinatorLink(self, self.coordinator)
+
+    if (self.coordinator_listen or self.radios) and not self.radio_coordinator:
+      self.radio_coordinator = RadioCoordinator(self, self.coordinator_listen, self.coordinator_window)
+
+      # Radios share keys, derived once, metrics and the capture writer, and hand received messages to the coordinator
+      for radio in self.radios:
+        radio.peers, radio.lmk_contexts, radio.metrics, radio.capture_writer = self.peers, self.lmk_contexts, self.metrics, self.capture_writer
+        radio.prepare()
+        self.radio_coordinator.attach(radio)
+
     # Add history deque to decoders as needed
     for k,dec in self.decoders.items():
       if "dedupe" in dec:
@@ -271,9 +443,16 @@ class ESPythoNow:
         self.mqtt_publish_json  = self.mqtt_config.get("json",      False) # Publish JSON of message, if decoder exists
         self.mqtt_publish_ack   = self.mqtt_config.get("ack",       False) # Publish any received ACK messages, can loosely be used to check if message has been delivered
         self.mqtt_discard_empty = True                                     # Discard messages with no data
+        self.mqtt_queue_size    = self.mqtt_config.get("queue_size", 10000)         # Publishes queued before the overflow policy applies
+        self.mqtt_overflow      = self.mqtt_config.get("overflow",   "drop_oldest") # Full publish queue: drop_oldest, drop_newest, or spill to spill_file
+        self.mqtt_spill_file    = self.mqtt_config.get("spill_file", "")            # File for spilled publishes
+        self.mqtt_compact       = self.mqtt_config.get("compact",        False) # Publish messages batched into compact envelopes to base_topic/frames, instead of raw and hex
+        self.mqtt_compact_wait  = self.mqtt_config.get("compact_window", .05)   # Seconds a message waits for others to share its envelope
+        self.mqtt_compact_max   = self.mqtt_config.get("compact_max",    64)    # Most messages per envelope
+        self.mqtt_qos           = {"raw": 1, "hex": 1, "json": 1, "ack": 1, "stats": 0, "frames": 1, "reply": 1, **(self.mqtt_config.get("qos") or {})} # QoS by topic type
 
         # Ensure that at least hex is published to MQTT
-        if not any([self.mqtt_publish_raw, self.mqtt_publish_hex, self.mqtt_publish_json]):
+        if not any([self.mqtt_publish_raw, self.mqtt_publish_hex, self.mqtt_publish_json, self.mqtt_compact]):
           self.mqtt_publish_hex = True
 
         if not self.mqtt_broker_ip:
@@ -294,6 +473,13 @@ class ESPythoNow:
           # Set LWT for offline
           self.mqtt_client.will_set(self.mqtt_topic_base, payload="offline", qos=1, retain=True)
 
+          # Publish from a dedicated thread, through a bounded queue
+          self.mqtt_publisher = MqttPublisher(self.mqtt_client, self.metrics, self.mqtt_queue_size, self.mqtt_overflow, self.mqtt_spill_file)
+
+          # Batch received messages into compact envelopes
+          if self.mqtt_compact:
+            self.mqtt_batcher = self.envelope_batcher()
+
           # Connect to the broker
           try:
             self.mqtt_client.connect(self.mqtt_broker_ip, self.mqtt_broker_port, keepalive=self.mqtt_keepalive)
@@ -302,12 +488,19 @@ class ESPythoNow:
 
           self.mqtt_client.loop_start()
 
+    # Stats endpoint and periodic publish
+    if self.stats_port and not self.stats_server:
+      self.serve_stats(self.stats_port)
+
+    if self.stats_interval and self.use_mqtt:
+      scapy.threading.Thread(target=self.stats_publisher, daemon=True).start()
+
     self.prepared = True
 
 
 
   # Send ESP-NOW message(s) to MAC
-  def send(self, mac, msg, block=None, delay=0, raw=None):
+  def send(self, mac, msg, block=None, delay=0, raw=None, pace=True):
     self.prepare()
 
     # Block argument overrides global delivery_block setting
@@ -321,89 +514,77 @@ class ESPythoNow:
     if not isinstance(msg, list):
       msg = [msg]
 
+    # Coordinator, the radio that last heard MAC sends. Blocking waits for that radio's delivery confirmation
+    if self.radio_coordinator:
+      if block:
+        return all([future.result() for future in self.radio_coordinator.send_async(mac, msg)])
+      return all(self.radio_coordinator.send(mac, msg))
+
+    # Wait for delivery confirmation from remote peer or timeout. Messages are handed over together and go out ACK clocked, without forced resends
+    if (block and not self.is_broadcast(mac)) or (block and self.block_on_broadcast and self.is_broadcast(mac)):
+      if not delay and not (pace and self.pacer.buckets):
+        return all([future.result() for future in self.send_async(mac, msg, raw)])
+
+      # Paced, or delay between messages one at a time
+      futures = []
+      for msg_ in msg:
+        if pace:
+          self.pacer.wait(self.format_mac(mac), len(msg_))
+        futures.extend(self.send_async(mac, msg_, raw))
+        if delay:
+          futures[-1].result()
+          time.sleep(delay)
+      return all([future.result() for future in futures])
+
     returns = []
 
     for msg_ in msg:
-      # Prepare for delivery confirmation
-      self.delivery_confirmed = False
-      self.delivery_event.clear()
-
-      # Send as v1.0 if message 250 bytes or less. Not strictly needed, could just as easily send as V2.
-      if len(msg_) <= 250:
-        plaintext_data = b"\x7f\x18\xfe\x34%s\xDD%s\x18\xfe\x34\x04\x01%s" % (random.randbytes(4), (5+len(msg_)).to_bytes(1, 'big'), msg_)
-
-      # Send as v2.0 packet, messages up to 1427 bytes (1500 MTU), or up to 2089 bytes (2304 MTU)
-      else:
-        plaintext_data = b"\x7f\x18\xfe\x34" + random.randbytes(4) + b''.join([b"\xDD" + (5+len(msg_[i:i+250])).to_bytes(1, 'big') + b"\x18\xfe\x34\x04" + (b"\x12" if i+250 < len(msg_) else b"\x02") + msg_[i:i+250] for i in range(0, len(msg_), 250)])
-
-      # Send encrypted ESP-NOW message
-      if self.encrypted:
-        counter       = self.esp_now_send_packet_encrypted.SC >> 4
-        src_mac_bytes = bytes.fromhex(self.local_mac.replace(':', ''))
-        dst_mac_bytes = bytes.fromhex(mac.replace(':', ''))
-        pn_low        = counter & 0xff
-        pn_high       = (counter >> 8) & 0xff
-        ccmp_hdr      = bytes([pn_low, pn_high, 0x00, 0xE0, 0x00, 0x00, 0x00, 0x00])
-        nonce         = b'\x00' + src_mac_bytes + b'\x00\x00\x00\x00' + bytes([pn_high, pn_low])
-        sc            = counter << 4
-        aad           = struct.pack('<H', 0x4080) + dst_mac_bytes + src_mac_bytes + b'\xff\xff\xff\xff\xff\xff' + struct.pack('<H', sc & 0x000f)
-        cipher        = AES.new(self.key, AES.MODE_CCM, nonce=nonce, mac_len=8)
-        cipher.update(aad)
-        enc_text, mic = cipher.encrypt_and_digest(plaintext_data)
-        packet        = self.esp_now_send_packet_encrypted
-        packet.SC     = sc
-        packet.load   = ccmp_hdr + enc_text + mic
-
-      # Send plaintext ESP-NOW message
-      else:
-        packet        = self.esp_now_send_packet
-        packet.load   = plaintext_data
+      # Wait for the rate limit, if any
+      if pace and self.pacer.buckets:
+        self.pacer.wait(self.format_mac(mac), len(msg_))
 
-      packet.addr1    = self.format_mac(mac)
-      packet.addr2    = self.local_mac
-      packet.SC       = (((packet.SC >> 4) + 1) & 0xFFF) << 4
+      # One sender at a time, the frame template and sequence number are shared
+      with self.send_lock:
+        # Prepare for delivery confirmation
+        self.delivery_confirmed = False
+        self.delivery_event.clear()
 
-      # Time how long the send process takes
-      send_time = time.time()
+        # Next 802.11 sequence number, also used as the CCMP packet number
+        self.sequence = (self.sequence + 1) & 0xFFF
 
-      # Send ESP-NOW packet
-      try:
+        # Preallocated frame with headers for this destination, only sequence number, random value and message are written
+        template = self.frame_template(mac)
 
-        # Send the packet directly to the socket, can be much faster and unstable
-        if raw and not self.encrypted: # Send the packet directly to the socket, can be much faster
+        # Time how long the send process takes
+        send_time = time.time()
 
-          #self.raw_packet_index is the index to start messing with the packet
-          self.esp_now_send_packet_raw[self.raw_packet_index      : self.raw_packet_index + 6]  = bytes.fromhex(packet.addr1.replace(':', '')) # mac
-          #self.esp_now_send_packet_raw[self.raw_packet_index + 6  : self.raw_packet_index + 12] = bytes.fromhex(packet.addr2.replace(':', '')) # local mac # should never change
-          #self.esp_now_send_packet_raw[self.raw_packet_index + 12 : self.raw_packet_index + 18] = bytes.fromhex(packet.addr3.replace(':', '')) # broadcast # should never change
-          self.esp_now_send_packet_raw[self.raw_packet_index + 18 : self.raw_packet_index + 20] = packet.SC.to_bytes(2, 'little')              # count # driver overwrites this?
-          self.esp_now_send_packet_raw[self.raw_packet_index + 20 : -4] = plaintext_data                                                       # data
+        # Send ESP-NOW packet
+        try:
+          frame     = template.view[:template.render(msg_, self.sequence)]
+          sock_send = self.l2_socket.ins.send if raw else self.l2_socket.send # Send the frame directly to the socket, or through scapy
 
-          # Send the raw packet
-          self.l2_socket.ins.send(self.esp_now_send_packet_raw) #, 64)     # Send the packet
-          self.esp_now_send_packet_raw[self.raw_packet_fc_index+1] ^= 0x08 # Set the resend flag in the raw packet
+          sock_send(frame)                                   # Send the packet
+          template.buffer[template.fc_index+1] |= 0x08       # Set the resend flag
           for i in range(self.repeat):
-            self.l2_socket.ins.send(self.esp_now_send_packet_raw) #, 64)   # Send any forced resends
-          self.esp_now_send_packet_raw[self.raw_packet_fc_index+1] ^= 0x08 # Unset the resend flag
+            sock_send(frame)                                 # Send any forced resends
 
-        # Send the packet with scapy
-        else:
-          self.l2_socket.send(packet)                              # Send the packet
-          self.esp_now_send_packet[scapy.Dot11FCS].FCfield ^= 0x08 # Set the resend flag in the scapy packet
-          for i in range(self.repeat):
-            self.l2_socket.send(packet)                            # Send any forced resends
-          self.esp_now_send_packet[scapy.Dot11FCS].FCfield ^= 0x08 # Unset the resend flag
+          counters                        = self.metrics.counters # Incremented in place, the send hot path
+          counters["frames_sent"]        += 1 + self.repeat
+          counters["messages_sent"]      += 1
+          counters["message_bytes_sent"] += len(msg_)
 
-      except Exception as e:
-        print("Error sending:",e)
+        except Exception as e:
+          print("Error sending:",e)
+          self.metrics.count("send_errors")
+
+        template.buffer[template.fc_index+1] &= ~0x08        # Unset the resend flag
 
       # Roughly detects when the send takes longer than it should
-      if (time.time() - send_time) > 0.1:
+      elapsed = time.time() - send_time
+      self.metrics.observe("send_seconds", elapsed)
+      if elapsed > 0.1:
         print("Outbound kernel buffer / driver / interface may be overwhelmed")
-
-      # Wait for delivery confirmation from remote peer or timeout
-      if (block and not self.is_broadcast(mac)) or (block and self.block_on_broadcast and self.is_broadcast(mac)):
-        returns.append(self.delivery_event.wait(timeout=self.delivery_timeout))
+        self.metrics.count("send_overwhelmed")
 
       # Additional delay after sending each ESP-NOW packet
       if delay:
@@ -413,349 +594,3775 @@ class ESPythoNow:
 
 
 
-  # Start listening for ESP-NOW packets
-  def start(self):
+  # Send ESP-NOW message(s) to MAC as one batch of pre-serialized frames with sendmmsg, without blocking or waiting for delivery confirmation
+  # Forced resends (repeat) are part of the same batch. Returns list of True/False per message, True if all its frames were accepted by the kernel
+  def send_batch(self, mac, msg, pace=True):
     self.prepare()
 
-    self.startup_event.clear()
+    if not isinstance(msg, list):
+      msg = [msg]
 
-    self.listener = scapy.AsyncSniffer(iface=self.interface, prn=self.parse_rx_packet, filter=self.filter, started_callback=lambda: self.startup_event.set(), store=False)
-    self.listener.start()
+    # Coordinator, the radio that last heard MAC sends
+    if self.radio_coordinator:
+      return self.radio_coordinator.send(mac, msg)
 
-    if self.startup_event.wait(timeout=1):
-      return True
-    else:
-      print("Error starting listener")
-      return False
+    # The batch waits for the rate limit as a whole
+    if pace and self.pacer.buckets:
+      self.pacer.wait(self.format_mac(mac), sum(len(msg_) for msg_ in msg), len(msg))
 
+    with self.send_lock:
+      frames = self.build_frames(mac, msg)
 
+    sent   = self.sendmmsg([frame for i, frame in frames])
+    result = [True] * len(msg)
 
-  # Callback for connection to broker
-  def mqtt_on_connect(self, client, userdata, flags, reason_code, properties):
+    # Frames are written in order, everything after the first failure was not sent
+    for i, frame in frames[sent:]:
+      result[i] = False
 
-    # Set LWT Online
-    self.mqtt_client.publish(self.mqtt_topic_base, "online", qos=1, retain=True)
+    self.metrics.update({"frames_sent": sent, "messages_sent": sum(result), "message_bytes_sent": sum(len(msg_) for msg_, ok in zip(msg, result) if ok)})
+    return result
 
-    if reason_code == 0:
-      print("Connected to broker")
-      client.subscribe(self.mqtt_topic_send+"/#")
-    else:
-      print(f"Failed to connect to broker, return code {reason_code}")
 
 
+  # Send ESP-NOW message(s) to MAC without waiting. Returns a Future per message, resolving True on delivery confirmation, False if not confirmed
+  # Frames go out ACK clocked, one waiting for its ACK at a time across all peers, delivery_peer_quota per peer in turn. Unconfirmed messages are resent on their own
+  # Forced resends (repeat) are never used. raw overrides send_raw. Broadcast and no_wait messages are sent as a batch and resolve once sent
+  def send_async(self, mac, msg, raw=None):
+    self.prepare()
 
-  # Experimental support for sending ESP-NOW messages on MQTT receive
-  # work in progress
-  def mqtt_on_message(self, client, userdata, msg):
+    if not isinstance(raw, bool):
+      raw = self.send_raw
 
-    # Discard empty message
-    if self.mqtt_discard_empty and not msg:
-      return
+    if not isinstance(msg, list):
+      msg = [msg]
 
-    if msg.topic.startswith(self.mqtt_topic_send):
+    # Coordinator, the radio that last heard MAC sends and confirms delivery
+    if self.radio_coordinator:
+      return self.radio_coordinator.send_async(mac, msg)
 
-      macs = msg.topic.split(self.mqtt_topic_send)[1].split("/")[1:]
-      # Validates that topic ESPythoNOW/send/AA:AA:AA:AA:AA:AA(/BB:BB:BB:BB:BB:BB) contains valid MAC addresses
-      if not all(self.is_valid_mac(mac) for mac in macs):
-        print("Invalid macs")
-        return
+    # No ACK will come
+    if self.no_wait or (self.is_broadcast(mac) and not self.block_on_broadcast):
+      futures = []
+      for sent in self.send_batch(mac, msg, pace=False):
+        future = concurrent.futures.Future()
+        future.set_result(sent)
+        futures.append(future)
+      return futures
 
-      if len(macs) == 1:
-        print(f"MQTT->ESP-NOW: {macs[0]} - {msg.payload}")
-        self.send(macs[0], msg.payload)
+    if not self.delivery_tracker:
+      self.delivery_tracker = DeliveryTracker(self.send_tracked, self.delivery_peer_quota, self.delivery_timeout, self.delivery_retries)
 
-      #elif len(macs) == 2:
-      #  print(f"Dual MAC: {macs[0]} -> {macs[1]}, Data: {msg.payload}")
+    # Forced resends are not used, every frame sent is ACKed and would confirm the wrong message
+    with self.send_lock:
+      mac      = self.format_mac(mac)
+      frames   = self.build_frames(mac, msg, repeat=0)
+      fc_index = self.frame_template(mac).fc_index
+      self.metrics.update({"messages_sent": len(msg), "message_bytes_sent": sum(len(msg_) for msg_ in msg)})
+      return [self.delivery_tracker.submit(mac, frame, fc_index, raw) for i, frame in frames]
 
 
 
-  # Process incoming ESP-NOW packets
-  def parse_rx_packet(self, packet):
-    is_ack   = (packet.type==1 and packet.subtype==13) # Packet is a delivery confirmation
-    from_mac = "" if is_ack else packet.addr2.upper()  # Source MAC
-    to_mac   = packet.addr1.upper()                    # Destination MAC
-    allow    = False                                   # Deny packet flag
+  # Write one tracked frame, first sends and resends. Raw frames go to the socket without blocking, others through scapy
+  def send_tracked(self, frame, raw=True):
+    if raw:
+      self.l2_socket.ins.send(frame, socket.MSG_DONTWAIT)
+    else:
+      self.l2_socket.send(frame)
+    self.metrics.count("frames_sent")
 
-    # Allow all ESP-NOW UNICAST packets
-    if self.accept_all and not is_ack:
-      allow = True
 
-    # Allow ESP-NOW BROADCAST packets
-    elif self.accept_broadcast and self.is_broadcast(to_mac):
-      allow = True
 
-    # Allow ESP-NOW packet sent to local_mac
-    elif to_mac == self.local_mac:
-      allow = True
+  # Queue ESP-NOW message(s) to MAC for the TX worker thread and return immediately, safe from any thread
+  # Higher priority messages go first. Within a priority destinations take turns, one message each, so a busy peer can't starve the others
+  # Destinations held back by their rate limit don't hold up the rest. Returns a Future per message, resolving True once sent
+  def send_queued(self, mac, msg, priority=PRIORITY_NORMAL):
+    if not self.tx_scheduler:
+      with self.send_lock:
+        if not self.tx_scheduler:
+          self.tx_scheduler = TxScheduler(lambda mac, msg: self.send(mac, msg, block=False, pace=False), self.pacer, self.tx_queue_size)
 
-    # Deny if not accepting packets sent to non local_mac
-    if (not self.accept_all and to_mac != self.local_mac) and (not self.accept_broadcast and self.is_broadcast(to_mac)):
-      allow = False
+    if not isinstance(msg, list):
+      msg = [msg]
 
-    # Deny if not accepting BROADCAST and packet is BROADCAST
-    if not self.accept_broadcast and self.is_broadcast(to_mac):
-      allow = False
+    return [self.tx_scheduler.submit(self.format_mac(mac), msg_, priority) for msg_ in msg]
 
-    # Ignore packet
-    if not allow:
-      return
 
-    # Store most recent packet
-    self.packet = packet
 
-    # Packet is ACK, delivery confirmation from remote peer
-    if is_ack:
-      self.delivery_confirmed = True
+  # Send ESP-NOW message(s) to MAC from a thread that must not block, safe alongside tracked sends. Returns a Future per message
+  # Unicast goes through the delivery tracker (see send_async), an untracked frame's ACK would confirm a tracked one. Broadcast and no_wait go to the TX queue
+  def send_background(self, mac, msg):
+    if self.no_wait or self.is_broadcast(mac):
+      return self.send_queued(mac, msg)
+    return self.send_async(mac, msg)
 
-      # Execute RX callback for ACK
-      if self.accept_ack:
 
-        if callable(self.esp_now_rx_callback):
-          self.esp_now_rx_callback(False, to_mac, "ack")
 
-        if self.use_mqtt and self.mqtt_publish_ack:
-          self.mqtt_client.publish(f"{self.mqtt_topic_base}/ack/{to_mac}", "ack", qos=1)
+  # Limit send rate to MAC, or overall if no MAC, in message bytes and/or messages per second. 0 removes the limit
+  # burst_bytes and burst_frames are how far ahead of the rate sending may get after being idle
+  # Applies to send(), send_batch() and send_queued(). send_async() is not paced
+  def set_pacing(self, mac=None, bytes_per_sec=0, frames_per_sec=0, burst_bytes=0, burst_frames=1):
+    self.pacer.configure(self.format_mac(mac) if mac else None, bytes_per_sec, frames_per_sec, burst_bytes, burst_frames)
 
-      # Clear delivery confirmation flag
-      self.delivery_event.set()
 
-    # Packet is ESP-NOW message
-    else:
-      # ESP-NOW message is encrypted
-      if scapy.Dot11CCMP in packet:
 
-        # If decryption keys present
-        if self.encrypted:
-          nonce = b'\x00'+bytes.fromhex(from_mac.replace(':',''))+struct.pack("BBBBBB",packet.PN5,packet.PN4,packet.PN3,packet.PN2,packet.PN1,packet.PN0)
-          data = AES.new(self.key, AES.MODE_CCM, nonce, mac_len=8).decrypt(packet.data[:-8])
+  # TX worker queue statistics, totals since start
+  def tx_stats(self):
+    if not self.tx_scheduler:
+      return {"depth": 0, "sent": 0, "rejected": 0, "latency_avg": 0, "latency_p99": 0, "latency_max": 0, "peers": {}}
+    return self.tx_scheduler.stats()
 
-          # Check if decryption succeded
-          if not data.startswith(b"\x7f\x18\xfe\x34"):
-            print("Decryption Failed")
-            data = b"%sEncrypted Message" % random.randbytes(15)
 
-        # No decryption keys present
-        else:
-          # Message may never reach here due to scapy filtering rules
-          data = b"%sEncrypted Message" % random.randbytes(15)
 
-      # ESP-NOW message is plaintext
-      else:
-        data = packet["Raw"].load
+  # Delivery tracking statistics, totals since start
+  def delivery_stats(self):
+    if not self.delivery_tracker:
+      return {"in_flight": 0, "backlog": 0, "confirmed": 0, "resent": 0, "failed": 0}
+    return self.delivery_tracker.stats()
 
-      # Check if vendor category code has been stripped. Due to cooked mode host network mode passthrough removing this byte?
-      if data[0] != 0x7f:
-        data = b"\x7f" + data
 
-      # Check packets random values to filter resent messages
-      if data[4:8] in self.recent_rand_values:
-        return
-      else:
-        self.recent_rand_values.append(data[4:8])
 
-      # Parse message from ESP-NOW packet, v1.0 and v2.0
-      msg_raw = b''.join([data[15:][i:i + 250] for i in range(0, len(data[15:]), 257)])
+  # Serialize ESP-NOW message(s) to MAC as complete raw frames, each in its own buffer. Forced resends (repeat) follow each frame with the retry flag set
+  # Returns list of (message index, frame)
+  def build_frames(self, mac, msg, repeat=None):
+    self.prepare()
 
-      # Check if there is a decoder that matches this message
-      dec = self.check_decoders(msg_raw)
+    if repeat is None:
+      repeat = self.repeat
 
-      # If a decoder exists for this message, and is set to filter duplicate messages, different from filtering resent messages.
-      if dec and "recent" in dec:
-        if msg_raw in dec["recent"]:
-          return
-        dec["recent"].append(msg_raw)
+    if not isinstance(msg, list):
+      msg = [msg]
 
-      # Prepare default callback values
-      callback = self.esp_now_rx_callback
-      output   = msg_raw
+    template = self.frame_template(mac)
+    frames   = []
 
-      # Check if decoder has a callback associated with it
-      if dec and "callback" in dec and callable(dec["callback"]):
-        callback = dec["callback"]
-        if   dec["data"] == "hex":  output = msg_raw.hex(" ")
-        elif dec["data"] == "dict": output = self.decode(dec, msg_raw)
-        elif dec["data"] == "json": output = json.dumps(self.decode(dec, msg_raw))
+    for i, msg_ in enumerate(msg):
+      # Next 802.11 sequence number, also used as the CCMP packet number
+      self.sequence = (self.sequence + 1) & 0xFFF
 
-      # Execute the callback if one was found
-      if callback and callable(callback):
-        callback(from_mac, to_mac, output)
+      frame = bytearray(template.view[:template.render(msg_, self.sequence)])
+      frames.append((i, frame))
 
-      # Check to see if using MQTT and publish incoming messages
-      if self.use_mqtt and self.mqtt_client.is_connected():
+      # Forced resends share one buffer with the retry flag set
+      if repeat:
+        resend = bytearray(frame)
+        resend[template.fc_index+1] |= 0x08
+        frames.extend([(i, resend)] * repeat)
 
-        if self.mqtt_discard_empty and not msg_raw:
-          return
+    return frames
 
-        if self.mqtt_publish_raw:
-          self.mqtt_client.publish(f"{self.mqtt_topic_base}/{from_mac}/{to_mac}/raw", msg_raw, qos=1)
 
-        if self.mqtt_publish_hex:
-          self.mqtt_client.publish(f"{self.mqtt_topic_base}/{from_mac}/{to_mac}/hex", msg_raw.hex(" "), qos=1)
 
-        if dec and self.mqtt_publish_json:
-          self.mqtt_client.publish(f"{self.mqtt_topic_base}/{from_mac}/{to_mac}/json", json.dumps(self.decode(dec, msg_raw)), qos=1)
+  # Frame template for MAC at the current PHY rate and NOACK setting, created on first use
+  def frame_template(self, mac):
+    template = self.frame_templates.get((mac, self.rate, self.no_wait))
 
+    if template is None:
+      if len(self.frame_templates) >= 1024: # Bound the cache for senders that spray many destinations
+        self.frame_templates.clear()
+      template = FrameTemplate(self.radiotap_header(self.rate, self.no_wait), self.mac_as_bytes(self.local_mac), self.mac_as_bytes(self.format_mac(mac)), self.peer_ccm(self.format_mac(mac)))
+      self.frame_templates[(mac, self.rate, self.no_wait)] = template
 
+    return template
 
-  # Identify the message signature
-  def check_decoders(self, data):
-    # Loop through each stored signature
-    for name, dev in self.decoders.items():
-      sig = dev["signature"]
 
-      # Check messsage length if it exists
-      if "length" in sig and len(data) != sig["length"]:
-        continue
 
-      # Check known byte locations and values
-      if "bytes" in sig:
-        reject = False
-        for k,v in sig["bytes"].items():
-          if data[k] != v:
-            reject = True
-        if reject:
-          continue
+  # RadioTap header bytes for sending at PHY rate, with or without NOACK
+  def radiotap_header(self, rate, no_wait):
+    kwargs  = {}
+    present = []
+    txflags = []
 
-      return dev
+    if rate in VALID_RATES:
+      present.append("Rate")
+      present.append("Flags")
+      kwargs["Rate"]  = rate
 
+    if no_wait:
+      present.append("TXFlags")
+      txflags.append("NOACK")
 
+    if txflags:
+      kwargs["TXFlags"] = "+".join(txflags)
 
-  # Takes the signature data and creates a dictionary of the parsed data to send to callback
-  def decode(self, sig, msg):
-    data = dict(zip(sig["vars"], struct.unpack(sig["struct"], msg)))
-    out  = {}
+    if present:
+      kwargs["present"] = "+".join(present)
 
-    for k,v in sig["dict"].items():
-      if k not in sig["vars"]:
-        continue
+    # Serialize with an 802.11 FCS header so the RadioTap FCS flag is set, then keep only the RadioTap part
+    packet = scapy.raw(scapy.RadioTap(**kwargs) / scapy.Dot11FCS())
+    return packet[:int.from_bytes(packet[2:4], 'little')]
 
-      if isinstance(v, bool) and v:
-        out[k] = data[k]
 
-      elif isinstance(v, dict):
-        for kk,vv in v.items():
-          if data[k] == kk:
-            out[k] = vv
 
-    return out
+  # Write frames to the L2 socket with as few sendmmsg calls as possible, without blocking
+  # Returns number of frames written, frames are written in order
+  def sendmmsg(self, frames):
+    sock = self.l2_socket.ins
 
+    # No sendmmsg, fall back to one send per frame
+    if not HAVE_SENDMMSG:
+      for n, frame in enumerate(frames):
+        try:
+          sock.send(frame, socket.MSG_DONTWAIT)
+        except OSError as e:
+          print("Error sending:", e)
+          self.metrics.count("send_errors")
+          return n
+      return len(frames)
+
+    count = len(frames)
+    iovs  = (iovec * count)()
+    msgs  = (mmsghdr * count)()
+    bufs  = [(ctypes.c_char * len(frame)).from_buffer(frame) for frame in frames] # Point at the frame buffers, no copy
+
+    for n in range(count):
+      iovs[n].iov_base           = ctypes.addressof(bufs[n])
+      iovs[n].iov_len            = len(frames[n])
+      msgs[n].msg_hdr.msg_iov    = ctypes.pointer(iovs[n])
+      msgs[n].msg_hdr.msg_iovlen = 1
+
+    sent = 0
+    while sent < count:
+      ret = libc.sendmmsg(sock.fileno(), ctypes.byref(msgs, sent * ctypes.sizeof(mmsghdr)), min(count - sent, UIO_MAXIOV), socket.MSG_DONTWAIT)
+
+      if ret <= 0:
+        err = ctypes.get_errno()
+        if err in (errno.EAGAIN, errno.ENOBUFS): # Kernel queue full, expected when not blocking
+          print("Outbound kernel buffer / driver / interface may be overwhelmed")
+          self.metrics.count("send_overwhelmed")
+        else:
+          print("Error sending:", os.strerror(err))
+          self.metrics.count("send_errors")
+        break
 
+      sent += ret
 
-  # Add message signature and signature callback
-  def add_signature(self, name, callback, data=None, dedupe=10): # dedupe should be more like recent history filter
-    if name not in self.decoders:
-      print("Unknown decoder")
-      return False
-    self.decoders[name]["callback"] = callback
-    self.decoders[name]["data"]     = data # actually should be "return data type"
+    return sent
 
 
 
-  # Provided MAC matches ESP-NOW BROADCAST address
-  def is_broadcast(self, mac):
-    return mac.replace(":", "").upper() == "FFFFFFFFFFFF"
+  # Start listening for ESP-NOW packets
+  def start(self):
+    self.prepare()
 
+    self.startup_event.clear()
 
+    # Start receive workers before the listener, so processes fork before capture starts
+    if self.rx_workers and not self.rx_worker_pool:
+      self.start_rx_workers()
 
-  # Matches formated AA:BB:CC:DD:EE:FF or unformated AABBCCDDEEFF
-  def is_valid_mac(self, mac):
-    return re.match(r'^([0-9A-Fa-f]{2}:){5}[0-9A-Fa-f]{2}$|^[0-9A-Fa-f]{12}$', mac)
+    # Coordinator, receive from this object's radios and/or radio workers
+    if self.radio_coordinator:
+      if not all([radio.start() for radio in self.radios]):
+        return False
+      self.listener = scapy.threading.Thread(target=self.radio_coordinator.serve, args=(self.startup_event,), daemon=True)
 
+    # Receive from capture file, frames are parsed as with the raw socket
+    elif self.pcap_file:
+      self.listener = scapy.threading.Thread(target=self.pcap_listener, daemon=True)
 
+    # Receive with memory mapped ring, frames are parsed in place
+    elif self.recv_ring:
+      try:
+        sock, ring = self.open_rx_ring()
+      except Exception as e:
+        print("Error opening receive ring:", e)
+        return False
+      self.listener = scapy.threading.Thread(target=self.ring_listener, args=(sock, ring), daemon=True)
 
-  # Ensure MAC is formatted like FF:FF:FF:FF:FF:FF
-  def format_mac(self, mac):
-    return ":".join(mac.replace(":", "").upper()[i:i+2] for i in range(0, 12, 2))
+    # Receive with raw socket, frames are parsed straight from bytes
+    elif self.recv_raw:
+      try:
+        sock = self.open_rx_socket()
+      except Exception as e:
+        print("Error opening raw socket:", e)
+        return False
+      self.listener = scapy.threading.Thread(target=self.raw_listener, args=(sock,), daemon=True)
 
+    # Receive with scapy sniffer
+    else:
+      self.listener = scapy.AsyncSniffer(iface=self.interface, prn=self.sniff_rx if self.capture_writer else self.parse_rx_packet, filter=self.filter, started_callback=lambda: self.startup_event.set(), store=False)
 
+    self.listener.start()
 
-  # Return interface's HW MAC. "XX:XX:XX:XX:XX:XX"
-  def hw_mac_as_str(self, interface):
-    if hasattr(scapy, "get_if_raw_hwaddr"):
-      return ("%02X:" * 6)[:-1] % tuple(scapy.orb(x) for x in scapy.get_if_raw_hwaddr(self.l2_socket.iface)[1])
+    if self.startup_event.wait(timeout=1):
+      return True
     else:
-      return scapy.get_if_hwaddr(interface).upper() # Potentially better suited for containers
+      print("Error starting listener")
+      return False
 
 
 
-  # Return mac as raw bytes
-  def mac_as_bytes(self, mac):
-    if isinstance(mac, bytes):
-        return mac
-    return bytes.fromhex(mac.replace(':', ''))
+  # Open an AF_PACKET socket on the interface with the BPF filter attached
+  def open_rx_socket(self):
+    from scapy.arch.linux import attach_filter
 
+    sock = socket.socket(socket.AF_PACKET, socket.SOCK_RAW, socket.htons(scapy.ETH_P_ALL))
+    attach_filter(sock, self.filter, self.interface) # Attach before bind, so no unfiltered frames are queued
+    sock.bind((self.interface, scapy.ETH_P_ALL))
+    return sock
 
 
 
+  # Raw socket receive loop, one frame per recv
+  def raw_listener(self, sock):
+    capture = self.capture_writer
 
-def speed_test(espnow, duration, size, mac):
-  data, start = b'\x00' * int(size), time.time()
-  byte_count, packet_count, total, last_report = 0, 0, 0, start
-  mbps_history = []
-  while (now := time.time()) - start < int(duration):
-    espnow.send(mac, data, block=False)
-    byte_count += len(data)
-    packet_count += 1
-    total += 1
-    if now - last_report >= 1.0:
-      if packet_count == 0:
-        byte_count, packet_count, last_report = 0, 0, now
-        continue
-      mbps_history.append((byte_count * 8) / (now - last_report) / 1000000)
-      print(f"pkts/s: {packet_count / (now - last_report):.0f}  B/s: {byte_count / (now - last_report):.0f}  kbps: {byte_count * 8 / (now - last_report) / 1000:.1f}  Mbps: {mbps_history[-1]:.3f}  [min: {min(mbps_history):.3f}  avg: {sum(mbps_history) / len(mbps_history):.3f}  max: {max(mbps_history):.3f}]")
-      byte_count, packet_count, last_report = 0, 0, now
-  espnow._speed_test_packets_sent = total
-  print(f"\n\t\t\t {total} packets sent")
+    self.startup_event.set()
+    while True:
+      frame    = sock.recv(65535)
+      accepted = self.parse_rx_frame(frame)
+      if capture:
+        capture.write(frame, accepted)
 
 
 
+  # Scapy sniffer receive with the capture writer, the frame is captured after the callback has run
+  def sniff_rx(self, packet):
+    accepted = self.parse_rx_packet(packet)
+    self.capture_writer.write(packet.original, accepted, float(packet.time))
 
 
-# QOL structures
-decoders = {
-  "wizmote":{
-    "name":      "Wizmote",
-    "struct":    "<BIBBBB4s",
-    "vars":      ["type", "sequence", "dt1", "button", "dt2", "battery", "ccm"],
-    "dict":      {"battery": True, "sequence": True, "button": {1: "on", 2: "off", 3: "sleep", 16: "1", 17: "2", 18: "3", 19: "4", 8: "-", 9: "+"}},
-    "signature": {"length": 13, "bytes": {5: 0x20, 7: 0x01}},
-    "dedupe":    10
-    },
 
-  "wiz_motion":{
-    "name":      "wiz motion sensor",
-    "struct":    "<BIBBBBBBBB4s",
-    "vars":      ["type", "sequence", "dt1", "_0", "_1", "_2", "motion", "_3", "_4", "_5", "ccm"],
-    "dict":      {"motion": {0x0b: True, 0x19: True, 0x0a: False, 0x18: False}}, # 0x0b RT Motion | 0x19 LT Motion | 0x0a RT Clear | 0x18 LT Clear
-    "signature": {"length": 17, "bytes": {0: 0x81, 5: 0x42}},
-    "dedupe":    10
-    }
-}
+  # Open an AF_PACKET socket on the interface with the BPF filter attached and a memory mapped TPACKET_V3 receive ring
+  def open_rx_ring(self):
+    from scapy.arch.linux import attach_filter
 
+    block_nr = max(self.ring_size // self.ring_block_size, 1)
+    sock     = socket.socket(socket.AF_PACKET, socket.SOCK_RAW, socket.htons(scapy.ETH_P_ALL))
 
+    try:
+      sock.setsockopt(SOL_PACKET, PACKET_VERSION, TPACKET_V3)
+      attach_filter(sock, self.filter, self.interface)
 
+      # tpacket_req3: block size, block count, frame size, frame count, block timeout ms, private size, features
+      sock.setsockopt(SOL_PACKET, PACKET_RX_RING, struct.pack("IIIIIII", self.ring_block_size, block_nr, 2048, self.ring_block_size // 2048 * block_nr, self.ring_timeout, 0, 0))
+      ring = mmap.mmap(sock.fileno(), self.ring_block_size * block_nr, mmap.MAP_SHARED, mmap.PROT_READ | mmap.PROT_WRITE)
+      sock.bind((self.interface, scapy.ETH_P_ALL))
+    except:
+      sock.close()
+      raise
 
+    self.ring_socket = sock
+    return sock, ring
 
-def main():
-  import argparse
-  import signal
-  import os
 
-  def s2b(v): return True if v.lower() in ('yes', 'true', 't', 'y', '1') else False
 
-  def generic_callback   (from_mac, to_mac, data): print(from_mac, to_mac, "Generic callback handler. (%s)" % len(data), data)
-  def wizmote_callback   (from_mac, to_mac, data): print(from_mac, to_mac, "Wizmote callback handler", data)
+  # Receive ring loop, hands frames to the parser as views into the ring, releases each block when done
+  def ring_listener(self, sock, ring):
+    view        = memoryview(ring)
+    block_nr    = len(ring) // self.ring_block_size
+    block       = 0
+    last_stats  = time.time()
+    poller      = select.poll()
+    poller.register(sock, select.POLLIN | select.POLLERR)
+    capture     = self.capture_writer
+
+    self.startup_event.set()
+
+    while True:
+      offset = block * self.ring_block_size
+
+      # Block still owned by kernel, wait for it to be retired (full, or ring_timeout)
+      if not TPACKET_BLOCK_STATUS.unpack_from(ring, offset + 8)[0] & TP_STATUS_USER:
+        poller.poll(1000)
+
+      else:
+        num_pkts, pkt = TPACKET_BLOCK_PKTS.unpack_from(ring, offset + 12)
+        pkt += offset
+
+        for i in range(num_pkts):
+          next_offset, snaplen, mac = TPACKET3_HDR.unpack_from(ring, pkt)
+          frame    = view[pkt + mac : pkt + mac + snaplen]
+          accepted = self.parse_rx_frame(frame)
+          if capture:
+            capture.write(frame, accepted) # Copied before the block goes back to the kernel
+          pkt += next_offset
+
+        # Hand the block back to the kernel
+        TPACKET_BLOCK_STATUS.pack_into(ring, offset + 8, TP_STATUS_KERNEL)
+        block = (block + 1) % block_nr
+
+      # Check kernel drop counters about once a second
+      if time.time() - last_stats >= 1:
+        last_stats = time.time()
+        self.ring_stats()
+
+
+
+  # Kernel statistics for the receive ring, totals since start. Warns when packets have been dropped
+  def ring_stats(self):
+    with self.ring_stats_lock:
+      if self.ring_socket:
+        packets, drops, freezes = struct.unpack("III", self.ring_socket.getsockopt(SOL_PACKET, PACKET_STATISTICS, 12)) # Reading resets kernel counters
+        self.ring_packets  += packets
+        self.ring_drops    += drops
+        self.ring_freezes  += freezes
+        if drops:
+          print(f"Receive ring dropped {drops} packets, ring_size ({self.ring_size}) may be too small")
+
+    return {"packets": self.ring_packets, "drops": self.ring_drops, "freezes": self.ring_freezes}
+
+
+
+  # Process ESP-NOW frames from a RadioTap pcap/pcapng file with the raw frame parser, no radio required
+  # speed 1 keeps the captured timing, 2 twice as fast, 0 as fast as possible
+  def replay(self, pcap_file, speed=0):
+    self.prepare()
+
+    if self.rx_workers and not self.rx_worker_pool:
+      self.start_rx_workers()
+
+    count = 0
+    first = None
+    for timestamp, frame in pcap_frames(pcap_file):
+      # Keep the captured spacing between frames, scaled by speed
+      if speed:
+        if first is None:
+          first, started = timestamp, time.perf_counter()
+        sleep_until(started + (timestamp - first) / speed)
+
+      accepted = self.parse_rx_frame(frame)
+      if self.capture_writer:
+        self.capture_writer.write(frame, accepted, timestamp)
+      count += 1
+
+    return count
+
+
+
+  # Capture file receive loop, replays the file once then waits for receive workers to finish
+  def pcap_listener(self):
+    self.startup_event.set()
+
+    started = time.perf_counter()
+    count   = self.replay(self.pcap_file, self.pcap_speed)
+    for rx_queue in self.rx_queues: # Until every queued message is processed, not just taken off the queue
+      rx_queue.join()
+    elapsed = time.perf_counter() - started
+
+    print(f"Replayed {count} frames from {self.pcap_file} in {elapsed:.3f}s ({count / elapsed:.0f} frames/s)")
+
+
+
+  # Decode captured traffic in bulk into columns for analytics (pandas.DataFrame(columns) works). Requires NumPy
+  # source is a RadioTap pcap/pcapng file, or a list of raw frames or (timestamp, frame). Messages to any destination are included
+  # Resent and repeated copies (same source and random value) are kept once, as when receiving live
+  # Messages are grouped by decoder and each group is decoded in one pass. Returns {decoder name, None without decoder: {column: array}}
+  # Columns are timestamp, src, dst, rssi, then the decoder's fields as decode() returns them, or msg (bytes) without decoder
+  def bulk_decode(self, source):
+    if not HAVE_NUMPY:
+      print("Error! NumPy missing, bulk decode not available.")
+      return None
+
+    self.prepare()
+
+    if isinstance(source, str):
+      source = pcap_frames(source)
+
+    names  = {id(dec): name for name, dec in self.decoders.items()}
+    groups = {}
+    recent = {} # Recent random values by source MAC
+
+    for item in source:
+      timestamp, frame = item if isinstance(item, tuple) else (None, item)
+
+      message = self.frame_message(frame)
+      if message is None:
+        continue
+
+      from_mac, to_mac, rssi, rand, msg = message
+      seen = recent.setdefault(from_mac, collections.deque(maxlen=10))
+      if rand in seen:
+        continue
+      seen.append(rand)
+
+      dec  = self.check_decoders(msg)
+      rows = groups.setdefault(names.get(id(dec)) if dec else None, (dec, []))[1]
+      rows.append((timestamp, from_mac, to_mac, rssi, msg))
+
+    out = {}
+    for name, (dec, rows) in groups.items():
+      timestamps, src, dst, rssi, msgs = zip(*rows)
+      columns = {"timestamp": np.array([np.nan if t is None else t for t in timestamps], dtype=float),
+                 "src":       np.array(src),
+                 "dst":       np.array(dst),
+                 "rssi":      np.array([np.nan if r is None else r for r in rssi], dtype=float)}
+
+      if dec and "struct" in dec:
+        keep, fields = self.bulk_fields(dec, msgs)
+        columns      = {k: v[keep] for k, v in columns.items()} # Drop messages the struct can't decode
+        columns.update(fields)
+      else:
+        columns["msg"] = np.array(msgs, dtype=object)
+
+      out[name] = columns
+
+    return out
+
+
+
+  # Decode messages for one decoder in one numpy pass. Returns mask of messages decoded (right size) and {field: array}
+  # Byte fields are unpacked by struct, as decode() does, so trailing NULs and pascal strings come out the same
+  def bulk_fields(self, dec, msgs):
+    dtype          = struct_dtype(dec["struct"])
+    unpacker, spec = self.compile_decoder(dec)
+    keep           = np.fromiter((len(m) == dtype.itemsize for m in msgs), dtype=bool, count=len(msgs))
+    data           = b"".join(m for m, k in zip(msgs, keep) if k)
+    values         = np.frombuffer(data, dtype=dtype)
+    rows           = None
+    fields         = {}
+
+    for index, name, mapping in spec:
+      column = values[dtype.names[index]]
+
+      if column.dtype.kind == "V":
+        rows      = list(unpacker.iter_unpack(data)) if rows is None else rows
+        column    = np.empty(len(rows), dtype=object)
+        column[:] = [row[index] for row in rows]
+
+      # Value mappings are looked up once per distinct value
+      if mapping is None:
+        fields[name] = column
+      else:
+        unique, inverse = np.unique(column, return_inverse=True)
+        fields[name]    = np.array([mapping.get(v) for v in unique.tolist()] + [None], dtype=object)[:-1][inverse]
+
+    return keep, fields
+
+
+
+  # ESP-NOW message from a raw frame, as (from_mac, to_mac, rssi, random value, message), or None. Unlike parse_rx_frame, nothing is filtered by destination
+  def frame_message(self, frame):
+    if len(frame) < 8:
+      return None
+
+    rt_len, rt_flags, rssi = self.parse_radiotap(frame)
+    end = len(frame) - 4 if rt_flags & 0x10 else len(frame) # Strip FCS if present
+
+    if end - rt_len < 24 + 8 or frame[rt_len] != 0xd0:
+      return None
+
+    frame    = bytes(frame)
+    to_mac   = frame[rt_len+4:rt_len+10].hex(":").upper()
+    from_mac = frame[rt_len+10:rt_len+16].hex(":").upper()
+    data     = frame[rt_len+24:end]
+
+    # Encrypted, decrypt if there is a key for the sender. CCMP header is PN0 PN1 rsvd keyid PN2 PN3 PN4 PN5
+    if frame[rt_len+1] & 0x40:
+      ccm = self.peer_ccm(from_mac)
+      if not ccm or len(data) < 16 + 8:
+        return None
+      nonce = int.from_bytes(b'\x00' + frame[rt_len+10:rt_len+16] + bytes((data[7], data[6], data[5], data[4], data[1], data[0])), 'big')
+      data  = ccm.decrypt(nonce, data[8:-8])
+
+    msg = espnow_message(data) if data.startswith(b"\x7f\x18\xfe\x34") else None
+    if msg is None:
+      return None
+
+    return from_mac, to_mac, rssi, data[4:8], msg
+
+
+
+  # Callback for connection to broker
+  def mqtt_on_connect(self, client, userdata, flags, reason_code, properties):
+
+    # Set LWT Online
+    self.mqtt_client.publish(self.mqtt_topic_base, "online", qos=1, retain=True)
+
+    if reason_code == 0:
+      print("Connected to broker")
+      client.subscribe(self.mqtt_topic_send+"/#")
+    else:
+      print(f"Failed to connect to broker, return code {reason_code}")
+
+
+
+  # Send ESP-NOW messages on MQTT receive, never blocking paho's network thread on the radio
+  # base_topic/send/MAC sends the payload to MAC, base_topic/send/batch sends each message of a compact envelope (see encode_envelope) to its to_mac
+  # Either may end in /request id, delivery results are then published to base_topic/reply/request id
+  def mqtt_on_message(self, client, userdata, msg):
+
+    # Discard empty message
+    if self.mqtt_discard_empty and not msg.payload:
+      return
+
+    route = self.mqtt_send_routes.get(msg.topic)
+    if route is None:
+      route = self.mqtt_send_route(msg.topic)
+
+    if not route:
+      self.metrics.count("mqtt_ingress_rejected")
+      return
+
+    mac, request_id = route
+    if mac == "batch":
+      try:
+        sends = [(frame["to_mac"], frame["msg"]) for frame in decode_envelope(msg.payload)]
+      except Exception as e:
+        print("Invalid MQTT batch:", e)
+        self.metrics.count("mqtt_ingress_rejected")
+        return
+    else:
+      sends = [(mac, msg.payload)]
+
+    self.metrics.counters["mqtt_ingress_messages"] += len(sends)
+
+    # Consecutive messages to the same MAC are handed over together, see send_background. Unicast is tracked with or without a request id
+    # Broadcast and no_wait messages get no ACK, their futures only say they were sent
+    futures = []
+    start   = 0
+    for i in range(1, len(sends) + 1):
+      if i < len(sends) and sends[i][0] == sends[start][0]:
+        continue
+
+      mac     = sends[start][0]
+      msgs    = [msg_ for mac_, msg_ in sends[start:i]]
+      tracked = not self.no_wait and not self.is_broadcast(mac)
+      start   = i
+      try:
+        futures.extend((future, tracked) for future in self.send_background(mac, msgs))
+
+      # Too large to send, fails without taking down MQTT message handling
+      except ValueError as e:
+        print("Invalid MQTT send:", e)
+        self.metrics.count("mqtt_ingress_rejected")
+        for msg_ in msgs:
+          failed = concurrent.futures.Future()
+          failed.set_result(False)
+          futures.append((failed, True))
+
+    if request_id:
+      self.mqtt_reply(request_id, futures)
+
+
+
+  # Parse and validate an MQTT send topic as (MAC or "batch", request id or None), cached by topic. False if invalid
+  def mqtt_send_route(self, topic):
+    parts = topic[len(self.mqtt_topic_send) + 1:].split("/")
+    route = False
+
+    if topic.startswith(self.mqtt_topic_send + "/") and len(parts) <= 2 and all(parts):
+      request_id = parts[1] if len(parts) == 2 else None
+      if parts[0] == "batch":
+        route = ("batch", request_id)
+      elif self.is_valid_mac(parts[0]):
+        route = (self.format_mac(parts[0]), request_id)
+
+    # Unique request ids would grow the cache without limit
+    if len(self.mqtt_send_routes) >= 4096:
+      self.mqtt_send_routes.clear()
+    self.mqtt_send_routes[topic] = route
+
+    return route
+
+
+
+  # Publish the results of an MQTT send request to base_topic/reply/request id, once every message is delivered, failed or sent unconfirmed
+  # futures are (future, confirmable) pairs. Results are true if delivered, false if failed, null if sent where no ACK can confirm it
+  def mqtt_reply(self, request_id, futures):
+    lock      = scapy.threading.Lock()
+    remaining = [len(futures)]
+
+    def publish():
+      results = [(True if future.result() else False) if confirmable else (None if future.result() else False) for future, confirmable in futures]
+      self.mqtt_publish(f"{self.mqtt_topic_base}/reply/{request_id}", json.dumps({"id": request_id, "results": results, "delivered": results.count(True), "failed": results.count(False), "unconfirmed": results.count(None)}), self.mqtt_qos["reply"])
+
+    def done(future):
+      with lock:
+        remaining[0] -= 1
+        if remaining[0]:
+          return
+      publish()
+
+    # Nothing to wait for, an empty batch is answered at once
+    if not futures:
+      publish()
+
+    for future, confirmable in futures:
+      future.add_done_callback(done)
+
+
+
+  # Process incoming ESP-NOW packets. Returns True when accepted
+  def parse_rx_packet(self, packet):
+    if scapy.Dot11 not in packet: # Truncated before the 802.11 header
+      return
+
+    is_ack   = (packet.type==1 and packet.subtype==13) # Packet is a delivery confirmation
+    from_mac = "" if is_ack else (packet.addr2 or "").upper() # Source MAC
+    to_mac   = (packet.addr1 or "").upper()            # Destination MAC
+
+    # Ignore packet, or truncated within the 802.11 header
+    if not to_mac or not (is_ack or from_mac) or not self.rx_allowed(is_ack, to_mac):
+      return
+
+    # Packet is ACK, delivery confirmation from remote peer
+    if is_ack:
+      self.process_rx(packet, True, from_mac, to_mac, b"")
+
+    # ESP-NOW message is encrypted, pass CCMP PN and encrypted data with MIC
+    elif scapy.Dot11CCMP in packet:
+      if len(packet.data or b"") < 8: # Truncated within the CCMP header or MIC
+        return
+      self.dispatch_rx(packet, from_mac, to_mac, packet.data, struct.pack("BBBBBB",packet.PN5,packet.PN4,packet.PN3,packet.PN2,packet.PN1,packet.PN0), getattr(packet, "dBm_AntSignal", None))
+
+    # ESP-NOW message is plaintext
+    elif scapy.Raw in packet:
+      self.dispatch_rx(packet, from_mac, to_mac, packet["Raw"].load, None, getattr(packet, "dBm_AntSignal", None))
+
+    else:
+      return
+
+    return True
+
+
+
+  # Process incoming ESP-NOW frames as raw bytes (RadioTap + 802.11), without scapy dissection
+  # frame may be a memoryview into a receive ring, it is only copied once accepted. Returns True when accepted
+  def parse_rx_frame(self, frame):
+    if len(frame) < 8:
+      return
+
+    rt_len, rt_flags, rssi = self.parse_radiotap(frame)
+    end = len(frame) - 4 if rt_flags & 0x10 else len(frame) # Strip FCS if present
+
+    if end - rt_len < 10:
+      return
+
+    fc     = frame[rt_len]                                     # Frame control, type and subtype
+    to_mac = bytes(frame[rt_len+4:rt_len+10]).hex(":").upper() # Destination MAC
+
+    # Packet is ACK, delivery confirmation from remote peer
+    if fc == 0xd4:
+      if to_mac != self.local_mac or not self.rx_allowed(True, to_mac):
+        return
+      self.process_rx(bytes(frame), True, "", to_mac, b"")
+      return True
+
+    # Not an action frame, or too short to be ESP-NOW
+    if fc != 0xd0 or end - rt_len < 24 + 8:
+      return
+
+    from_mac = bytes(frame[rt_len+10:rt_len+16]).hex(":").upper() # Source MAC
+
+    # Ignore own packets, and packets not for us
+    if from_mac == self.local_mac or not self.rx_allowed(False, to_mac):
+      return
+
+    # ESP-NOW message is encrypted, CCMP header is PN0 PN1 rsvd keyid PN2 PN3 PN4 PN5
+    if frame[rt_len+1] & 0x40:
+      if end - rt_len < 24 + 16:
+        return
+      frame = bytes(frame)
+      body  = frame[rt_len+24:end]
+      self.dispatch_rx(frame, from_mac, to_mac, body[8:], bytes((body[7], body[6], body[5], body[4], body[1], body[0])), rssi)
+      return True
+
+    # ESP-NOW message is plaintext, matches vendor specific category and Espressif OUI
+    elif frame[rt_len+24:rt_len+28] == b"\x7f\x18\xfe\x34":
+      frame = bytes(frame)
+      self.dispatch_rx(frame, from_mac, to_mac, frame[rt_len+24:end], None, rssi)
+      return True
+
+
+
+  # Parse RadioTap header from raw frame bytes. Returns header length, flags, and dBm antenna signal (or None)
+  # A header longer than the frame is returned as is, callers then find no room for the 802.11 header
+  def parse_radiotap(self, frame):
+    rt_len  = frame[2] | frame[3] << 8
+    present = frame[4] | frame[5] << 8
+    offset  = 4
+    flags   = 0
+    rssi    = None
+
+    if rt_len < 8 or rt_len > len(frame):
+      return rt_len, flags, rssi
+
+    # Skip extended present bitmaps, fields start after the last one
+    while offset + 8 <= rt_len and frame[offset+3] & 0x80:
+      offset += 4
+    offset += 4
+
+    if present & 0x01:                   # TSFT, u64 aligned to 8
+      offset = ((offset + 7) & ~7) + 8
+
+    if present & 0x02 and offset < rt_len: # Flags, u8
+      flags   = frame[offset]
+      offset += 1
+
+    if present & 0x20:                   # dBm antenna signal, s8. Skip Rate u8, Channel 2x u16, FHSS 2x u8
+      if present & 0x04:
+        offset += 1
+      if present & 0x08:
+        offset = ((offset + 1) & ~1) + 4
+      if present & 0x10:
+        offset += 2
+      if offset < rt_len:
+        rssi = frame[offset] - 256 if frame[offset] > 127 else frame[offset]
+
+    return rt_len, flags, rssi
+
+
+
+  # Check received packet against accept_all, accept_broadcast and local MAC settings
+  def rx_allowed(self, is_ack, to_mac):
+    allow = False # Deny packet flag
+
+    # Allow all ESP-NOW UNICAST packets
+    if self.accept_all and not is_ack:
+      allow = True
+
+    # Allow ESP-NOW BROADCAST packets
+    elif self.accept_broadcast and self.is_broadcast(to_mac):
+      allow = True
+
+    # Allow ESP-NOW packet sent to local_mac
+    elif to_mac == self.local_mac:
+      allow = True
+
+    # Deny if not accepting packets sent to non local_mac
+    if (not self.accept_all and to_mac != self.local_mac) and (not self.accept_broadcast and self.is_broadcast(to_mac)):
+      allow = False
+
+    # Deny if not accepting BROADCAST and packet is BROADCAST
+    if not self.accept_broadcast and self.is_broadcast(to_mac):
+      allow = False
+
+    return allow
+
+
+
+  # Hand an accepted ESP-NOW message to process_rx, or queue it for a receive worker
+  # Messages are sharded by source MAC, so each peer's messages are processed in order by one worker
+  def dispatch_rx(self, packet, from_mac, to_mac, data, pn, rssi):
+    if not self.rx_queues:
+      return self.process_rx(packet, False, from_mac, to_mac, data, pn, rssi)
+
+    shard = int(from_mac[-2:], 16) % len(self.rx_queues)
+    try:
+      self.rx_queues[shard].put_nowait((packet, False, from_mac, to_mac, data, pn, rssi))
+      self.rx_queued[shard] += 1
+    except queue.Full: # Don't stall capture behind a slow worker
+      self.rx_queue_drops[shard] += 1
+
+
+
+  # Start receive worker threads, or forked processes, each with its own queue
+  def start_rx_workers(self):
+    ctx = multiprocessing.get_context("fork")
+
+    if self.rx_worker_mode == "process":
+      self.mqtt_relay_queue = ctx.Queue() if self.use_mqtt else None
+      if self.mqtt_relay_queue:
+        scapy.threading.Thread(target=self.mqtt_relay, daemon=True).start()
+
+    for n in range(self.rx_workers):
+      if self.rx_worker_mode == "process":
+        rx_queue = ctx.JoinableQueue(self.rx_queue_size)
+        worker   = ctx.Process(target=self.rx_worker, args=(rx_queue, True), daemon=True)
+      else:
+        rx_queue = queue.Queue(self.rx_queue_size)
+        worker   = scapy.threading.Thread(target=self.rx_worker, args=(rx_queue,), daemon=True)
+
+      self.rx_queues.append(rx_queue)
+      self.rx_queued.append(0)
+      self.rx_queue_drops.append(0)
+      self.rx_worker_pool.append(worker)
+      worker.start()
+
+
+
+  # Receive worker loop, processes one shard's messages in order
+  def rx_worker(self, rx_queue, process=False):
+    if process:
+      self.in_worker_process = True
+      if self.mqtt_batcher: # The parent's flush thread did not survive the fork
+        self.mqtt_batcher = self.envelope_batcher()
+      if self.coordinator_link: # Nor did the link's reader, and the connection can't be shared between processes
+        self.coordinator_link = CoordinatorLink(self, self.coordinator)
+
+    recent = collections.deque(maxlen=10) # Resends come from the same source, so each worker filters its own
+    while True:
+      item = rx_queue.get()
+      try:
+        self.process_rx(*item, recent=recent)
+      except Exception as e:
+        print("Error processing message:", e)
+      finally:
+        rx_queue.task_done()
+
+
+
+  # Receive worker queue depth, messages queued, and messages dropped with the queue full, per worker
+  def rx_worker_stats(self):
+    return [{"depth": rx_queue.qsize(), "queued": self.rx_queued[n], "drops": self.rx_queue_drops[n]} for n, rx_queue in enumerate(self.rx_queues)]
+
+
+
+  # All statistics: send/receive counters and latency histograms (see Metrics.snapshot), plus delivery, TX worker, receive worker, ring, capture, MQTT and coordinator statistics
+  # Counters from forked receive worker processes stay in those processes
+  def stats(self):
+    stats             = self.metrics.snapshot()
+    stats["delivery"] = self.delivery_stats()
+    stats["tx"]       = self.tx_stats()
+
+    if self.rx_queues:
+      stats["rx_workers"] = self.rx_worker_stats()
+    if self.ring_socket:
+      stats["ring"]       = self.ring_stats()
+    if self.capture_writer:
+      stats["capture"]    = self.capture_stats()
+    if self.use_mqtt:
+      stats["mqtt"]       = self.mqtt_publisher.stats()
+    if self.coordinator_link:
+      stats["coordinator"] = self.coordinator_link.stats()
+    if self.radio_coordinator:
+      stats["coordinator"] = self.radio_coordinator.stats()
+    if self.radios:
+      stats["radios"]     = {radio.interface: {"delivery": radio.delivery_stats(), "tx": radio.tx_stats()} for radio in self.radios}
+
+    return stats
+
+
+
+  # Serve stats over HTTP, Prometheus text on /metrics and JSON on /stats
+  def serve_stats(self, port):
+    espnow = self
+
+    class StatsHandler(http.server.BaseHTTPRequestHandler):
+      def do_GET(self):
+        if self.path == "/metrics":
+          stats = espnow.stats()
+          body  = espnow.metrics.prometheus(extra={k: v for k, v in stats.items() if k not in ("counters", "histograms")}).encode()
+          ctype = "text/plain; version=0.0.4"
+        elif self.path == "/stats":
+          body  = json.dumps(espnow.stats()).encode()
+          ctype = "application/json"
+        else:
+          self.send_error(404)
+          return
+        self.send_response(200)
+        self.send_header("Content-Type", ctype)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+      def log_message(self, format, *args): # No request logging
+        pass
+
+    try:
+      self.stats_server = http.server.ThreadingHTTPServer(("", port), StatsHandler)
+    except Exception as e:
+      print(f"Error starting stats server on port {port}: {e}")
+      return False
+
+    scapy.threading.Thread(target=self.stats_server.serve_forever, daemon=True).start()
+    return True
+
+
+
+  # Routing table, the radio (interface, or radio worker) each destination MAC is sent through, learned from received messages
+  def routes(self):
+    return self.radio_coordinator.routes() if self.radio_coordinator else {}
+
+
+
+  # Publish stats as JSON to MQTT every stats_interval seconds
+  def stats_publisher(self):
+    while True:
+      time.sleep(self.stats_interval)
+      self.mqtt_publish(f"{self.mqtt_topic_base}/stats", json.dumps(self.stats()), self.mqtt_qos["stats"], coalesce=True)
+
+
+
+  # Capture writer statistics, None without capture_file
+  def capture_stats(self):
+    return self.capture_writer.stats() if self.capture_writer else None
+
+
+
+  # Write frames still queued for capture and close the capture file
+  def stop_capture(self):
+    if self.capture_writer:
+      self.capture_writer.close()
+      self.capture_writer = None
+
+
+
+  # Publish MQTT messages from receive worker processes with the parent's connection
+  def mqtt_relay(self):
+    while True:
+      topic, payload, qos = self.mqtt_relay_queue.get()
+      self.mqtt_publish(topic, payload, qos)
+
+
+
+  # Publish to MQTT, receive worker processes hand messages to the parent
+  def mqtt_publish(self, topic, payload, qos=1, coalesce=False):
+    if self.in_worker_process:
+      self.mqtt_relay_queue.put((topic, payload, qos))
+    else:
+      self.mqtt_publisher.submit(topic, payload, qos, coalesce)
+
+
+
+  # Compact envelope batcher, publishing to base_topic/frames
+  def envelope_batcher(self):
+    return EnvelopeBatcher(lambda payload: self.mqtt_publish(f"{self.mqtt_topic_base}/frames", payload, self.mqtt_qos["frames"]), self.mqtt_compact_wait, self.mqtt_compact_max)
+
+
+
+  # ACK received by this ESPythoNow or one of its radios, runs the ACK callback, MQTT publish and delivery hooks
+  def ack_received(self, to_mac):
+    self.delivery_confirmed = True
+
+    # Execute RX callback for ACK
+    if self.accept_ack:
+
+      if callable(self.esp_now_rx_callback):
+        self.esp_now_rx_callback(False, to_mac, "ack")
+
+      if self.use_mqtt and self.mqtt_publish_ack:
+        self.mqtt_publish(f"{self.mqtt_topic_base}/ack/{to_mac}", "ack", self.mqtt_qos["ack"])
+
+    # Clear delivery confirmation flag
+    self.delivery_event.set()
+
+    if self.delivery_callback:
+      self.delivery_callback(to_mac)
+
+
+
+  # Handle an accepted ESP-NOW message or ACK, shared by the scapy and raw receive paths
+  # data is the ESP-NOW payload, or the encrypted data with MIC when pn (CCMP packet number PN5..PN0) is set
+  # recent is the resent message filter to use, each receive worker has its own
+  def process_rx(self, packet, is_ack, from_mac, to_mac, data, pn=None, rssi=None, recent=None):
+
+    # Store most recent packet
+    self.packet = packet
+
+    # Packet is ACK, delivery confirmation from remote peer
+    if is_ack:
+      self.metrics.count("acks_received")
+
+      # Confirm the most recently transmitted tracked message, tracking is per radio
+      if self.delivery_tracker:
+        rtt = self.delivery_tracker.ack()
+        if rtt is not None:
+          self.metrics.observe("ack_rtt_seconds", rtt)
+
+      # Radio of a multi-interface ESPythoNow, ACK callbacks and MQTT are the parent's
+      (self.ack_forward or self.ack_received)(to_mac)
+
+    # Packet is ESP-NOW message
+    else:
+      self.rssi                    = rssi
+      counters                     = self.metrics.counters # Incremented in place, the receive hot path
+      counters["frames_received"] += 1
+
+      # ESP-NOW message is encrypted
+      if pn is not None:
+
+        # Shorter than the smallest ESP-NOW message and MIC, truncated
+        if len(data) < ESPNOW_HEADER.size + 7 + 8:
+          self.metrics.count("malformed_dropped")
+          return
+
+        # Per peer LMK if registered, otherwise the default LMK
+        ccm = self.peer_ccm(from_mac)
+
+        # If decryption keys present
+        if ccm:
+          nonce = int.from_bytes(b'\x00'+bytes.fromhex(from_mac.replace(':',''))+pn, 'big')
+          data  = ccm.decrypt(nonce, data[:-8])
+
+          # Check if decryption succeded
+          if not data.startswith(b"\x7f\x18\xfe\x34"):
+            print("Decryption Failed")
+            self.metrics.count("decrypt_failures")
+            data = ENCRYPTED_PLACEHOLDER % random.randbytes(4)
+
+        # No decryption keys present
+        else:
+          # Message may never reach here due to scapy filtering rules
+          data = ENCRYPTED_PLACEHOLDER % random.randbytes(4)
+
+      # Check if vendor category code has been stripped. Due to cooked mode host network mode passthrough removing this byte?
+      if data[:1] != b"\x7f":
+        data = b"\x7f" + data
+
+      # Parse message from ESP-NOW packet, v1.0 and v2.0. Truncated or malformed messages are dropped
+      msg_raw = espnow_message(data)
+      if msg_raw is None:
+        self.metrics.count("malformed_dropped")
+        return
+
+      # Check packets random values to filter resent messages
+      recent = self.recent_rand_values if recent is None else recent
+      if data[4:8] in recent:
+        self.metrics.count("duplicates_dropped")
+        return
+      else:
+        recent.append(data[4:8])
+
+      # Radio worker, the coordinator filters copies heard by other radios and handles the message
+      if self.coordinator_link:
+        self.coordinator_link.forward(from_mac, to_mac, rssi, data)
+        return
+
+      counters["messages_received"]      += 1
+      counters["message_bytes_received"] += len(msg_raw)
+
+      # Check if there is a decoder that matches this message
+      dec = self.check_decoders(msg_raw)
+      if dec:
+        self.metrics.count("decoder_hits", label=("decoder", self.decoder_index.names.get(id(dec))))
+
+      # If a decoder exists for this message, and is set to filter duplicate messages, different from filtering resent messages.
+      if dec and "recent" in dec:
+        with self.decoder_lock:
+          if msg_raw in dec["recent"]:
+            self.metrics.count("decoder_duplicates_dropped")
+            return
+          dec["recent"].append(msg_raw)
+
+      # Prepare default callback values
+      callback = self.esp_now_rx_callback
+      output   = msg_raw
+      hex_str  = None # Decoded/encoded at most once, shared by the callback and MQTT
+      decoded  = None
+      json_str = None
+
+      # Check if decoder has a callback associated with it
+      if dec and "callback" in dec and callable(dec["callback"]):
+        callback = dec["callback"]
+        if   dec["data"] == "hex":  output = hex_str = msg_raw.hex(" ")
+        elif dec["data"] == "dict": output = decoded = self.decode(dec, msg_raw)
+        elif dec["data"] == "json":
+          decoded  = self.decode(dec, msg_raw)
+          output   = json_str = json.dumps(decoded)
+
+      # Execute the callback if one was found
+      if callback and callable(callback):
+        started = time.perf_counter()
+        callback(from_mac, to_mac, output)
+        self.metrics.observe("callback_seconds", time.perf_counter() - started)
+
+      # Check to see if using MQTT and publish incoming messages
+      if self.use_mqtt:
+
+        if self.mqtt_discard_empty and not msg_raw:
+          return
+
+        if self.mqtt_batcher:
+          self.mqtt_batcher.add(time.time(), from_mac, to_mac, rssi, msg_raw)
+
+        elif self.mqtt_publish_raw:
+          self.mqtt_publish(f"{self.mqtt_topic_base}/{from_mac}/{to_mac}/raw", msg_raw, self.mqtt_qos["raw"])
+
+        if self.mqtt_publish_hex and not self.mqtt_batcher:
+          self.mqtt_publish(f"{self.mqtt_topic_base}/{from_mac}/{to_mac}/hex", hex_str or msg_raw.hex(" "), self.mqtt_qos["hex"])
+
+        if dec and self.mqtt_publish_json and "struct" in dec:
+          if json_str is None:
+            json_str = json.dumps(decoded if decoded is not None else self.decode(dec, msg_raw))
+          self.mqtt_publish(f"{self.mqtt_topic_base}/{from_mac}/{to_mac}/json", json_str, self.mqtt_qos["json"])
+
+
+
+  # Identify the message signature
+  def check_decoders(self, data):
+    index = self.decoder_index
+
+    # Decoders assigned, added, replaced or removed since compiled
+    if index is None or index.decoders is not self.decoders or index.version != self.decoders.version:
+      if not isinstance(self.decoders, DecoderTable):
+        self.decoders = DecoderTable(self.decoders)
+      index = self.decoder_index = DecoderIndex(self.decoders)
+
+    return index.match(data)
+
+
+
+  # Takes the signature data and creates a dictionary of the parsed data to send to callback
+  def decode(self, sig, msg):
+    unpacker, fields = self.compile_decoder(sig)
+    values           = unpacker.unpack(msg)
+    out              = {}
+
+    for index, name, mapping in fields:
+      if mapping is None:
+        out[name] = values[index]
+      elif values[index] in mapping:
+        out[name] = mapping[values[index]]
+
+    return out
+
+
+
+  # Compile a decoder once into a struct.Struct and a flat list of (value index, name, value mapping or None for the raw value)
+  def compile_decoder(self, sig):
+    compiled = self.compiled_decoders.get(id(sig))
+    if compiled and compiled[0] is sig:
+      return compiled[1]
+
+    fields = []
+    for k,v in sig["dict"].items():
+      if k not in sig["vars"]:
+        continue
+
+      index = len(sig["vars"]) - 1 - sig["vars"][::-1].index(k) # Last of duplicate names wins, as with dict(zip())
+
+      if isinstance(v, bool) and v:
+        fields.append((index, k, None))
+
+      elif isinstance(v, dict):
+        fields.append((index, k, v))
+
+    self.compiled_decoders[id(sig)] = (sig, (struct.Struct(sig["struct"]), fields))
+    return self.compiled_decoders[id(sig)][1]
+
+
+
+  # Add message signature and signature callback
+  def add_signature(self, name, callback, data=None, dedupe=10): # dedupe should be more like recent history filter
+    if name not in self.decoders:
+      print("Unknown decoder")
+      return False
+    self.decoders[name]["callback"] = callback
+    self.decoders[name]["data"]     = data # actually should be "return data type"
+
+
+
+  # Add or replace a peer with its own LMK, messages to and from the peer use it instead of the default LMK. Requires PMK
+  def add_peer(self, mac, lmk):
+    lmk = str.encode(lmk) if isinstance(lmk, str) else lmk
+
+    if not HAVE_PYCRYPTODOME:
+      print("Error! PyCryptoDome missing, encryption can not be enabled.")
+      return False
+
+    if not self.pmk or len(self.pmk) != 16 or not lmk or len(lmk) != 16:
+      print("Invalid PMK or LMK for peer %s" % mac)
+      return False
+
+    ccm = self.lmk_context(lmk)
+    self.peers[self.format_mac(mac)] = {"lmk": lmk, "key": ccm.key, "ccm": ccm}
+    self.frame_templates.clear() # Templates for this peer may have been built with another key
+    for radio in self.radios:
+      radio.frame_templates.clear()
+    return True
+
+
+
+  # Remove a peer's LMK, messages to and from the peer go back to the default LMK or plaintext
+  def remove_peer(self, mac):
+    if self.peers.pop(self.format_mac(mac), None) is None:
+      return False
+    self.frame_templates.clear()
+    for radio in self.radios:
+      radio.frame_templates.clear()
+    return True
+
+
+
+  # CCM context for messages to or from MAC, formatted AA:BB:CC:DD:EE:FF. Per peer LMK if registered, otherwise the default LMK, or None for plaintext
+  def peer_ccm(self, mac):
+    peer = self.peers.get(mac)
+    return peer["ccm"] if peer else self.ccm
+
+
+
+  # CCM context for LMK, the key is derived from PMK and LMK once and cached
+  def lmk_context(self, lmk):
+    ccm = self.lmk_contexts.get(lmk)
+
+    if ccm is None:
+      pmk = str.encode(self.pmk) if isinstance(self.pmk, str) else self.pmk
+      ccm = self.lmk_contexts[lmk] = CCMContext(AES.new(pmk, AES.MODE_ECB).encrypt(lmk))
+
+    return ccm
+
+
+
+  # Provided MAC matches ESP-NOW BROADCAST address
+  def is_broadcast(self, mac):
+    return mac.replace(":", "").upper() == "FFFFFFFFFFFF"
+
+
+
+  # Matches formated AA:BB:CC:DD:EE:FF or unformated AABBCCDDEEFF
+  def is_valid_mac(self, mac):
+    return re.match(r'^([0-9A-Fa-f]{2}:){5}[0-9A-Fa-f]{2}$|^[0-9A-Fa-f]{12}$', mac)
+
+
+
+  # Ensure MAC is formatted like FF:FF:FF:FF:FF:FF
+  def format_mac(self, mac):
+    return ":".join(mac.replace(":", "").upper()[i:i+2] for i in range(0, 12, 2))
+
+
+
+  # Return interface's HW MAC. "XX:XX:XX:XX:XX:XX"
+  def hw_mac_as_str(self, interface):
+    if hasattr(scapy, "get_if_raw_hwaddr"):
+      return ("%02X:" * 6)[:-1] % tuple(scapy.orb(x) for x in scapy.get_if_raw_hwaddr(interface)[1])
+    else:
+      return scapy.get_if_hwaddr(interface).upper() # Potentially better suited for containers
+
+
+
+  # Return mac as raw bytes
+  def mac_as_bytes(self, mac):
+    if isinstance(mac, bytes):
+        return mac
+    return bytes.fromhex(mac.replace(':', ''))
+
+
+
+
+
+# asyncio interface to ESPythoNow. The event loop reads the receive socket with add_reader, there is no listener thread
+# Messages are read from a bounded queue. The socket is always read so ACKs are seen, messages arriving with the queue full are dropped and counted
+# Each send awaits its own delivery confirmation from the ESPythoNow delivery tracker
+class AsyncESPythoNow:
+
+  def __init__(self, espnow, queue_size=1024):
+    self.espnow     = espnow                                     # ESPythoNow instance, interface and send/receive settings
+    self.queue_size = queue_size                                 # Received messages held, more are dropped
+    self.queue      = None                                       # Received (from_mac, to_mac, msg), created on start in the running loop
+    self.loop       = None                                       # Event loop the socket is registered with
+    self.sock       = None                                       # Receive socket
+    self.dropped    = 0                                          # Messages dropped with the queue full
+
+    espnow.esp_now_rx_callback = self.on_message
+
+
+
+  # Open the receive socket and register it with the running event loop
+  async def start(self):
+    self.espnow.prepare()
+
+    self.loop  = asyncio.get_running_loop()
+    self.queue = asyncio.Queue(self.queue_size)
+
+    try:
+      self.sock = self.espnow.open_rx_socket()
+    except Exception as e:
+      print("Error opening raw socket:", e)
+      return False
+
+    self.sock.setblocking(False)
+    self.loop.add_reader(self.sock, self.on_readable)
+    return True
+
+
+
+  # Unregister and close the receive socket
+  async def stop(self):
+    if self.sock:
+      self.loop.remove_reader(self.sock)
+      self.sock.close()
+      self.sock = None
+
+
+
+  # Read available frames, a limited number per call so a flood can't starve the event loop
+  def on_readable(self):
+    for i in range(64):
+      try:
+        frame = self.sock.recv(65535)
+      except BlockingIOError:
+        return
+
+      self.espnow.parse_rx_frame(frame)
+
+
+
+  # RX callback. With the queue full the message is dropped, reading goes on so delivery confirmations still arrive
+  def on_message(self, from_mac, to_mac, msg):
+    if self.queue.full():
+      self.dropped += 1
+      self.espnow.metrics.count("async_queue_drops")
+      return
+
+    self.queue.put_nowait((from_mac, to_mac, msg))
+
+
+
+  # Received ESP-NOW messages, as (from_mac, to_mac, msg)
+  async def messages(self):
+    while True:
+      yield await self.queue.get()
+
+
+
+  # Send ESP-NOW message(s) to MAC without blocking the event loop
+  # Returns True once delivery is confirmed, or when no confirmation is expected (broadcast, no_wait). False if not confirmed
+  async def send(self, mac, msg):
+    futures = self.espnow.send_async(mac, msg)
+    return all([await asyncio.wrap_future(future) for future in futures])
+
+
+
+
+
+# Blobs of any size over ESP-NOW, split into numbered fragments and reassembled on receive
+# Unicast receivers NACK missing fragments when they see the last one, and the sender resends only those. Broadcast blobs are sent once
+# Receive memory is bounded by max_blobs reassemblies of up to max_blob_size, reassemblies idle for timeout are dropped
+class FragmentTransport:
+
+  def __init__(self, espnow, callback=None, fragment_size=250, timeout=.5, retries=5, max_blob_size=1048576, max_blobs=8):
+    self.espnow        = espnow                                  # ESPythoNow instance
+    self.callback      = callback                                # Function called with (from_mac, to_mac, blob) for each reassembled blob
+    self.fragment_size = fragment_size                           # ESP-NOW message size including the fragment header. 250 for ESP-NOW v1.0 receivers, up to 1470 for v2.0
+    self.timeout       = timeout                                 # How long the sender waits for a NACK or DONE, and receive reassemblies wait for more fragments
+    self.retries       = retries                                 # Send rounds without progress before giving up
+    self.max_blob_size = max_blob_size                           # Largest blob reassembled
+    self.max_blobs     = max_blobs                               # Reassemblies in progress, the least recently active is dropped for a new one
+    self.blob_id       = random.randrange(0x10000)               # Last blob id sent
+    self.blobs         = {}                                      # Reassemblies in progress by (from_mac, blob id)
+    self.completed     = collections.deque(maxlen=64)            # Recently reassembled (from_mac, blob id), answered with DONE if the sender asks again
+    self.sending       = {}                                      # Sends waiting for NACK or DONE by (mac, blob id)
+    self.lock          = scapy.threading.Lock()                  # Receive workers may handle different senders at once
+
+    # Fragment messages are recognized by their magic bytes and handed to this transport
+    espnow.decoders = {**espnow.decoders, "fragment": {"name": "FragmentTransport", "signature": {"bytes": {0: FRAGMENT_MAGIC[0], 1: FRAGMENT_MAGIC[1]}}, "callback": self.on_message, "data": "raw"}}
+
+
+
+  # Send blob to mac. Returns True once the receiver has all of it, for broadcast once sent
+  def send(self, mac, blob):
+    mac   = self.espnow.format_mac(mac)
+    size  = self.fragment_size - FRAGMENT_HEADER.size
+    count = max((len(blob) + size - 1) // size, 1)
+
+    if count > 0xFFFF:
+      print(f"Blob too large ({len(blob)} bytes) for fragment_size {self.fragment_size}")
+      return False
+
+    with self.lock:
+      self.blob_id = blob_id = (self.blob_id + 1) & 0xFFFF
+
+    fragments = [FRAGMENT_HEADER.pack(FRAGMENT_MAGIC, FRAGMENT_DATA, blob_id, i, count) + blob[i*size:(i+1)*size] for i in range(count)]
+
+    # No NACKs from broadcast receivers
+    if self.espnow.is_broadcast(mac):
+      return self.espnow.send(mac, fragments, block=False)
+
+    state = {"event": scapy.threading.Event(), "missing": None, "done": False}
+    self.sending[(mac, blob_id)] = state
+
+    try:
+      resend   = fragments
+      unacked  = set(range(count)) # Fragments the receiver may not have
+      failures = 0
+
+      while failures <= self.retries:
+        state["event"].clear()
+        self.espnow.send(mac, resend, block=False)
+
+        # No answer, ask again with the last fragment
+        if not state["event"].wait(self.timeout):
+          failures += 1
+          resend    = [fragments[-1]]
+          continue
+
+        if state["done"]:
+          return True
+
+        # Fragments the NACK doesn't list were received, up to its last index if the list was cut short to fit one message
+        listed  = set(state["missing"])
+        known   = state["missing"][-1] if len(listed) >= (self.fragment_size - FRAGMENT_HEADER.size) // 2 else count - 1
+        before  = len(unacked)
+        unacked = {i for i in unacked if i > known or i in listed}
+        if len(unacked) >= before:
+          failures += 1
+
+        # Resend what is missing, last fragment last so the receiver answers again
+        resend = [fragments[i] for i in state["missing"] if i < count - 1] + [fragments[-1]]
+
+      return False
+
+    finally:
+      del self.sending[(mac, blob_id)]
+
+
+
+  # Decoder callback for fragment messages
+  def on_message(self, from_mac, to_mac, msg):
+    if len(msg) < FRAGMENT_HEADER.size:
+      return
+
+    magic, kind, blob_id, index, count = FRAGMENT_HEADER.unpack_from(msg)
+
+    if kind == FRAGMENT_DATA:
+      self.on_fragment(from_mac, to_mac, blob_id, index, count, msg[FRAGMENT_HEADER.size:])
+
+    # Answer to one of our sends
+    elif kind in (FRAGMENT_NACK, FRAGMENT_DONE):
+      state = self.sending.get((from_mac, blob_id))
+      if state:
+        state["done"]    = kind == FRAGMENT_DONE
+        state["missing"] = struct.unpack_from("<%dH" % ((len(msg) - FRAGMENT_HEADER.size) // 2), msg, FRAGMENT_HEADER.size)
+        state["event"].set()
+
+
+
+  # Store a received fragment, deliver the blob once complete. Unicast senders get a NACK on the last fragment if any are missing
+  def on_fragment(self, from_mac, to_mac, blob_id, index, count, payload):
+    key     = (from_mac, blob_id)
+    unicast = to_mac == self.espnow.local_mac
+    reply   = None
+    blob    = None
+
+    with self.lock:
+      now = time.time()
+
+      # Sender didn't get our DONE
+      if key in self.completed:
+        if unicast and index == count - 1:
+          reply = (FRAGMENT_DONE, [])
+
+      else:
+        # Drop stale reassemblies
+        for stale in [k for k, v in self.blobs.items() if now - v["time"] > self.timeout * (self.retries + 1)]:
+          del self.blobs[stale]
+
+        entry = self.blobs.get(key)
+        if entry is None:
+          if len(self.blobs) >= self.max_blobs:
+            del self.blobs[min(self.blobs, key=lambda k: self.blobs[k]["time"])]
+          entry = self.blobs[key] = {"fragments": [None] * count, "received": 0, "size": 0, "time": now}
+
+        fragments = entry["fragments"]
+        if index < count == len(fragments):
+          entry["time"] = now
+
+          if fragments[index] is None:
+            fragments[index]  = payload
+            entry["received"] += 1
+            entry["size"]     += len(payload)
+
+          if entry["size"] > self.max_blob_size:
+            del self.blobs[key]
+
+          elif entry["received"] == count:
+            del self.blobs[key]
+            self.completed.append(key)
+            blob  = b"".join(fragments)
+            reply = (FRAGMENT_DONE, []) if unicast else None
+
+          elif unicast and index == count - 1:
+            reply = (FRAGMENT_NACK, [i for i, fragment in enumerate(fragments) if fragment is None][:(self.fragment_size - FRAGMENT_HEADER.size) // 2])
+
+    if reply:
+      kind, missing = reply
+      self.espnow.send_queued(from_mac, FRAGMENT_HEADER.pack(FRAGMENT_MAGIC, kind, blob_id, 0, count) + struct.pack("<%dH" % len(missing), *missing), priority=PRIORITY_CONTROL)
+
+    if blob is not None and callable(self.callback):
+      self.callback(from_mac, to_mac, blob)
+
+
+
+
+
+# ESP-NOW message from an action frame body: category, OUI and random value, then vendor elements. v1.0 has one element,
+# v2.0 one per 250 bytes, all but the last flagged as more to follow. None if an element is cut short or not ESP-NOW
+def espnow_message(data):
+  pos = ESPNOW_HEADER.size
+  msg = None
+  while True:
+    if len(data) < pos + 7 or data[pos] != 0xDD or data[pos+2:pos+6] != b"\x18\xfe\x34\x04":
+      return None
+
+    size = data[pos+1]
+    end  = pos + 2 + size
+    if size < 5 or end > len(data):
+      return None
+
+    msg = data[pos+7:end] if msg is None else msg + data[pos+7:end]
+    if not data[pos+6] & 0x10: # Last element
+      return msg
+    pos = end
+
+
+
+
+
+# RadioTap frames from a pcap/pcapng file, as (timestamp, frame). Frames with other link types are skipped
+# gzip, bz2 and lzma (xz) compressed files, as CaptureWriter writes them, are recognized by their magic bytes
+def pcap_frames(pcap_file):
+  with open(pcap_file, "rb") as f:
+    magic = f.read(6)
+
+  if   magic.startswith(b"\x1f\x8b"):        capture = gzip.open(pcap_file, "rb")
+  elif magic.startswith(b"BZh"):             capture = bz2.open(pcap_file, "rb")
+  elif magic.startswith(b"\xfd7zXZ\x00"):    capture = lzma.open(pcap_file, "rb")
+  else:                                      capture = open(pcap_file, "rb")
+
+  reader = scapy.RawPcapReader(capture)
+  try:
+    for frame, meta in reader:
+      # pcapng carries linktype and timestamp resolution per interface, pcap per file
+      if hasattr(meta, "linktype"):
+        if meta.linktype != scapy.DLT_IEEE802_11_RADIO:
+          continue
+        timestamp = ((meta.tshigh << 32) | meta.tslow) / meta.tsresol
+      else:
+        if reader.linktype != scapy.DLT_IEEE802_11_RADIO:
+          continue
+        timestamp = meta.sec + meta.usec / 1000000
+      yield timestamp, frame
+  finally:
+    reader.close()
+
+
+
+
+
+# Write received frames to pcapng from a background thread. The receive loop only queues (timestamp, frame), the writer thread
+# encodes and writes them in batches. mode picks "accepted", "rejected" or "all" frames. Files rotate after rotate_size bytes
+# or rotate_time seconds, rotated files are named path-<time>-<n>. compress is "", "gzip", "bz2" or "lzma", written as a stream
+class CaptureWriter:
+
+  def __init__(self, path, mode="all", rotate_size=0, rotate_time=0, compress="", queue_size=65536, batch_size=1024):
+    self.path        = path                         # Capture file path, extension kept after the rotation suffix
+    self.mode        = mode                         # Frames to write: "accepted", "rejected" or "all"
+    self.rotate_size = rotate_size                  # Start a new file after this many bytes (uncompressed), 0 never
+    self.rotate_time = rotate_time                  # Start a new file after this many seconds, 0 never
+    self.compress    = compress                     # Compression for capture files, "" for none
+    self.batch_size  = batch_size                   # Most frames written with one file write
+    self.queue       = queue.Queue(queue_size)      # Frames waiting for the writer thread, new frames are dropped when full
+    self.file        = None                         # Current capture file
+    self.file_name   = None                         # Name of the current capture file
+    self.file_bytes  = 0                            # Bytes written to the current capture file
+    self.file_opened = 0                            # When the current capture file was opened
+    self.files       = 0                            # Capture files opened
+    self.frames      = 0                            # Frames written
+    self.drops       = 0                            # Frames dropped with the queue full
+    self.writer      = scapy.threading.Thread(target=self.write_loop, daemon=True)
+
+    if mode not in ("accepted", "rejected", "all"):
+      print(f"Invalid capture mode {mode}, capturing all frames")
+      self.mode = "all"
+
+    if compress not in ("", "gzip", "bz2", "lzma"):
+      print(f"Invalid capture compression {compress}, not compressing")
+      self.compress = ""
+
+    self.writer.start()
+
+
+
+  # Queue a received frame, frame may be a memoryview into a receive ring. Called on the receive thread, never blocks
+  def write(self, frame, accepted, timestamp=None):
+    if self.mode != "all" and bool(accepted) != (self.mode == "accepted"):
+      return
+
+    try:
+      self.queue.put_nowait((timestamp or time.time(), bytes(frame)))
+    except queue.Full:
+      self.drops += 1
+
+
+
+  # Writer thread, drains the queue in batches
+  def write_loop(self):
+    while True:
+      batch = [self.queue.get()]
+      try:
+        while len(batch) < self.batch_size:
+          batch.append(self.queue.get_nowait())
+      except queue.Empty:
+        pass
+
+      # Stop marker from close(), write what came before it
+      stop = None in batch
+      if stop:
+        batch = batch[:batch.index(None)]
+
+      if batch:
+        if not self.file or (self.rotate_size and self.file_bytes >= self.rotate_size) or (self.rotate_time and time.time() - self.file_opened >= self.rotate_time):
+          self.rotate()
+
+        data = b"".join([self.epb(timestamp, frame) for timestamp, frame in batch])
+        self.file.write(data)
+        self.file_bytes += len(data)
+        self.frames     += len(batch)
+
+        # Flush when caught up, so the file can be followed while capturing
+        if self.queue.empty():
+          self.file.flush()
+
+      if stop:
+        if self.file:
+          self.file.close()
+          self.file = None
+        return
+
+
+
+  # Close the current capture file, if any, and open the next one with the pcapng section and interface headers
+  def rotate(self):
+    if self.file:
+      self.file.close()
+
+    name = self.path
+    if self.rotate_size or self.rotate_time:
+      base, ext = os.path.splitext(self.path)
+      name      = f"{base}-{time.strftime('%Y%m%d-%H%M%S')}-{self.files}{ext}"
+
+    if self.compress == "gzip":
+      self.file_name = name + ".gz"
+      self.file      = gzip.open(self.file_name, "wb", compresslevel=1) # Fastest level, keeps up with bursts
+    elif self.compress == "bz2":
+      self.file_name = name + ".bz2"
+      self.file      = bz2.open(self.file_name, "wb")
+    elif self.compress == "lzma":
+      self.file_name = name + ".xz"
+      self.file      = lzma.open(self.file_name, "wb")
+    else:
+      self.file_name = name
+      self.file      = open(self.file_name, "wb")
+
+    header = PCAPNG_SHB.pack(0x0A0D0D0A, 28, 0x1A2B3C4D, 1, 0, -1, 28) + PCAPNG_IDB.pack(1, 20, scapy.DLT_IEEE802_11_RADIO, 0, 0, 20)
+    self.file.write(header)
+    self.file_bytes   = len(header)
+    self.file_opened  = time.time()
+    self.files       += 1
+
+
+
+  # pcapng enhanced packet block for a frame, microsecond timestamp
+  def epb(self, timestamp, frame):
+    ts     = int(timestamp * 1000000)
+    pad    = -len(frame) % 4
+    length = 32 + len(frame) + pad
+    return PCAPNG_EPB.pack(6, length, 0, ts >> 32, ts & 0xFFFFFFFF, len(frame), len(frame)) + frame + bytes(pad) + PCAPNG_LEN.pack(length)
+
+
+
+  # Write queued frames, close the file and stop the writer thread
+  def close(self):
+    self.queue.put(None)
+    self.writer.join()
+
+
+
+  # Capture statistics
+  def stats(self):
+    return {"frames": self.frames, "drops": self.drops, "depth": self.queue.qsize(), "files": self.files, "file": self.file_name}
+
+
+
+
+
+# NumPy structured dtype matching a struct format, one field per unpacked value, named by position ("f0", "f1", ..). Requires NumPy
+# Byte fields (c, s, p) are raw void, NumPy's S would drop trailing NULs
+def struct_dtype(fmt):
+  order   = {"<": "<", ">": ">", "!": ">"}.get(fmt[:1], "=")
+  prefix  = fmt[0] if fmt[:1] in "@=<>!" else "@"
+  formats = []
+  offsets = []
+  done    = ""
+
+  for count, code in re.findall(r"(\d*)([xcbB?hHiIlLqQnNefdsp])", fmt):
+    count = int(count) if count else 1
+
+    if code == "x":
+      done += f"{count}x"
+      continue
+
+    # One value for strings, count values for the rest
+    item = f"{count}{code}" if code in "sp" else code
+    for i in range(1 if code in "sp" else count):
+      size = struct.calcsize(prefix + item)
+      offsets.append(struct.calcsize(prefix + done + item) - size)
+      done += item
+
+      if   code in "sp":       formats.append(f"V{size}")
+      elif code == "c":        formats.append("V1")
+      elif code == "?":        formats.append("?")
+      elif code in "efd":      formats.append(f"{order}f{size}")
+      elif code in "bhilqn":   formats.append(f"{order}i{size}")
+      else:                    formats.append(f"{order}u{size}")
+
+  return np.dtype({"names": [f"f{i}" for i in range(len(formats))], "formats": formats, "offsets": offsets, "itemsize": struct.calcsize(fmt)})
+
+
+
+
+
+# Decoders by name, counting changes so compiled decoder signatures are rebuilt when a decoder is added, replaced or removed
+class DecoderTable(dict):
+
+  def __init__(self, *args, **kwargs):
+    super().__init__(*args, **kwargs)
+    self.version = 0                                             # Changes since created
+
+
+
+  def __setitem__(self, name, dec):
+    super().__setitem__(name, dec)
+    self.version += 1
+
+
+
+  def __delitem__(self, name):
+    super().__delitem__(name)
+    self.version += 1
+
+
+
+  def __ior__(self, other):
+    self.update(other)
+    return self
+
+
+
+  def update(self, *args, **kwargs):
+    super().update(*args, **kwargs)
+    self.version += 1
+
+
+
+  def setdefault(self, name, dec=None):
+    self.version += name not in self
+    return super().setdefault(name, dec)
+
+
+
+  def pop(self, *args):
+    self.version += 1
+    return super().pop(*args)
+
+
+
+  def popitem(self):
+    self.version += 1
+    return super().popitem()
+
+
+
+  def clear(self):
+    super().clear()
+    self.version += 1
+
+
+
+
+
+# Decoder signatures compiled for matching. Signatures are bucketed by length, then by the value of the byte that best tells them apart
+# A message is only checked against signatures that fit its length and that byte value, in the order the decoders were declared
+class DecoderIndex:
+
+  def __init__(self, decoders):
+    self.decoders = decoders                                     # Decoders compiled, to detect replacement
+    self.version  = getattr(decoders, "version", 0)              # Changes to the DecoderTable when compiled, to detect additions and replacements
+    self.names    = {id(dec): name for name, dec in decoders.items()} # Decoder names, by id of the decoder
+    self.buckets  = {}                                           # By length, None for any length: (byte position or None, {byte value: [entries]}, [entries without that byte])
+
+    # Entries are (declaration order, ((position, value), ..), decoder)
+    grouped = {}
+    for order, dec in enumerate(decoders.values()):
+      sig = dec["signature"]
+      grouped.setdefault(sig.get("length"), []).append((order, tuple(sig.get("bytes", {}).items()), dec))
+
+    for length, entries in grouped.items():
+      self.buckets[length] = self.compile(entries)
+
+
+
+  # Pick the byte position with the most distinct values among the entries, and split the entries by its value
+  def compile(self, entries):
+    values = {}
+    for order, checks, dec in entries:
+      for position, value in checks:
+        values.setdefault(position, set()).add(value)
+
+    if not values:
+      return None, {}, entries
+
+    position = max(values, key=lambda p: (len(values[p]), sum(1 for e in entries if p in dict(e[1]))))
+    table    = {}
+    rest     = []
+    for entry in entries:
+      value = dict(entry[1]).get(position)
+      if value is None:
+        rest.append(entry)
+      else:
+        table.setdefault(value, []).append(entry)
+
+    return position, table, rest
+
+
+
+  # First declared decoder whose signature matches data, or None
+  def match(self, data):
+    size       = len(data)
+    candidates = []
+
+    for length in (size, None):
+      bucket = self.buckets.get(length)
+      if bucket:
+        position, table, rest = bucket
+        if position is not None and position < size:
+          candidates += table.get(data[position], ())
+        candidates += rest
+
+    if len(candidates) > 1:
+      candidates.sort(key=lambda entry: entry[0])
+
+    for order, checks, dec in candidates:
+      for position, value in checks:
+        if position >= size or data[position] != value:
+          break
+      else:
+        return dec
+
+
+
+
+
+# Forward error correction for broadcast streams, where there are no ACKs to resend on
+# After every group data messages one XOR parity message is sent, receivers rebuild any one lost message of a group from the rest and the parity
+# Costs 1/group more airtime, where repeat costs 100% per repeat. Data messages are delivered as they arrive, rebuilt ones once the parity arrives
+class FecStream:
+
+  def __init__(self, espnow, callback=None, group=4, history=8, message_size=250):
+    self.espnow   = espnow                                       # ESPythoNow instance, None for encoding/decoding only
+    self.callback = callback                                     # Function called with (from_mac, to_mac, msg) for each received message
+    self.group    = min(max(group, 1), 255)                      # Data messages per parity message
+    self.max_size = message_size - FEC_HEADER.size - 2           # Largest msg, the parity message adds a length prefix. message_size is 250 for ESP-NOW v1.0 receivers, up to 1470 for v2.0
+    self.history  = history                                      # Groups per sender kept for rebuilding
+    self.sending  = {}                                           # Group being sent by destination MAC: [group id, data count, parity]
+    self.groups   = {}                                           # Groups being received by sender MAC: {group id: [data by index, data count from parity, parity, delivered]}
+    self.rebuilt  = 0                                            # Messages rebuilt from parity
+    self.lock     = scapy.threading.Lock()                       # Receive workers may handle different senders at once
+
+    # FEC messages are recognized by their magic bytes and handed to this stream
+    if espnow:
+      espnow.decoders = {**espnow.decoders, "fec": {"name": "FecStream", "signature": {"bytes": {0: FEC_MAGIC[0], 1: FEC_MAGIC[1]}}, "callback": self.on_message, "data": "raw"}}
+
+
+
+  # Send msg to mac, followed by the group's parity message once the group is full. False if msg is too large
+  def send(self, mac, msg):
+    messages = self.encode(self.espnow.format_mac(mac), msg)
+    return self.espnow.send(mac, messages, block=False) if messages is not None else False
+
+
+
+  # Send the parity for a partly filled group, so its messages can be rebuilt without waiting for more. Use at the end of a stream
+  def flush(self, mac):
+    messages = self.encode(self.espnow.format_mac(mac), None)
+    return self.espnow.send(mac, messages, block=False) if messages else True
+
+
+
+  # ESP-NOW messages to send for msg, the data message and the parity message if the group is now full. msg None closes the group
+  # None if msg is larger than max_size, its parity message would not fit
+  def encode(self, mac, msg):
+    if msg is not None and len(msg) > self.max_size:
+      print(f"Message too large ({len(msg)} bytes) for FEC, at most {self.max_size}")
+      return None
+
+    with self.lock:
+      state = self.sending.setdefault(mac, [random.randrange(0x10000), 0, bytearray()])
+      group_id, count, parity = state
+      messages = []
+
+      if msg is not None:
+        messages.append(FEC_HEADER.pack(FEC_MAGIC, FEC_DATA, group_id, count) + msg)
+        fec_xor(parity, len(msg).to_bytes(2, 'little') + msg)
+        count += 1
+
+      if count and (count >= self.group or msg is None):
+        messages.append(FEC_HEADER.pack(FEC_MAGIC, FEC_PARITY, group_id, count) + parity)
+        group_id, count, parity = (group_id + 1) & 0xFFFF, 0, bytearray()
+
+      self.sending[mac] = [group_id, count, parity]
+      return messages
+
+
+
+  # Messages delivered by a received FEC message, the data itself and any message rebuilt with it
+  def decode(self, from_mac, msg):
+    if len(msg) < FEC_HEADER.size:
+      return []
+
+    magic, kind, group_id, index = FEC_HEADER.unpack_from(msg)
+    payload = msg[FEC_HEADER.size:]
+    out     = []
+
+    with self.lock:
+      groups = self.groups.setdefault(from_mac, {})
+      group  = groups.get(group_id)
+
+      if group is None:
+        if len(groups) >= self.history: # Oldest group is past rebuilding
+          del groups[next(iter(groups))]
+        group = groups[group_id] = [{}, None, None, set()]
+
+      data, count, parity, delivered = group
+
+      if kind == FEC_DATA and index not in data:
+        data[index] = payload
+      elif kind == FEC_PARITY:
+        group[1], group[2] = count, parity = index, payload
+
+      # Deliver data not delivered yet
+      for i, message in data.items():
+        if i not in delivered:
+          delivered.add(i)
+          out.append(message)
+
+      # One data message missing and parity here, rebuild it
+      if parity is not None and len(data) == count - 1:
+        missing = next(i for i in range(count) if i not in data)
+        rebuilt = bytearray(parity)
+        for message in data.values():
+          fec_xor(rebuilt, len(message).to_bytes(2, 'little') + message)
+        size = int.from_bytes(rebuilt[:2], 'little')
+        if size <= len(rebuilt) - 2:
+          data[missing] = bytes(rebuilt[2:2+size])
+          delivered.add(missing)
+          out.append(data[missing])
+          self.rebuilt += 1
+
+    return out
+
+
+
+  # Decoder callback for FEC messages
+  def on_message(self, from_mac, to_mac, msg):
+    for message in self.decode(from_mac, msg):
+      if callable(self.callback):
+        self.callback(from_mac, to_mac, message)
+
+
+
+
+
+# XOR data into parity in place, extending parity with zeros as needed
+def fec_xor(parity, data):
+  if len(parity) < len(data):
+    parity.extend(bytes(len(data) - len(parity)))
+  parity[:len(data)] = (int.from_bytes(parity[:len(data)], 'little') ^ int.from_bytes(data, 'little')).to_bytes(len(data), 'little')
+
+
+
+
+
+# Coordinator address to (socket family, address). "host:port" is TCP, for radio workers on other hosts, anything else a Unix socket path
+def coordinator_address(address):
+  host, sep, port = address.rpartition(":")
+  if sep and port.isdigit() and "/" not in address:
+    return socket.AF_INET, (host or "127.0.0.1", int(port))
+  return socket.AF_UNIX, address
+
+
+
+
+
+# Read one coordinator record from a stream socket, (kind, body). None once the connection is closed, ValueError if too long
+def coordinator_record(sock):
+  header = bytearray(COORDINATOR_HEADER.size)
+  view   = memoryview(header)
+  while view:
+    read = sock.recv_into(view)
+    if not read:
+      return None
+    view = view[read:]
+
+  length, kind = COORDINATOR_HEADER.unpack(header)
+  if length > COORDINATOR_MAX: # The peer is not trusted with the allocation size
+    raise ValueError(f"Coordinator record of {length} bytes")
+
+  body = bytearray(length)
+  view = memoryview(body)
+  while view:
+    read = sock.recv_into(view)
+    if not read:
+      return None
+    view = view[read:]
+
+  return kind, bytes(body)
+
+
+
+
+
+# Radio worker side of the coordinator transport. Received messages are forwarded once decrypted, sends routed here go to send_background(),
+# tracked sends to send_async(), with the delivery result sent back. Messages too large to send fail, tracked ones report it
+# The reader thread reconnects when the coordinator goes away, messages received meanwhile are dropped
+class CoordinatorLink:
+
+  def __init__(self, espnow, address):
+    self.espnow    = espnow                                      # Radio worker, sends routed here
+    self.address   = address                                     # Coordinator Unix socket path or host:port
+    self.lock      = scapy.threading.Lock()                      # Serialize forwarding between receive worker threads
+    self.sock      = None                                        # Connection to the coordinator, None while disconnected
+    self.forwarded = 0                                           # Messages forwarded to the coordinator
+    self.dropped   = 0                                           # Messages dropped while disconnected
+    self.sends     = 0                                           # Messages the coordinator routed to this radio
+    self.thread    = scapy.threading.Thread(target=self.run, daemon=True)
+
+    self.connect()
+    self.thread.start()
+
+
+
+  # Connect to the coordinator, True on success
+  def connect(self):
+    family, address = coordinator_address(self.address)
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    try:
+      sock.connect(address)
+    except OSError as e:
+      print(f"Unable to connect to coordinator {self.address}: {e}")
+      sock.close()
+      return False
+
+    if family == socket.AF_INET:
+      sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    self.sock = sock
+    return True
+
+
+
+  # Forward a received message, data is the decrypted ESP-NOW data
+  def forward(self, from_mac, to_mac, rssi, data):
+    record = COORDINATOR_MESSAGE.pack(bytes.fromhex(from_mac.replace(":", "")), bytes.fromhex(to_mac.replace(":", "")), -128 if rssi is None else max(-128, min(127, rssi))) + data
+
+    with self.lock:
+      if not self.sock:
+        self.dropped += 1
+        return
+      try:
+        self.sock.sendall(COORDINATOR_HEADER.pack(len(record), COORDINATOR_FRAME) + record)
+        self.forwarded += 1
+      except OSError as e:
+        print("Coordinator connection lost:", e)
+        self.dropped += 1
+        self.sock.close()
+        self.sock = None
+
+
+
+  # Reader thread, sends what the coordinator routes to this radio and reconnects when disconnected
+  def run(self):
+    while True:
+      sock = self.sock
+      if not sock:
+        time.sleep(1)
+        with self.lock:
+          if not self.sock:
+            self.connect()
+        continue
+
+      try:
+        record = coordinator_record(sock)
+      except (OSError, ValueError) as e:
+        print("Coordinator connection error:", e)
+        record = None
+
+      if record is None:
+        with self.lock:
+          if self.sock is sock:
+            sock.close()
+            self.sock = None
+        continue
+
+      kind, body = record
+      if kind == COORDINATOR_SEND:
+        self.sends += 1
+        try:
+          self.espnow.send_background(body[:6].hex(":").upper(), body[6:])
+        except ValueError as e:
+          print("Invalid coordinator send:", e)
+
+      elif kind == COORDINATOR_TRACKED:
+        self.sends   += 1
+        request, mac  = COORDINATOR_REQUEST.unpack_from(body)
+        try:
+          future = self.espnow.send_async(mac.hex(":").upper(), body[COORDINATOR_REQUEST.size:])[0]
+        except ValueError as e:
+          print("Invalid coordinator send:", e)
+          self.result(sock, request, False)
+          continue
+        future.add_done_callback(lambda future, sock=sock, request=request: self.result(sock, request, future.result()))
+
+
+
+  # Send a tracked message's delivery result back on the connection it came from
+  def result(self, sock, request, delivered):
+    with self.lock:
+      if self.sock is not sock:
+        return
+      try:
+        sock.sendall(COORDINATOR_HEADER.pack(COORDINATOR_OUTCOME.size, COORDINATOR_RESULT) + COORDINATOR_OUTCOME.pack(request, bool(delivered)))
+      except OSError as e:
+        print("Coordinator connection lost:", e)
+
+
+
+  # Link statistics, totals since start
+  def stats(self):
+    return {"connected": self.sock is not None, "forwarded": self.forwarded, "dropped": self.dropped, "sends": self.sends}
+
+
+
+
+
+# Radio inside the coordinator's process, one per interface when ESPythoNow is given a list. In-process counterpart of CoordinatorLink
+class RadioLink:
+
+  def __init__(self, coordinator, radio):
+    self.coordinator = coordinator                               # RadioCoordinator of the ESPythoNow that created the radio
+    self.radio       = radio                                     # ESPythoNow on one interface
+    self.forwarded   = 0                                         # Messages passed to the coordinator
+    self.sends       = 0                                         # Messages the coordinator routed to this radio
+
+
+
+  # Pass a received message to the coordinator, data is the decrypted ESP-NOW data
+  def forward(self, from_mac, to_mac, rssi, data):
+    self.forwarded += 1
+    self.coordinator.receive(self.radio, bytes.fromhex(from_mac.replace(":", "")), bytes.fromhex(to_mac.replace(":", "")), rssi, data)
+
+
+
+  # Send routed message(s) without waiting, see send_background. True per message accepted, not delivered
+  def send(self, mac, msg):
+    self.sends += len(msg)
+    return [not future.done() or future.result() for future in self.radio.send_background(mac, msg)]
+
+
+
+  # Send routed message(s) tracked by the radio. A Future per message resolving True on delivery confirmation
+  def send_async(self, mac, msg):
+    self.sends += len(msg)
+    return self.radio.send_async(mac, msg)
+
+
+
+  # Link statistics, totals since start
+  def stats(self):
+    return {"connected": True, "forwarded": self.forwarded, "dropped": 0, "sends": self.sends}
+
+
+
+
+
+# Aggregation side of the coordinator transport, several radio workers on one host or several, and/or this process's own radios, feed one ESPythoNow
+# Copies of a message heard by more than one radio share source MAC and random value (data[4:8]). The first copy waits window seconds
+# for the others, then the best RSSI copy goes through dispatch_rx, so decoders, callback and MQTT see each message once. Later copies are dropped
+# Sends go to the radio that delivered the last message from the destination, broadcasts and unknown destinations to every radio
+class RadioCoordinator:
+
+  def __init__(self, espnow, address, window=.02, recent_size=4096):
+    self.espnow      = espnow                                    # Handles the deduplicated messages
+    self.address     = address                                   # Unix socket path or host:port to listen on, "" for in-process radios only
+    self.window      = window                                    # Seconds the first copy waits for copies from other radios, 0 passes it on at once
+    self.lock        = scapy.threading.Condition()               # Guards the state below, wakes the flush thread
+    self.workers     = {}                                        # (name, send, send_async functions) by radio worker connection, or by in-process radio
+    self.pending     = {}                                        # [deadline, rssi, connection, to_mac, data] waiting for copies, by (source MAC, random value)
+    self.order       = collections.deque()                       # Pending keys, oldest first
+    self.recent      = set()                                     # Keys of messages passed on, later copies are dropped
+    self.recent_keys = collections.deque(maxlen=recent_size)     # The same keys in order, the oldest are forgotten
+    self.last_heard  = {}                                        # Radio worker connection or radio by source MAC, of the best copy of its last message. The routing table
+    self.requests    = {}                                        # (future, connection) of tracked sends waiting for their result, by request id
+    self.request_id  = 0                                         # Last tracked send request id
+    self.server      = None                                      # Listening socket
+    self.received    = 0                                         # Copies received from radio workers
+    self.duplicates  = 0                                         # Copies dropped, heard by more than one radio
+    self.replaced    = 0                                         # Pending copies replaced by one with better RSSI
+    self.routed      = 0                                         # Messages sent to the radio that last heard the destination
+    self.flooded     = 0                                         # Messages sent to every radio, broadcast or destination not heard yet
+
+
+
+  # Receive from a radio in this process, see RadioLink
+  def attach(self, radio):
+    radio.coordinator_link = link = RadioLink(self, radio)
+    radio.ack_forward      = self.espnow.ack_received
+    with self.lock:
+      self.workers[radio] = (f"{radio.interface} channel {radio.wifi_channel}" if radio.wifi_channel else radio.interface, link.send, link.send_async)
+
+
+
+  # Accept radio workers, each read by its own thread. started is set once listening, or at once without an address
+  def serve(self, started=None):
+    if self.window > 0:
+      scapy.threading.Thread(target=self.flush, daemon=True).start()
+
+    if not self.address:
+      if started:
+        started.set()
+      return
+
+    family, address = coordinator_address(self.address)
+    if family == socket.AF_UNIX and os.path.exists(address):
+      os.unlink(address)
+
+    self.server = socket.socket(family, socket.SOCK_STREAM)
+    if family == socket.AF_INET:
+      self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    self.server.bind(address)
+    self.server.listen(16)
+
+    if started:
+      started.set()
+
+    while True:
+      conn, peer = self.server.accept()
+      if family == socket.AF_INET:
+        conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+      with self.lock:
+        self.workers[conn] = ("%s:%s" % peer if family == socket.AF_INET else f"worker {conn.fileno()}", *self.sender(conn))
+      scapy.threading.Thread(target=self.reader, args=(conn,), daemon=True).start()
+
+
+
+  # Send functions for a radio worker connection, one record per message
+  # send returns True per message written, send_async a Future per message resolving with the worker's delivery result
+  def sender(self, conn):
+    lock = scapy.threading.Lock()
+
+    def send(mac, msg):
+      result = [False] * len(msg)
+      mac_   = bytes.fromhex(mac.replace(":", ""))
+      with lock:
+        for i, msg_ in enumerate(msg):
+          if 6 + len(msg_) > COORDINATOR_MAX: # The worker would drop the connection
+            print(f"Message too large ({len(msg_)} bytes)")
+            continue
+          try:
+            conn.sendall(COORDINATOR_HEADER.pack(6 + len(msg_), COORDINATOR_SEND) + mac_ + msg_)
+            result[i] = True
+          except OSError as e:
+            print("Coordinator send failed:", e)
+            break
+      return result
+
+    def send_async(mac, msg):
+      futures = []
+      mac_    = bytes.fromhex(mac.replace(":", ""))
+      for msg_ in msg:
+        future = concurrent.futures.Future()
+        future.set_running_or_notify_cancel()
+        futures.append(future)
+        if COORDINATOR_REQUEST.size + len(msg_) > COORDINATOR_MAX:
+          print(f"Message too large ({len(msg_)} bytes)")
+          future.set_result(False)
+          continue
+
+        with self.lock:
+          self.request_id = request = (self.request_id + 1) & 0xFFFFFFFF
+          self.requests[request] = (future, conn)
+
+        try:
+          with lock:
+            conn.sendall(COORDINATOR_HEADER.pack(COORDINATOR_REQUEST.size + len(msg_), COORDINATOR_TRACKED) + COORDINATOR_REQUEST.pack(request, mac_) + msg_)
+        except OSError as e:
+          print("Coordinator send failed:", e)
+          with self.lock:
+            self.requests.pop(request, None)
+          future.set_result(False)
+      return futures
+
+    return send, send_async
+
+
+
+  # Read forwarded messages from one radio worker until it disconnects, or sends a malformed record
+  def reader(self, conn):
+    try:
+      while record := coordinator_record(conn):
+        kind, body = record
+        if kind == COORDINATOR_FRAME:
+          if len(body) < COORDINATOR_MESSAGE.size + 15: # ESP-NOW header and element header
+            raise ValueError(f"Short coordinator record of {len(body)} bytes")
+          from_mac, to_mac, rssi = COORDINATOR_MESSAGE.unpack_from(body)
+          self.receive(conn, from_mac, to_mac, None if rssi == -128 else rssi, body[COORDINATOR_MESSAGE.size:])
+
+        elif kind == COORDINATOR_RESULT:
+          request, delivered = COORDINATOR_OUTCOME.unpack_from(body)
+          with self.lock:
+            entry = self.requests.pop(request, None)
+          if entry:
+            entry[0].set_result(bool(delivered))
+
+    except (OSError, struct.error, ValueError) as e:
+      print("Dropping radio worker:", e)
+
+    # Peers last heard by this radio are flooded until heard again, its tracked sends fail
+    finally:
+      with self.lock:
+        del self.workers[conn]
+        for mac in [mac for mac, worker in self.last_heard.items() if worker is conn]:
+          del self.last_heard[mac]
+        lost = [self.requests.pop(request)[0] for request, (future, worker) in list(self.requests.items()) if worker is conn]
+      conn.close()
+      for future in lost:
+        future.set_result(False)
+
+
+
+  # Take one copy of a message from a radio worker connection or radio, keeping the best RSSI while copies are pending. MACs as bytes
+  def receive(self, conn, from_mac, to_mac, rssi, data):
+    key = (from_mac, data[4:8])
+
+    with self.lock:
+      self.received += 1
+
+      if key in self.recent:
+        self.duplicates += 1
+        return
+
+      entry = self.pending.get(key)
+      if entry:
+        self.duplicates += 1
+        if rssi is not None and (entry[1] is None or rssi > entry[1]):
+          entry[1:] = [rssi, conn, to_mac, data]
+          self.replaced += 1
+        return
+
+      if self.window > 0:
+        self.pending[key] = [time.perf_counter() + self.window, rssi, conn, to_mac, data]
+        self.order.append(key)
+        if len(self.order) == 1:
+          self.lock.notify()
+        return
+
+      self.remember(key)
+
+    self.dispatch(key, [0, rssi, conn, to_mac, data])
+
+
+
+  # Mark a message as passed on, lock held
+  def remember(self, key):
+    if len(self.recent_keys) == self.recent_keys.maxlen:
+      self.recent.discard(self.recent_keys[0])
+    self.recent_keys.append(key)
+    self.recent.add(key)
+
+
+
+  # Flush thread, passes on each pending message once its window closes
+  def flush(self):
+    while True:
+      with self.lock:
+        while not self.order:
+          self.lock.wait()
+
+        remaining = self.pending[self.order[0]][0] - time.perf_counter()
+        if remaining > 0:
+          self.lock.wait(remaining)
+          continue
+
+        key   = self.order.popleft()
+        entry = self.pending.pop(key)
+        self.remember(key)
+
+      self.dispatch(key, entry)
+
+
+
+  # Pass the best copy on as if received here, and route replies to its radio
+  def dispatch(self, key, entry):
+    deadline, rssi, conn, to_mac, data = entry
+    from_mac = key[0].hex(":").upper()
+
+    with self.lock:
+      if conn in self.workers:
+        self.last_heard[from_mac] = conn
+
+    self.espnow.dispatch_rx(None, from_mac, to_mac.hex(":").upper(), data, None, rssi)
+
+
+
+  # (name, send, send_async) of the radio that last heard MAC, or of every radio
+  def targets(self, mac, count):
+    with self.lock:
+      conn = None if self.espnow.is_broadcast(mac) else self.last_heard.get(mac)
+      if conn:
+        self.routed += count
+        return [self.workers[conn]]
+      self.flooded += count
+      return list(self.workers.values())
+
+
+
+  # Send message(s) through the radio that last heard MAC, or every radio, without delivery confirmation
+  # Returns list of True/False per message, True if handed to a radio
+  def send(self, mac, msg):
+    mac    = self.espnow.format_mac(mac)
+    result = [False] * len(msg)
+
+    for name, send, send_async in self.targets(mac, len(msg)):
+      result = [ok or sent for ok, sent in zip(result, send(mac, msg))]
+
+    return result
+
+
+
+  # Send message(s) like send(), tracked by the radio for delivery confirmation
+  # Returns a Future per message resolving True once delivered by any radio it went to, False if by none
+  def send_async(self, mac, msg):
+    mac     = self.espnow.format_mac(mac)
+    targets = [send_async(mac, msg) for name, send, send_async in self.targets(mac, len(msg))]
+
+    if len(targets) == 1:
+      return targets[0]
+
+    futures = []
+    for copies in zip(*targets) if targets else [[] for msg_ in msg]:
+      future = concurrent.futures.Future()
+      future.set_running_or_notify_cancel()
+      if not copies:
+        future.set_result(False) # No radio to send with
+      else:
+        state = [len(copies), False] # Copies outstanding, resolved
+        def done(copy, future=future, state=state):
+          delivered = bool(copy.result())
+          with self.lock:
+            state[0] -= 1
+            if state[1] or not (delivered or not state[0]): # Resolve on the first delivery, or once the last copy failed
+              return
+            state[1] = True
+          future.set_result(delivered)
+        for copy in copies:
+          copy.add_done_callback(done)
+      futures.append(future)
+
+    return futures
+
+
+
+  # Routing table, name of the radio each destination is sent through by MAC
+  def routes(self):
+    with self.lock:
+      return {mac: self.workers[conn][0] for mac, conn in self.last_heard.items()}
+
+
+
+  # Coordinator statistics, totals since start
+  def stats(self):
+    with self.lock:
+      return {"workers": len(self.workers), "peers": len(self.last_heard), "pending": len(self.pending), "received": self.received, "duplicates": self.duplicates, "replaced": self.replaced, "routed": self.routed, "flooded": self.flooded}
+
+
+
+
+
+# MQTT egress stage, publishes from a dedicated thread so a slow or reconnecting broker never stalls receiving
+# submit() only appends to a bounded queue. The thread hands messages to paho in batches while connected, and paho's own queue is
+# bounded too, so broker pressure backs up into this queue. When it is full, overflow picks what gives: "drop_oldest", "drop_newest",
+# or "spill", appending to spill_file on disk until the thread catches up. Coalesced topics keep only their latest payload queued in memory
+class MqttPublisher:
+
+  def __init__(self, client, metrics, queue_size=10000, overflow="drop_oldest", spill_file="", batch_size=64):
+    self.client      = client                                    # paho client, with its network loop running
+    self.metrics     = metrics                                   # Queue wait and publish latency histograms
+    self.queue_size  = max(queue_size, 1)                        # Messages queued in memory before overflow
+    self.overflow    = overflow                                  # "drop_oldest", "drop_newest" or "spill"
+    self.spill_file  = spill_file                                # File for spilled messages, with overflow "spill"
+    self.batch_size  = batch_size                                # Most messages handed to paho per wake up
+    self.lock        = scapy.threading.Condition()               # Guards the queue and spill state, wakes the publish thread
+    self.queue       = collections.deque()                       # [topic, payload, qos, enqueue time, coalesce]
+    self.pending     = {}                                        # Queued coalesced messages by topic
+    self.spill       = None                                      # Open spill file
+    self.spill_read  = 0                                         # Offset of the next spilled message to publish
+    self.spilled     = 0                                         # Messages in the spill file not yet published
+    self.published   = 0                                         # Messages handed to paho
+    self.dropped     = 0                                         # Messages dropped by the overflow policy
+    self.coalesced   = 0                                         # Messages replaced by a newer payload for the same topic
+    self.thread      = scapy.threading.Thread(target=self.run, daemon=True)
+
+    if overflow not in ("drop_oldest", "drop_newest", "spill") or (overflow == "spill" and not spill_file):
+      print(f"Invalid MQTT overflow {overflow}, or no spill_file. Dropping oldest")
+      self.overflow = "drop_oldest"
+
+    self.client.max_queued_messages_set(batch_size * 4) # Keep paho's backlog small, the rest waits here where overflow applies
+    self.thread.start()
+
+
+
+  # Queue a message to publish, never blocks on the broker
+  def submit(self, topic, payload, qos=1, coalesce=False):
+    with self.lock:
+      if coalesce:
+        entry = self.pending.get(topic)
+        if entry:
+          entry[1]        = payload
+          self.coalesced += 1
+          return
+
+      entry = [topic, payload, qos, time.perf_counter(), coalesce]
+
+      # Once spilling, everything goes to disk until the spill is published, to keep the order
+      if self.spilled or len(self.queue) >= self.queue_size:
+        if self.overflow == "spill":
+          self.spill_write(entry)
+          self.lock.notify()
+          return
+
+        self.dropped += 1
+        if self.overflow == "drop_newest":
+          return
+
+        oldest = self.queue.popleft()
+        if oldest[4] and self.pending.get(oldest[0]) is oldest:
+          del self.pending[oldest[0]]
+
+      self.queue.append(entry)
+      if coalesce:
+        self.pending[topic] = entry
+      self.lock.notify()
+
+
+
+  # Append a message to the spill file, lock held. Topic length, payload length, QoS, topic, payload
+  def spill_write(self, entry):
+    if not self.spill:
+      self.spill = open(self.spill_file, "w+b")
+
+    topic   = entry[0].encode()
+    payload = entry[1].encode() if isinstance(entry[1], str) else bytes(entry[1])
+    self.spill.seek(0, os.SEEK_END)
+    self.spill.write(MQTT_SPILL_HEADER.pack(len(topic), len(payload), entry[2]) + topic + payload)
+    self.spilled += 1
+
+
+
+  # Read up to count spilled messages, lock held. The file is emptied once everything in it has been read
+  def spill_take(self, count):
+    self.spill.flush()
+    self.spill.seek(self.spill_read)
+    batch = []
+
+    while len(batch) < count and self.spilled:
+      topic_len, payload_len, qos = MQTT_SPILL_HEADER.unpack(self.spill.read(MQTT_SPILL_HEADER.size))
+      topic    = self.spill.read(topic_len).decode()
+      payload  = self.spill.read(payload_len)
+      batch.append([topic, payload, qos, None, False])
+      self.spilled -= 1
+
+    self.spill_read = self.spill.tell()
+    if not self.spilled:
+      self.spill.seek(0)
+      self.spill.truncate()
+      self.spill_read = 0
+
+    return batch
+
+
+
+  # Publish thread, memory queue first, then the spill file, which only holds newer messages
+  def run(self):
+    while True:
+      # Hold messages while disconnected, paho would only queue them without limit
+      if not self.client.is_connected():
+        time.sleep(.1)
+        continue
+
+      with self.lock:
+        while not self.queue and not self.spilled:
+          self.lock.wait()
+
+        if self.queue:
+          batch = [self.queue.popleft() for i in range(min(self.batch_size, len(self.queue)))]
+          for entry in batch:
+            if entry[4] and self.pending.get(entry[0]) is entry:
+              del self.pending[entry[0]]
+        else:
+          batch = self.spill_take(self.batch_size)
+
+      for topic, payload, qos, queued, coalesce in batch:
+        if queued is not None:
+          self.metrics.observe("mqtt_queue_seconds", time.perf_counter() - queued)
+
+        # paho's queue is full, or the connection dropped with QoS 0, wait and retry
+        # With QoS 1 and 2 paho keeps a message it reports NO_CONN for and sends it after reconnecting, retrying would duplicate it
+        started = time.perf_counter()
+        try:
+          while (rc := self.client.publish(topic, payload, qos=qos).rc) == mqtt.MQTT_ERR_QUEUE_SIZE or (rc == mqtt.MQTT_ERR_NO_CONN and not qos):
+            time.sleep(.01)
+          self.published += 1
+        except Exception as e:
+          print("MQTT publish error:", e)
+        self.metrics.observe("mqtt_publish_seconds", time.perf_counter() - started)
+
+
+
+  # Queue statistics, totals since start
+  def stats(self):
+    with self.lock:
+      return {"depth": len(self.queue), "spilled": self.spilled, "published": self.published, "dropped": self.dropped, "coalesced": self.coalesced}
+
+
+
+
+
+# Pack received messages as (timestamp, from_mac, to_mac, rssi, msg) into a compact MQTT envelope, see ENVELOPE_HEADER and ENVELOPE_FRAME
+def encode_envelope(frames):
+  base  = frames[0][0] if frames else 0
+  parts = [ENVELOPE_HEADER.pack(ENVELOPE_MAGIC, ENVELOPE_VERSION, base, len(frames))]
+
+  for timestamp, from_mac, to_mac, rssi, msg in frames:
+    parts.append(ENVELOPE_FRAME.pack(int((timestamp - base) * 1000000), bytes.fromhex(from_mac.replace(":", "")), bytes.fromhex(to_mac.replace(":", "")), -128 if rssi is None else max(-128, min(127, rssi)), len(msg)))
+    parts.append(msg)
+
+  return b"".join(parts)
+
+
+
+
+
+# Unpack a compact MQTT envelope for consumers, a list of {"timestamp", "from_mac", "to_mac", "rssi", "msg"}
+# Raises ValueError for anything else, including truncated envelopes or trailing bytes
+def decode_envelope(payload):
+  payload = bytes(payload)
+  if len(payload) < ENVELOPE_HEADER.size:
+    raise ValueError("Truncated envelope header")
+
+  magic, version, base, count = ENVELOPE_HEADER.unpack_from(payload)
+  if magic != ENVELOPE_MAGIC or version != ENVELOPE_VERSION:
+    raise ValueError(f"Not a version {ENVELOPE_VERSION} ESPythoNOW envelope")
+
+  frames = []
+  offset = ENVELOPE_HEADER.size
+  for i in range(count):
+    if offset + ENVELOPE_FRAME.size > len(payload):
+      raise ValueError(f"Truncated envelope, frame {i} of {count}")
+
+    delta, from_mac, to_mac, rssi, length = ENVELOPE_FRAME.unpack_from(payload, offset)
+    offset += ENVELOPE_FRAME.size
+    if offset + length > len(payload):
+      raise ValueError(f"Truncated envelope, message {i} of {count}")
+
+    frames.append({
+      "timestamp": base + delta / 1000000,
+      "from_mac":  from_mac.hex(":").upper(),
+      "to_mac":    to_mac.hex(":").upper(),
+      "rssi":      None if rssi == -128 else rssi,
+      "msg":       payload[offset:offset + length]})
+    offset += length
+
+  if offset != len(payload):
+    raise ValueError(f"{len(payload) - offset} bytes after the last envelope frame")
+
+  return frames
+
+
+
+
+
+# Batches received messages into compact envelopes, published once window seconds after the first message, or at max_frames
+class EnvelopeBatcher:
+
+  def __init__(self, publish, window=.05, max_frames=64):
+    self.publish    = publish                                    # Called with each encoded envelope
+    self.window     = window                                     # Seconds a message may wait for others
+    self.max_frames = max(max_frames, 1)                         # Messages per envelope
+    self.lock       = scapy.threading.Condition()                # Guards frames, wakes the flush thread
+    self.frames     = []                                         # (timestamp, from_mac, to_mac, rssi, msg) waiting
+    self.opened     = 0                                          # perf_counter() of the first waiting message
+    self.thread     = scapy.threading.Thread(target=self.run, daemon=True)
+    self.thread.start()
+
+
+
+  # Add a received message, publishes here when the envelope is full
+  def add(self, timestamp, from_mac, to_mac, rssi, msg):
+    with self.lock:
+      self.frames.append((timestamp, from_mac, to_mac, rssi, msg))
+      if len(self.frames) == 1:
+        self.opened = time.perf_counter()
+        self.lock.notify()
+      if len(self.frames) < self.max_frames:
+        return
+      frames, self.frames = self.frames, []
+
+    self.publish(encode_envelope(frames))
+
+
+
+  # Flush thread, publishes whatever is waiting once the window closes
+  def run(self):
+    while True:
+      with self.lock:
+        while not self.frames:
+          self.lock.wait()
+
+        remaining = self.opened + self.window - time.perf_counter()
+        if remaining > 0:
+          self.lock.wait(remaining)
+          continue
+
+        frames, self.frames = self.frames, []
+
+      self.publish(encode_envelope(frames))
+
+
+
+
+
+# Counters and latency histograms for the send and receive paths. Updates take no lock, they are single dict and list increments
+# under the GIL, so an update racing another thread's update of the same counter can rarely be lost. Snapshots copy under a lock
+# Counters may have a label as (label name, value), e.g. decoder hits by ("decoder", name). Histograms have fixed buckets in seconds, as Prometheus expects
+class Metrics:
+
+  BUCKETS = (.00005, .0001, .00025, .0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5) # Upper bounds in seconds, plus +Inf
+
+  def __init__(self):
+    self.lock       = scapy.threading.Lock()                     # Guards creating histograms and taking snapshots
+    self.counters   = collections.defaultdict(int)               # Totals by name, or by (name, label name, label value)
+    self.histograms = {}                                         # Bucket counts followed by the sum, by name
+
+
+
+  # Add n to a counter
+  def count(self, name, n=1, label=None):
+    self.counters[name if label is None else (name,) + label] += n
+
+
+
+  # Add several counters at once, {name: n}
+  def update(self, counts):
+    counters = self.counters
+    for name, n in counts.items():
+      counters[name] += n
+
+
+
+  # Record a duration in seconds
+  def observe(self, name, seconds):
+    histogram = self.histograms.get(name)
+    if histogram is None:
+      with self.lock:
+        histogram = self.histograms.setdefault(name, [0] * (len(self.BUCKETS) + 1) + [0.0])
+
+    histogram[bisect.bisect_left(self.BUCKETS, seconds)] += 1
+    histogram[-1]                                        += seconds
+
+
+
+  # Counters as {name: total} or {name: {label value: total}}, histograms with count, sum, average, p50/p99 as bucket bounds (None past the last bound) and cumulative buckets
+  def snapshot(self):
+    with self.lock:
+      counters   = dict(self.counters)
+      histograms = {name: list(histogram) for name, histogram in self.histograms.items()}
+
+    out = {"counters": {}, "histograms": {}}
+    for key, value in counters.items():
+      if isinstance(key, tuple):
+        out["counters"].setdefault(key[0], {})[key[2]] = value
+      else:
+        out["counters"][key] = value
+
+    for name, histogram in histograms.items():
+      buckets, total, count = histogram[:-1], histogram[-1], sum(histogram[:-1])
+      cumulative = [sum(buckets[:i + 1]) for i in range(len(buckets))]
+      quantile   = lambda q: next((bound for bound, seen in zip(self.BUCKETS + (None,), cumulative) if seen >= q * count), None)
+      out["histograms"][name] = {"count": count, "sum": total, "avg": total / count if count else 0, "p50": quantile(.5), "p99": quantile(.99),
+                                 "buckets": dict(zip([str(bound) for bound in self.BUCKETS] + ["+Inf"], cumulative))}
+
+    return out
+
+
+
+  # Prometheus text exposition of a snapshot. Numbers in extra (nested dicts, e.g. delivery stats) are added as gauges
+  def prometheus(self, prefix="espythonow", extra={}):
+    snapshot = self.snapshot()
+    labels   = {key[0]: key[1] for key in list(self.counters) if isinstance(key, tuple)}
+    lines    = []
+
+    for name, value in snapshot["counters"].items():
+      lines.append(f"# TYPE {prefix}_{name}_total counter")
+      if isinstance(value, dict):
+        lines += [f'{prefix}_{name}_total{{{labels[name]}="{label}"}} {total}' for label, total in value.items()]
+      else:
+        lines.append(f"{prefix}_{name}_total {value}")
+
+    for name, histogram in snapshot["histograms"].items():
+      lines.append(f"# TYPE {prefix}_{name} histogram")
+      lines += [f'{prefix}_{name}_bucket{{le="{bound}"}} {seen}' for bound, seen in histogram["buckets"].items()]
+      lines.append(f"{prefix}_{name}_sum {histogram['sum']}")
+      lines.append(f"{prefix}_{name}_count {histogram['count']}")
+
+    def gauges(name, value):
+      if isinstance(value, dict):
+        for key, item in value.items():
+          gauges(f"{name}_{key}", item)
+      elif isinstance(value, (int, float)) and not isinstance(value, bool):
+        lines.append(f"# TYPE {name} gauge")
+        lines.append(f"{name} {value}")
+
+    for name, value in extra.items():
+      gauges(f"{prefix}_{name}", value)
+
+    return "\n".join(lines) + "\n"
+
+
+
+
+
+# Global ACK clocked serializer for unicast messages waiting for delivery confirmation, one frame in flight across all peers
+# ACKs only carry our own MAC, not the frame or peer they confirm, so one frame waits for its ACK at a time and each ACK confirms the most
+# recently transmitted frame. The next frame goes out as soon as the ACK comes in, or once the wait times out. Throughput is one frame per round trip
+# An unreachable peer holds up every other peer for timeout per attempt, and an ACK arriving after its frame timed out confirms the next frame
+# quota messages per peer share the transmit order at a time, the rest wait in a per peer backlog, so one busy peer can't push the others back
+# Frames not confirmed within timeout are resent on their own with the retry flag set, up to retries times, then resolve False
+class DeliveryTracker:
+
+  def __init__(self, send_frame, quota=8, timeout=.025, retries=0):
+    self.send_frame = send_frame                                 # Function writing one frame to the socket, called with (frame, raw)
+    self.quota      = max(quota, 1)                              # Messages per peer in the transmit order before the backlog
+    self.timeout    = timeout                                    # How long to wait for each ACK
+    self.retries    = retries                                    # Resends before giving up
+    self.lock       = scapy.threading.Condition()                # Guards all state, wakes the timeout thread
+    self.ready      = collections.deque()                        # [future, mac, frame, fc_index, deadline, attempts, raw] waiting their turn to transmit, in order accepted
+    self.awaiting   = None                                       # Entry of the frame last transmitted, waiting for its ACK
+    self.peer_count = {}                                         # Messages accepted, ready or awaiting, by peer MAC
+    self.backlog    = {}                                         # Messages waiting for room in the peer's quota, by peer MAC
+    self.thread     = None                                       # Timeout and resend thread, started on first message
+    self.confirmed  = 0                                          # Messages confirmed
+    self.resent     = 0                                          # Frames resent after a timeout
+    self.failed     = 0                                          # Messages never confirmed
+
+
+
+  # Track a frame to mac, sent in turn once the peer's quota has room. raw writes it to the socket directly, else through scapy. Returns a Future resolving True/False
+  def submit(self, mac, frame, fc_index, raw=True):
+    future = concurrent.futures.Future()
+    future.set_running_or_notify_cancel() # Not cancellable, so it can always be resolved
+    entry  = [future, mac, frame, fc_index, 0, 0, raw]
+
+    with self.lock:
+      if not self.thread:
+        self.thread = scapy.threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+      if self.peer_count.get(mac, 0) < self.quota:
+        self.peer_count[mac] = self.peer_count.get(mac, 0) + 1
+        self.ready.append(entry)
+        self.pump()
+      else:
+        self.backlog.setdefault(mac, collections.deque()).append(entry)
+
+    return future
+
+
+
+  # Transmit the next ready frame unless one is waiting for its ACK, lock held
+  def pump(self):
+    if self.awaiting is None and self.ready:
+      self.transmit(self.ready.popleft())
+
+
+
+  # Send an entry's frame, it then waits for its ACK, lock held
+  def transmit(self, entry):
+    entry[4]      = time.time() + self.timeout
+    self.awaiting = entry
+    self.lock.notify()
+    try:
+      self.send_frame(entry[2], entry[6])
+    except Exception as e: # Resent or failed on timeout
+      print("Error sending:", e)
+
+
+
+  # Message done, make room for the next one waiting for this peer, lock held
+  def release(self, mac):
+    backlog = self.backlog.get(mac)
+    if backlog:
+      self.ready.append(backlog.popleft())
+    else:
+      self.peer_count[mac] -= 1
+      if not self.peer_count[mac]:
+        del self.peer_count[mac]
+    if backlog is not None and not backlog:
+      del self.backlog[mac]
+
+
+
+  # ACK received, confirm the most recently transmitted frame. Returns seconds since it was sent, None with nothing waiting
+  def ack(self):
+    with self.lock:
+      entry = self.awaiting
+      if entry is None:
+        return None
+      self.awaiting   = None
+      self.confirmed += 1
+      self.release(entry[1])
+      self.pump()
+
+    entry[0].set_result(True) # Outside the lock, done callbacks may send again
+    return time.time() - entry[4] + self.timeout
+
+
+
+  # Resend or fail the awaited frame once its ACK is overdue
+  def run(self):
+    while True:
+      failed = None
+
+      with self.lock:
+        self.lock.wait(self.awaiting[4] - time.time() if self.awaiting else None)
+
+        entry = self.awaiting
+        if entry is None or entry[4] > time.time():
+          continue
+        self.awaiting = None
+
+        if entry[5] < self.retries:
+          entry[5]             += 1
+          entry[2][entry[3]+1] |= 0x08 # Set the resend flag
+          self.resent          += 1
+          self.transmit(entry)
+
+        else:
+          self.failed += 1
+          failed       = entry[0]
+          self.release(entry[1])
+          self.pump()
+
+      if failed:
+        failed.set_result(False)
+
+
+
+  # Messages accepted and waiting, and totals since start
+  def stats(self):
+    with self.lock:
+      return {"in_flight": len(self.ready) + (self.awaiting is not None), "backlog": sum(len(backlog) for backlog in self.backlog.values()), "confirmed": self.confirmed, "resent": self.resent, "failed": self.failed}
+
+
+
+
+
+# Send queue with a dedicated TX worker thread. Submitting is a put on a thread safe queue, no locks are taken by the caller
+# The worker moves submissions into a queue per priority and destination. Higher priorities go first, within a priority destinations take turns
+# Destinations waiting on their rate limit are skipped, the worker sleeps only when nothing can be sent
+class TxScheduler:
+
+  def __init__(self, send, pacer, queue_size=1024):
+    self.send        = send                                      # Function sending one message to a MAC
+    self.pacer       = pacer                                     # Rate limits
+    self.queue_size  = max(queue_size, 1)                        # Messages held per destination and priority, more are rejected
+    self.inbox       = queue.SimpleQueue()                       # Submitted (mac, msg, future, enqueue time, priority), not yet sorted by destination
+    self.queues      = {}                                        # Messages waiting by (priority, destination MAC), owned by the worker
+    self.ready       = [collections.deque() for priority in range(PRIORITY_BULK+1)] # Destinations with messages waiting, per priority in turn order
+    self.sent        = 0                                         # Messages sent
+    self.rejected    = 0                                         # Messages rejected with the destination queue full
+    self.peer_sent   = collections.Counter()                     # Messages sent by destination MAC
+    self.latency     = collections.deque(maxlen=1024)            # Recent enqueue to wire times, seconds
+    self.latency_max = 0                                         # Longest enqueue to wire time, seconds
+    self.thread      = scapy.threading.Thread(target=self.run, daemon=True)
+    self.thread.start()
+
+
+
+  # Queue msg to mac, returns a Future resolving True once sent, False if rejected or failed
+  def submit(self, mac, msg, priority=PRIORITY_NORMAL):
+    future = concurrent.futures.Future()
+    self.inbox.put((mac, msg, future, time.perf_counter(), min(max(priority, PRIORITY_CONTROL), PRIORITY_BULK)))
+    return future
+
+
+
+  # Sort new submissions into destination queues. Waits up to timeout for the first one, forever if None
+  def collect(self, timeout=0):
+    block = timeout != 0
+
+    while True:
+      try:
+        item = self.inbox.get(block=block, timeout=timeout)
+      except queue.Empty:
+        return
+      block = False
+
+      key = (item[4], item[0])
+      if key not in self.queues:
+        self.queues[key] = collections.deque()
+        self.ready[item[4]].append(item[0])
+
+      if len(self.queues[key]) >= self.queue_size:
+        self.rejected += 1
+        item[2].set_result(False)
+      else:
+        self.queues[key].append(item)
+
+
+
+  # Next destination allowed to send now, highest priority first. Returns (priority, mac, None), or (None, None, seconds to wait)
+  def next(self):
+    wait = None
+
+    for priority, ready in enumerate(self.ready):
+      for i in range(len(ready)):
+        mac   = ready[0]
+        delay = self.pacer.delay(mac, len(self.queues[(priority, mac)][0][1]))
+        if not delay:
+          return priority, mac, None
+        ready.rotate(-1) # Held back by its rate limit, let the next destination go
+        wait = delay if wait is None else min(wait, delay)
+
+    return None, None, wait
+
+
+
+  # TX worker loop, one message at a time
+  def run(self):
+    while True:
+      self.collect()
+
+      priority, mac, wait = self.next()
+
+      # Nothing allowed to send yet. Short waits are slept precisely, longer ones wake early for new messages
+      if mac is None:
+        if wait is not None and wait <= .002:
+          sleep_until(time.perf_counter() + wait)
+        else:
+          self.collect(wait - .001 if wait else None)
+        continue
+
+      self.ready[priority].popleft()
+      pending = self.queues[(priority, mac)]
+      mac, msg, future, enqueued, priority = pending.popleft()
+
+      try:
+        result = self.send(mac, msg)
+      except Exception as e:
+        print("Error sending:", e)
+        result = False
+
+      self.pacer.take(mac, len(msg))
+
+      latency = time.perf_counter() - enqueued
+      self.latency.append(latency)
+      self.latency_max = max(self.latency_max, latency)
+      self.sent += 1
+      self.peer_sent[mac] += 1
+      future.set_result(result)
+
+      # Back of the line, or done
+      if pending:
+        self.ready[priority].append(mac)
+      else:
+        del self.queues[(priority, mac)]
+
+
+
+  # Queue depth, totals since start, and enqueue to wire latency in seconds over recent messages
+  def stats(self):
+    latency = sorted(self.latency)
+    queues  = dict(self.queues)    # Copies, the worker keeps running
+    sent    = dict(self.peer_sent)
+    depth   = collections.Counter()
+    for (priority, mac), pending in queues.items():
+      depth[mac] += len(pending)
+
+    return {"depth":       self.inbox.qsize() + sum(depth.values()),
+            "sent":        self.sent,
+            "rejected":    self.rejected,
+            "latency_avg": sum(latency) / len(latency) if latency else 0,
+            "latency_p99": latency[int(len(latency) * .99)] if latency else 0,
+            "latency_max": self.latency_max,
+            "peers":       {mac: {"depth": depth[mac], "sent": sent.get(mac, 0)} for mac in set(sent) | set(depth)}}
+
+
+
+
+
+# Token bucket, rate in units per second. Holds up to burst units, at least one
+# A request larger than burst waits only for a full bucket and leaves it in debt, so large messages keep the average rate
+class TokenBucket:
+
+  def __init__(self, rate, burst=0, now=None):
+    self.rate   = rate                                           # Units per second
+    self.burst  = max(burst, 1)                                  # Bucket size
+    self.tokens = self.burst                                     # Units available, starts full
+    self.time   = time.perf_counter() if now is None else now    # Last refill
+
+
+
+  # Add tokens for the time passed
+  def refill(self, now):
+    self.tokens = min(self.burst, self.tokens + (now - self.time) * self.rate)
+    self.time   = now
+
+
+
+  # Seconds until n units may be taken, 0 if now
+  def delay(self, n, now):
+    self.refill(now)
+    need = min(n, self.burst)
+    return 0 if self.tokens >= need else (need - self.tokens) / self.rate
+
+
+
+  # Take n units
+  def take(self, n, now):
+    self.refill(now)
+    self.tokens -= n
+
+
+
+
+
+# Send rate limits, an overall limit (MAC None) and per destination limits, each in bytes and/or messages per second
+class Pacer:
+
+  def __init__(self, clock=time.perf_counter):
+    self.buckets = {}                                            # [bytes bucket, messages bucket] by MAC, None for overall. Either may be None
+    self.lock    = scapy.threading.RLock()                       # Senders on different threads share buckets
+    self.clock   = clock                                         # Seconds, monotonic
+
+
+
+  # Set or remove (all rates 0) the limits for mac
+  def configure(self, mac, bytes_per_sec=0, frames_per_sec=0, burst_bytes=0, burst_frames=1):
+    with self.lock:
+      if bytes_per_sec or frames_per_sec:
+        now               = self.clock()
+        self.buckets[mac] = [TokenBucket(bytes_per_sec, burst_bytes, now) if bytes_per_sec else None, TokenBucket(frames_per_sec, burst_frames, now) if frames_per_sec else None]
+      else:
+        self.buckets.pop(mac, None)
+
+
+
+  # Seconds until size bytes in frames messages may be sent to mac, 0 if now
+  def delay(self, mac, size, frames=1):
+    if not self.buckets:
+      return 0
+
+    now  = self.clock()
+    wait = 0
+    with self.lock:
+      for key in (None, mac):
+        if key in self.buckets:
+          size_bucket, frame_bucket = self.buckets[key]
+          if size_bucket:
+            wait = max(wait, size_bucket.delay(size, now))
+          if frame_bucket:
+            wait = max(wait, frame_bucket.delay(frames, now))
+    return wait
+
+
+
+  # Account for size bytes in frames messages sent to mac
+  def take(self, mac, size, frames=1):
+    if not self.buckets:
+      return
+
+    now = self.clock()
+    with self.lock:
+      for key in (None, mac):
+        if key in self.buckets:
+          size_bucket, frame_bucket = self.buckets[key]
+          if size_bucket:
+            size_bucket.take(size, now)
+          if frame_bucket:
+            frame_bucket.take(frames, now)
+
+
+
+  # Block until size bytes in frames messages may be sent to mac, then account for them
+  def wait(self, mac, size, frames=1):
+    while True:
+      with self.lock:
+        delay = self.delay(mac, size, frames)
+        if not delay:
+          self.take(mac, size, frames)
+          return
+      sleep_until(time.perf_counter() + delay)
+
+
+
+
+
+# Sleep until time.perf_counter() reaches deadline. time.sleep() for most of it, then yield in a loop for the last ms, for low jitter
+def sleep_until(deadline):
+  remaining = deadline - time.perf_counter()
+  if remaining > .002:
+    time.sleep(remaining - .001)
+  while time.perf_counter() < deadline:
+    time.sleep(0)
+
+
+
+
+
+# AES-CCM for ESP-NOW (13 byte nonce, 8 byte MIC) with the AES key schedule cached
+# pycryptodome builds new cipher objects for every CCM message. Here one ECB object makes the CTR keystream for a whole message in one call,
+# and one CBC object computes the CBC-MAC, chained across messages by undoing the previous chaining value on the first block
+class CCMContext:
+
+  def __init__(self, key):
+    self.key   = key                                      # CCM key
+    self.ecb   = AES.new(key, AES.MODE_ECB)               # CTR keystream
+    self.cbc   = AES.new(key, AES.MODE_CBC, iv=bytes(16)) # CBC-MAC
+    self.chain = 0                                        # Last CBC output block, the CBC object's chaining value
+    self.lock  = scapy.threading.Lock()                   # The CBC object and chain are shared by every sender using this key
+
+
+
+  # Keystream blocks S0, S1.. for nonce (int), enough to cover size bytes
+  def keystream(self, nonce, size):
+    blocks        = (size + 31) // 16
+    repeat, index = ccm_counters(blocks)
+    return self.ecb.encrypt((((0x01 << 120) | (nonce << 16)) * repeat + index).to_bytes(blocks * 16, 'big'))
+
+
+
+  # Encrypt plaintext with nonce (int) and encoded AAD block. Returns encrypted data + MIC
+  def encrypt(self, nonce, plaintext, aad_block):
+    size = len(plaintext)
+    with self.lock:
+      b0         = ((0x59 << 120) | (nonce << 16) | size) ^ self.chain # Flags (Adata, 8 byte MIC, 2 byte length), nonce, length
+      mac        = self.cbc.encrypt(b0.to_bytes(16, 'big') + aad_block + plaintext + bytes(-size % 16))
+      self.chain = int.from_bytes(mac[-16:], 'big')
+    stream = self.keystream(nonce, size)
+    return (int.from_bytes(plaintext, 'big') ^ int.from_bytes(stream[16:16+size], 'big')).to_bytes(size, 'big') + \
+           (int.from_bytes(mac[-16:-8], 'big') ^ int.from_bytes(stream[:8], 'big')).to_bytes(8, 'big')
+
+
+
+  # Decrypt data (without MIC) with nonce (int). MIC is not checked, callers check the decrypted ESP-NOW header
+  def decrypt(self, nonce, data):
+    size   = len(data)
+    stream = self.keystream(nonce, size)
+    return (int.from_bytes(data, 'big') ^ int.from_bytes(stream[16:16+size], 'big')).to_bytes(size, 'big')
+
+
+
+
+
+# CCM AAD encoded for the CBC-MAC, length prefixed and padded to whole blocks
+def ccm_aad_block(aad):
+  return len(aad).to_bytes(2, 'big') + aad + bytes(-(len(aad) + 2) % 16)
+
+
+
+# CTR counter block multipliers for a number of blocks. Counter blocks are (flags + nonce) * repeat + index, as one big integer
+def ccm_counters(blocks):
+  if blocks not in CCM_COUNTERS:
+    CCM_COUNTERS[blocks] = (sum(1 << (128 * i) for i in range(blocks)), sum(i << (128 * (blocks - 1 - i)) for i in range(blocks)))
+  return CCM_COUNTERS[blocks]
+
+
+
+
+
+# Preallocated ESP-NOW frame for one destination MAC, PHY rate and NOACK setting
+# RadioTap, 802.11 and CCMP headers are written once, each send only writes sequence number, random value, element headers and message
+class FrameTemplate:
+
+  def __init__(self, radiotap, src_mac, dst_mac, ccm=None):
+    self.ccm      = ccm                                   # Cached CCM context, frames are encrypted if set
+    self.fc_index = len(radiotap)                         # Index of 802.11 frame control
+    self.sc_index = self.fc_index + 22                    # Index of 802.11 sequence control
+    self.body     = self.fc_index + 24 + (8 if ccm else 0) # Index of ESP-NOW data, after CCMP header if encrypted
+    self.buffer   = bytearray(self.body + 4096)           # Room for the largest ESP-NOW v2.0 message, MIC and FCS
+    self.view     = memoryview(self.buffer)
+
+    self.buffer[:self.fc_index]                   = radiotap
+    self.buffer[self.fc_index:self.fc_index+2]    = b"\xd0\x40" if ccm else b"\xd0\x00" # Action frame, protected if encrypted
+    self.buffer[self.fc_index+4:self.sc_index]    = dst_mac + src_mac + b"\xff\xff\xff\xff\xff\xff"
+
+    if ccm:
+      self.buffer[self.body-8:self.body]          = b"\x00\x00\x00\xe0\x00\x00\x00\x00" # CCMP header, PN0 PN1 rsvd keyid/ExtIV PN2-5
+      self.nonce = int.from_bytes(b"\x00" + src_mac + b"\x00\x00\x00\x00\x00\x00", 'big') # CCM nonce, the packet number is added to the last two bytes
+      self.aad   = ccm_aad_block(struct.pack('<H', 0x4080) + dst_mac + src_mac + b"\xff\xff\xff\xff\xff\xff" + struct.pack('<H', 0))
+
+
+
+  # Write message into the frame. v1.0 if 250 bytes or less, otherwise v2.0. Returns frame length
+  def render(self, msg, sequence):
+    buffer = self.buffer
+    view   = self.view
+    size   = len(msg)
+    pos    = self.body + 8
+
+    if pos + size + 7 * (size // 250 + 1) + 12 > len(buffer):
+      raise ValueError(f"Message too large ({size} bytes)")
+
+    SEQUENCE_CONTROL.pack_into(buffer, self.sc_index, sequence << 4)
+    ESPNOW_HEADER.pack_into(buffer, self.body, b"\x7f\x18\xfe\x34", random.getrandbits(32)) # Vendor specific category and Espressif OUI (overwritten when encrypted in place), random value used by receivers to filter resent messages
+
+    # v1.0, single vendor element
+    if size <= 250:
+      view[pos:pos+7]            = ESPNOW_V1_HEADERS[size]
+      view[pos+7:pos+7+size]     = msg
+      pos                       += 7 + size
+
+    # v2.0, vendor element per 250 bytes, all but the last flagged as more to follow
+    else:
+      msg = memoryview(msg)
+      for i in range(0, size, 250):
+        chunk                    = msg[i:i+250]
+        view[pos:pos+7]          = ESPNOW_V2_MORE_HEADER if i+250 < size else ESPNOW_V2_LAST_HEADERS[len(chunk)]
+        view[pos+7:pos+7+len(chunk)] = chunk
+        pos                     += 7 + len(chunk)
+
+    # Encrypt, append MIC
+    if self.ccm:
+      buffer[self.body-8]        = sequence & 0xff
+      buffer[self.body-7]        = (sequence >> 8) & 0xff
+      view[self.body:pos+8]      = self.ccm.encrypt(self.nonce | sequence, view[self.body:pos], self.aad)
+      pos                       += 8
+
+    FCS.pack_into(buffer, pos, 0) # FCS, filled in by driver
+    return pos + 4
+
+
+
+
+
+# Stand-in L2 socket for benchmarks without a radio, pass as ESPythoNow(l2_socket=). Frames are written to a local UDP socket,
+# so scapy send, raw send and sendmmsg make real system calls. After answer(), a reader thread answers unicast frames with an
+# ACK frame passed to ack (e.g. espnow.parse_rx_frame), the way a receiving peer would. Frames the reader can't keep up with are lost
+class LoopbackL2Socket(scapy.SuperSocket):
+
+  def __init__(self):
+    self.peer   = socket.socket(socket.AF_INET, socket.SOCK_DGRAM) # Receiving end, stands in for the air and the remote peer
+    self.peer.bind(("127.0.0.1", 0))
+    self.ins    = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    self.ins.connect(self.peer.getsockname())
+    self.outs   = self.ins
+    self.iface  = "loopback"
+    self.closed = False
+    self.ack    = None                                            # Called with an ACK frame for every unicast frame received
+
+
+
+  # Start answering unicast frames, ack is called with each ACK frame
+  def answer(self, ack):
+    self.ack = ack
+    scapy.threading.Thread(target=self.reader, daemon=True).start()
+
+
+
+  # Answer unicast frames with an ACK to their source, RadioTap header without fields, then frame control, duration and destination
+  def reader(self):
+    while True:
+      frame  = self.peer.recv(65535)
+      rt_len = frame[2] | frame[3] << 8
+      if not frame[rt_len+4] & 0x01:
+        self.ack(b"\x00\x00\x08\x00\x00\x00\x00\x00\xd4\x00\x00\x00" + frame[rt_len+10:rt_len+16])
+
+
+
+
+
+def speed_test(espnow, duration, size, mac):
+  data, start = b'\x00' * int(size), time.time()
+  byte_count, packet_count, total, last_report = 0, 0, 0, start
+  mbps_history = []
+  while (now := time.time()) - start < int(duration):
+    espnow.send(mac, data, block=False)
+    byte_count += len(data)
+    packet_count += 1
+    total += 1
+    if now - last_report >= 1.0:
+      if packet_count == 0:
+        byte_count, packet_count, last_report = 0, 0, now
+        continue
+      mbps_history.append((byte_count * 8) / (now - last_report) / 1000000)
+      print(f"pkts/s: {packet_count / (now - last_report):.0f}  B/s: {byte_count / (now - last_report):.0f}  kbps: {byte_count * 8 / (now - last_report) / 1000:.1f}  Mbps: {mbps_history[-1]:.3f}  [min: {min(mbps_history):.3f}  avg: {sum(mbps_history) / len(mbps_history):.3f}  max: {max(mbps_history):.3f}]")
+      byte_count, packet_count, last_report = 0, 0, now
+  espnow._speed_test_packets_sent = total
+  print(f"\n\t\t\t {total} packets sent")
+
+
+
+# Compare encrypted and plaintext send throughput, frames are rendered from templates and written to the raw socket as in send()
+# Encrypted sends use the instance key if set, otherwise a random one. With send=False only frame building is measured
+def encryption_benchmark(espnow, duration, size, mac, send=True):
+  espnow.prepare()
+  data     = b'\x00' * int(size)
+  radiotap = espnow.radiotap_header(espnow.rate, espnow.no_wait)
+  src, dst = espnow.mac_as_bytes(espnow.local_mac), espnow.mac_as_bytes(espnow.format_mac(mac))
+  results  = {}
+
+  for name, template in [("plaintext", FrameTemplate(radiotap, src, dst)), ("encrypted", FrameTemplate(radiotap, src, dst, espnow.ccm or CCMContext(random.randbytes(16))))]:
+    count, start = 0, time.time()
+    while (now := time.time()) - start < float(duration):
+      frame = template.view[:template.render(data, count & 0xFFF)]
+      if send:
+        espnow.l2_socket.ins.send(frame)
+      count += 1
+    results[name] = count / (now - start)
+    print(f"{name:10} pkts/s: {results[name]:.0f}  Mbps: {results[name] * len(data) * 8 / 1000000:.3f}")
+
+  print(f"Encrypted throughput is {results['encrypted'] / results['plaintext'] * 100:.1f}% of plaintext")
+  return results
+
+
+
+
+
+# Compare FEC against repeat on a simulated lossy channel, each frame lost independently with probability loss. No radio required
+# Goodput is delivered message bytes per byte of airtime. Every message sent, copy or parity, counts its ESP-NOW headers, FEC messages their FEC header too
+# Loss is the share of messages never delivered. size defaults to the largest message FecStream sends to ESP-NOW v1.0 receivers
+def fec_benchmark(loss, group, repeat, count=20000, size=250 - FEC_HEADER.size - 2):
+  loss, group, repeat, count, size = float(loss), int(group), int(repeat), int(count), int(size)
+  results = {}
+  header  = ESPNOW_HEADER.size + len(ESPNOW_V1_HEADERS[0]) # Category, OUI and random value, then the vendor element header
+
+  # Every message sent repeat+1 times, delivered if any copy arrives
+  for n in range(repeat + 1):
+    delivered = sum(1 for i in range(count) if any(random.random() >= loss for copy in range(n + 1)))
+    results[f"repeat={n}"] = (delivered * size / (count * (n + 1) * (header + size)), 1 - delivered / count)
+
+  # Every message once, plus one parity message per group
+  sender, receiver = FecStream(None, group=group, message_size=max(size + FEC_HEADER.size + 2, 250)), FecStream(None, group=group)
+  delivered, airtime = 0, 0
+  for i in range(count):
+    for message in sender.encode("", random.randbytes(size)) + (sender.encode("", None) if i == count - 1 else []):
+      airtime += header + len(message)
+      if random.random() >= loss:
+        delivered += len(receiver.decode("", message))
+  results[f"fec group={group}"] = (delivered * size / airtime, 1 - delivered / count)
+
+  print(f"Simulated {loss * 100:.1f}% frame loss, {count} messages of {size} bytes")
+  for name, (goodput, lost) in results.items():
+    print(f"{name:14} goodput: {goodput * 100:5.1f}%  loss: {lost * 100:6.3f}%")
+
+  return results
+
+
+
+
+
+# Compare compiled decoder matching against checking every signature in turn, as check_decoders did, for growing numbers of signatures
+def decoder_benchmark(count=100000):
+  count   = int(count)
+  results = {}
+
+  # The previous check_decoders
+  def linear(decoders, data):
+    for name, dev in decoders.items():
+      sig = dev["signature"]
+      if "length" in sig and len(data) != sig["length"]:
+        continue
+      if "bytes" in sig:
+        reject = False
+        for k,v in sig["bytes"].items():
+          if k >= len(data) or data[k] != v:
+            reject = True
+        if reject:
+          continue
+      return dev
+
+  for signatures in (2, 8, 32, 64, 128, 256):
+    decs     = {f"sig{i}": {"signature": {"length": random.randrange(8, 33), "bytes": {0: random.randrange(256), random.randrange(1, 8): random.randrange(256)}}} for i in range(signatures)}
+    messages = []
+    for i in range(1000):
+      sig  = random.choice(list(decs.values()))["signature"]
+      data = bytearray(random.randbytes(sig["length"]))
+      for k, v in sig["bytes"].items():
+        data[k] = v
+      messages.append(bytes(data) if i % 2 else random.randbytes(len(data))) # Half match, half don't
+
+    index = DecoderIndex(decs)
+    assert all(index.match(m) is linear(decs, m) for m in messages)
+
+    times = []
+    for match in (lambda m: linear(decs, m), index.match):
+      start = time.perf_counter()
+      for i in range(count):
+        match(messages[i % 1000])
+      times.append((time.perf_counter() - start) / count * 1000000)
+
+    results[signatures] = times
+    print(f"{signatures:4} signatures  linear: {times[0]:7.2f} us/msg  compiled: {times[1]:5.2f} us/msg")
+
+  return results
+
+
+
+
+
+# Send and receive benchmarks without a radio, over LoopbackL2Socket. Results are printed and, if output is set, written there as JSON
+# Send: scapy and raw paths, plaintext and encrypted, v1 (250 byte) and v2 (1470 byte) messages, send_batch batch sizes, and blocking
+# send latency with ACKs from the loopback peer. Receive: parse_rx_frame and scapy dissection with parse_rx_packet, with and without decoder
+def benchmark_suite(count=20000, output=""):
+  count    = int(count)
+  local    = "02:00:00:00:00:01"
+  peer     = "02:00:00:00:00:02"
+  key      = "ESPythoNOW bench"
+  results  = {}
+
+  def espnow_for(mac=local, encrypted=False, ack=False, **kwargs):
+    sock   = LoopbackL2Socket()
+    espnow = ESPythoNow(interface="", set_interface=False, mac=mac, l2_socket=sock, pmk=key if encrypted else "", lmk=key if encrypted else "", **kwargs)
+    if ack:
+      sock.answer(espnow.parse_rx_frame)
+    espnow.prepare()
+    return espnow
+
+  def record(name, messages, size, elapsed, latencies=None, delivered=None):
+    result = {"messages": messages, "size": size, "msgs_per_sec": round(messages / elapsed, 1), "mbps": round(messages * size * 8 / elapsed / 1000000, 3)}
+    line   = f"{name:40} msgs/s: {result['msgs_per_sec']:9.0f}  Mbps: {result['mbps']:8.3f}"
+
+    if latencies:
+      latencies.sort()
+      for label, value in (("p50", latencies[len(latencies) // 2]), ("p99", latencies[int(len(latencies) * .99)]), ("max", latencies[-1])):
+        result[f"latency_{label}_us"] = round(value * 1000000, 1)
+        line += f"  {label}: {value * 1000000:7.1f} us"
+
+    if delivered is not None:
+      result["delivered"] = delivered
+      line += f"  delivered: {delivered * 100:.1f}%"
+
+    results[name] = result
+    print(line)
+
+  # Non-blocking send, one message at a time
+  for path in ("scapy", "raw"):
+    for encrypted in (False, True):
+      for size in (250, 1470):
+        espnow = espnow_for(encrypted=encrypted, send_raw=path == "raw")
+        msg    = bytes(size)
+        start  = time.perf_counter()
+        for i in range(count):
+          espnow.send(peer, msg, block=False)
+        record(f"send {path} {'encrypted' if encrypted else 'plaintext'} {size}", count, size, time.perf_counter() - start)
+
+  # Batched send with sendmmsg
+  espnow = espnow_for()
+  for batch in (1, 16, 64, 256):
+    msgs  = [bytes(250)] * batch
+    loops = max(count // batch, 1)
+    start = time.perf_counter()
+    for i in range(loops):
+      espnow.send_batch(peer, msgs)
+    record(f"send_batch {batch} 250", loops * batch, 250, time.perf_counter() - start)
+
+  # Blocking send, waiting for delivery confirmation. One at a time for latency, then a pipelined list
+  espnow    = espnow_for(ack=True)
+  msg       = bytes(250)
+  latencies = []
+  confirmed = 0
+  start     = time.perf_counter()
+  for i in range(min(count, 2000)):
+    sent = time.perf_counter()
+    confirmed += espnow.send(peer, msg, block=True)
+    latencies.append(time.perf_counter() - sent)
+  record("send blocking 250", len(latencies), 250, time.perf_counter() - start, latencies, confirmed / len(latencies))
+
+  start   = time.perf_counter()
+  futures = espnow.send_async(peer, [msg] * count)
+  confirmed = sum(future.result() for future in futures)
+  record(f"send_async ACK clocked (quota {espnow.delivery_peer_quota}) 250", count, 250, time.perf_counter() - start, delivered=confirmed / count)
+
+  # Receive, frames built by a sender with the same keys
+  wizmote = struct.Struct("<BIBBBB4s")
+  for encrypted in (False, True):
+    for size in (250, 1470):
+      sender   = espnow_for(mac=peer, encrypted=encrypted)
+      receiver = espnow_for(encrypted=encrypted, callback=lambda from_mac, to_mac, data: None)
+      frames   = [bytes(frame) for i, frame in sender.build_frames(local, [bytes(size)] * count)]
+      start    = time.perf_counter()
+      for frame in frames:
+        receiver.parse_rx_frame(frame)
+      record(f"receive raw {'encrypted' if encrypted else 'plaintext'} {size}", count, size, time.perf_counter() - start)
+
+      frames = frames[:max(count // 10, 1)] # Scapy dissection is much slower
+      start  = time.perf_counter()
+      for frame in frames:
+        receiver.parse_rx_packet(scapy.RadioTap(frame))
+      record(f"receive scapy {'encrypted' if encrypted else 'plaintext'} {size}", len(frames), size, time.perf_counter() - start)
+
+  sender   = espnow_for(mac=peer)
+  receiver = espnow_for(decoders={"wizmote": dict(decoders["wizmote"])})
+  receiver.add_signature("wizmote", lambda from_mac, to_mac, data: None, data="dict")
+  frames   = [bytes(frame) for i, frame in sender.build_frames(local, [wizmote.pack(1, i, 0x20, 1, 0x01, 90, b"ccm!") for i in range(count)])]
+  start    = time.perf_counter()
+  for frame in frames:
+    receiver.parse_rx_frame(frame)
+  record("receive raw decoded wizmote", count, wizmote.size, time.perf_counter() - start)
+
+  report = {"timestamp": time.time(), "python": sys.version.split()[0], "scapy": scapy.conf.version, "sendmmsg": HAVE_SENDMMSG, "count": count, "results": results}
+
+  if output:
+    with open(output, "w") as f:
+      json.dump(report, f, indent=2)
+    print(f"Results written to {output}")
+
+  return report
+
+
+
+
+
+# QOL structures
+decoders = {
+  "wizmote":{
+    "name":      "Wizmote",
+    "struct":    "<BIBBBB4s",
+    "vars":      ["type", "sequence", "dt1", "button", "dt2", "battery", "ccm"],
+    "dict":      {"battery": True, "sequence": True, "button": {1: "on", 2: "off", 3: "sleep", 16: "1", 17: "2", 18: "3", 19: "4", 8: "-", 9: "+"}},
+    "signature": {"length": 13, "bytes": {5: 0x20, 7: 0x01}},
+    "dedupe":    10
+    },
+
+  "wiz_motion":{
+    "name":      "wiz motion sensor",
+    "struct":    "<BIBBBBBBBB4s",
+    "vars":      ["type", "sequence", "dt1", "_0", "_1", "_2", "motion", "_3", "_4", "_5", "ccm"],
+    "dict":      {"motion": {0x0b: True, 0x19: True, 0x0a: False, 0x18: False}}, # 0x0b RT Motion | 0x19 LT Motion | 0x0a RT Clear | 0x18 LT Clear
+    "signature": {"length": 17, "bytes": {0: 0x81, 5: 0x42}},
+    "dedupe":    10
+    }
+}
+
+
+
+
+
+def main():
+  import argparse
+  import signal
+  import os
+
+  def s2b(v): return True if v.lower() in ('yes', 'true', 't', 'y', '1') else False
+
+  def generic_callback   (from_mac, to_mac, data): print(from_mac, to_mac, "Generic callback handler. (%s)" % len(data), data)
+  def wizmote_callback   (from_mac, to_mac, data): print(from_mac, to_mac, "Wizmote callback handler", data)
   def wiz_motion_callback(from_mac, to_mac, data): print(from_mac, to_mac, "Wiz Motion callback handler", data)
 
   parser = argparse.ArgumentParser(description='ESPythoNOW: ESP-NOW for Linux!')
 
-  parser.add_argument('-i',      '--interface',        required=False, default="",                help='Dedicated wireless interface (e.g., wlan1)')
-  parser.add_argument('-c',      '--channel',          required=False, default=0,     type=int,   help='Wireless channel to use')
+  parser.add_argument('-i',      '--interface',        required=False, default="",                help='Dedicated wireless interface (e.g., wlan1), or several: wlan1,wlan2,wlan3')
+  parser.add_argument('-c',      '--channel',          required=False, default="0",               help='Wireless channel to use, or one per interface: 1,6,11')
   parser.add_argument('-s',      '--set_interface',    required=False, default=False, type=s2b,   help='ESPythoNOW will try and set monitor mode and channel')
   parser.add_argument('-M',      '--mtu',              required=False, default=0,     type=int,   help='ESPythoNOW will try and set the MTU for the interface')
   parser.add_argument('-r',      '--rate',             required=False, default=0,     type=float, help='ESPythoNOW will try and set the PHY rate for the interface')
   parser.add_argument('-m',      '--mac',              required=False, default=None,              help='Override local MAC address (default: interfaces MAC)')
   parser.add_argument('-S',      '--send_raw',         required=False, default=False, type=s2b,   help='Send with raw socket, can be faster and unstable')
+  parser.add_argument('-rr',     '--recv_raw',         required=False, default=False, type=s2b,   help='Receive with raw socket, parses frames without scapy dissection')
+  parser.add_argument('-rg',     '--recv_ring',        required=False, default=False, type=s2b,   help='Receive with memory mapped TPACKET_V3 ring, for bursty traffic')
+  parser.add_argument('-rgs',    '--ring_size',        required=False, default=4194304, type=int, help='Receive ring size in bytes (default: 4194304)')
+  parser.add_argument('-rgt',    '--ring_timeout',     required=False, default=10,    type=int,   help='Receive ring block timeout in ms (default: 10)')
+  parser.add_argument('-rw',     '--rx_workers',       required=False, default=0,     type=int,   help='Receive workers, messages are sharded by source MAC (default: 0, process on capture thread)')
+  parser.add_argument('-rwm',    '--rx_worker_mode',   required=False, default="thread",          help='Receive workers as thread or process (default: thread)')
+  parser.add_argument('-pf',     '--pcap_file',        required=False, default="",                help='Receive from a RadioTap pcap/pcapng capture file instead of the interface, no radio required')
+  parser.add_argument('-ps',     '--pcap_speed',       required=False, default=0,     type=float, help='Capture file replay speed, 1 original timing, 0 as fast as possible (default: 0)')
+  parser.add_argument('-cf',     '--capture_file',     required=False, default="",                help='Write received frames to this pcapng file, from a background thread')
+  parser.add_argument('-cm',     '--capture_mode',     required=False, default="all",             help='Received frames to capture: accepted, rejected or all (default: all)')
+  parser.add_argument('-crs',    '--capture_rotate_size', required=False, default=0,  type=int,   help='Start a new capture file after this many bytes (default: 0, never)')
+  parser.add_argument('-crt',    '--capture_rotate_time', required=False, default=0,  type=float, help='Start a new capture file after this many seconds (default: 0, never)')
+  parser.add_argument('-cz',     '--capture_compress', required=False, default="",                help='Capture file compression: gzip, bz2 or lzma (default: none)')
   parser.add_argument('-n',      '--no_wait',          required=False, default=False, type=s2b,   help='Don\'t wait for confirmation from receiver when sending. Speeds up UNICAST sending at cost of no retransmit')
   parser.add_argument('-R',      '--retry_limit',      required=False, default=0,     type=int,   help='Try and set the retry limit')
   parser.add_argument('-d',      '--repeat',           required=False, default=0,     type=int,   help='Force packet repeat in send n times')
@@ -763,8 +4370,11 @@ def main():
   parser.add_argument('-a',      '--accept_all',       required=False, default=False, type=s2b,   help='Accept all ESP-NOW messages regardless of destination (default: False)')
   parser.add_argument('-ack',    '--accept_ack',       required=False, default=False, type=s2b,   help='Execute callback on ACK confirmation (default: False)')
   parser.add_argument('-blk',    '--block_on_send',    required=False, default=False, type=s2b,   help='Block on sending data, wait for ACK from receiving device')
+  parser.add_argument('-dq',     '--delivery_peer_quota', required=False, default=8,  type=int,   help='Messages per peer in the ACK clocked transmit order at a time (default: 8)')
+  parser.add_argument('-dr',     '--delivery_retries', required=False, default=0,     type=int,   help='Times an unconfirmed message is resent when blocking (default: 0)')
   parser.add_argument('-pmk',    '--primary_key',      required=False, default=None,              help='Primary master key for encrypted ESP-NOW (16 chars)')
   parser.add_argument('-lmk',    '--local_key',        required=False, default=None,              help='Local master key for encrypted ESP-NOW (16 chars)')
+  parser.add_argument('-peers',  '--peer_keys',        required=False, default="",                help='Per peer local master keys, used instead of --local_key for those peers: AA:BB:CC:DD:EE:FF=lmk,11:22:33:44:55:66=lmk')
   parser.add_argument('-mqh',    '--mqtt_host',        required=False, default=None,              help='MQTT broker IP address')
   parser.add_argument('-mqp',    '--mqtt_port',        required=False, default=1883,  type=int,   help='MQTT broker port (default: 1883)')
   parser.add_argument('-mqu',    '--mqtt_username',    required=False, default=None,              help='MQTT username for authentication')
@@ -774,9 +4384,25 @@ def main():
   parser.add_argument('-mqhex',  '--mqtt_hex',         required=False, default=True,  type=s2b,   help='Publish hex-encoded data to MQTT (default: True)')
   parser.add_argument('-mqjson', '--mqtt_json',        required=False, default=True,  type=s2b,   help='Publish JSON-formatted data to MQTT, if decoder exists. (default: True)')
   parser.add_argument('-mqack',  '--mqtt_ack',         required=False, default=False, type=s2b,   help='Publish ACK (messsage received) to confirm message delivery on send (default: False)')
+  parser.add_argument('-mqq',    '--mqtt_queue_size',  required=False, default=10000, type=int,   help='MQTT publishes queued while the broker is slow or reconnecting (default: 10000)')
+  parser.add_argument('-mqo',    '--mqtt_overflow',    required=False, default="drop_oldest",     help='When the MQTT publish queue is full: drop_oldest, drop_newest or spill (default: drop_oldest)')
+  parser.add_argument('-mqsf',   '--mqtt_spill_file',  required=False, default="",                help='File for MQTT publishes spilled with --mqtt_overflow spill')
+  parser.add_argument('-mqqos',  '--mqtt_qos',         required=False, default="",                help='MQTT QoS by topic type: raw=1,hex=0,json=1,ack=1,stats=0,frames=1,reply=1 (default: 1, stats 0)')
+  parser.add_argument('-mqc',    '--mqtt_compact',     required=False, default=False, type=s2b,   help='Publish messages batched into compact binary envelopes to <base topic>/frames, instead of raw and hex (default: False)')
+  parser.add_argument('-mqcw',   '--mqtt_compact_window', required=False, default=.05, type=float, help='Seconds a message waits for others to share its compact envelope (default: 0.05)')
+  parser.add_argument('-mqcm',   '--mqtt_compact_max', required=False, default=64,    type=int,   help='Most messages per compact envelope (default: 64)')
   parser.add_argument('-mqbt',   '--mqtt_base_topic',  required=False, default=None,              help='The base topic ESPythoNOW will use for subscribe/publish')
+  parser.add_argument('-sp',     '--stats_port',       required=False, default=0,     type=int,   help='Serve stats on this HTTP port, Prometheus on /metrics and JSON on /stats (default: 0, disabled)')
+  parser.add_argument('-si',     '--stats_interval',   required=False, default=0,     type=float, help='Publish stats to MQTT base_topic/stats every this many seconds (default: 0, disabled)')
+  parser.add_argument('-co',     '--coordinator',      required=False, default="",                help='Radio worker, forward received messages to the coordinator at this Unix socket path or host:port')
+  parser.add_argument('-col',    '--coordinator_listen', required=False, default="",              help='Coordinator, receive from radio workers on this Unix socket path or host:port, no interface needed')
+  parser.add_argument('-cow',    '--coordinator_window', required=False, default=.02, type=float, help='Seconds the coordinator waits for copies of a message from other radios, keeping the best RSSI (default: 0.02)')
 
   parser.add_argument('-z',      '--speed_test',       required=False, default="",                help='Execute 30 second sending speed test, set packet size: --speed_test 30,250,FF:FF:FF:FF:FF:FF (seconds, message size, address)')
+  parser.add_argument('-zc',     '--encryption_benchmark', required=False, default="",            help='Compare encrypted and plaintext sending throughput: --encryption_benchmark 10,250,FF:FF:FF:FF:FF:FF (seconds, message size, address)')
+  parser.add_argument('-zd',     '--decoder_benchmark', required=False, default="",               help='Compare compiled and linear decoder signature matching, no radio required: --decoder_benchmark 100000 (messages)')
+  parser.add_argument('-zb',     '--benchmark_suite',  required=False, default="",                help='Send and receive benchmarks over a loopback socket, no radio required: --benchmark_suite 20000,results.json (messages, JSON output file)')
+  parser.add_argument('-zf',     '--fec_benchmark',    required=False, default="",                help='Compare FEC and repeat on a simulated lossy channel, no radio required: --fec_benchmark 0.1,4,2 (frame loss, FEC group, max repeat)')
 
   parser.add_argument('-C',      '--config',           required=False, default="",                help='JSON config for all CLI arguments')
   parser.add_argument('-ha',     '--homeassistant',    required=False, default=False, type=s2b,   help='Is home assistant addon')
@@ -826,8 +4452,21 @@ def main():
       except:
         print("Unable to get MQTT information from Supervisor. Falling back to configured MQTT settings.")
 
+  # Simulation only, no interface needed
+  if args.fec_benchmark and len(fb := args.fec_benchmark.split(",")) == 3:
+    fec_benchmark(*fb)
+    quit()
+
+  if args.decoder_benchmark:
+    decoder_benchmark(args.decoder_benchmark)
+    quit()
+
+  if args.benchmark_suite:
+    benchmark_suite(*args.benchmark_suite.split(",")[:2])
+    quit()
+
   # Quit if minimum configuration is not met
-  if not args.interface:
+  if not args.interface and not args.pcap_file and not args.coordinator_listen:
     print("Interface must be specified.")
     try:
       wifi = {i for i in os.listdir('/sys/class/net') if os.path.exists(f'/sys/class/net/{i}/wireless')}
@@ -873,30 +4512,58 @@ def main():
       "raw":        args.mqtt_raw,
       "hex":        args.mqtt_hex,
       "json":       args.mqtt_json,
-      "ack":        args.mqtt_ack}
+      "ack":        args.mqtt_ack,
+      "queue_size": args.mqtt_queue_size,
+      "overflow":   args.mqtt_overflow,
+      "spill_file": args.mqtt_spill_file,
+      "compact":    args.mqtt_compact,
+      "compact_window": args.mqtt_compact_window,
+      "compact_max":    args.mqtt_compact_max,
+      "qos":        {kind: int(qos) for kind, qos in (item.split("=", 1) for item in args.mqtt_qos.split(",") if "=" in item)}}
   else:
     mqtt_config = {}
 
   espnow = ESPythoNow(
-    interface        = args.interface,
-    channel          = args.channel,
-    set_interface    = args.set_interface,
-    mtu              = args.mtu,
-    rate             = args.rate,
-    mac              = args.mac,
-    send_raw         = args.send_raw,
-    no_wait          = args.no_wait,
-    retry_limit      = args.retry_limit,
-    repeat           = args.repeat,
-    accept_broadcast = args.accept_broadcast,
-    accept_all       = args.accept_all,
-    accept_ack       = args.accept_ack,
-    block_on_send    = args.block_on_send,
-    pmk              = args.primary_key,
-    lmk              = args.local_key,
-    callback         = generic_callback,
-    decoders         = decoders,
-    mqtt_config      = mqtt_config)
+    interface           = args.interface.split(",") if "," in args.interface else args.interface,
+    channel             = [int(c) for c in str(args.channel).split(",")] if "," in str(args.channel) else int(args.channel),
+    set_interface       = args.set_interface,
+    mtu                 = args.mtu,
+    rate                = args.rate,
+    mac                 = args.mac,
+    send_raw            = args.send_raw,
+    recv_raw            = args.recv_raw,
+    recv_ring           = args.recv_ring,
+    ring_size           = args.ring_size,
+    ring_timeout        = args.ring_timeout,
+    rx_workers          = args.rx_workers,
+    rx_worker_mode      = args.rx_worker_mode,
+    pcap_file           = args.pcap_file,
+    pcap_speed          = args.pcap_speed,
+    capture_file        = args.capture_file,
+    capture_mode        = args.capture_mode,
+    capture_rotate_size = args.capture_rotate_size,
+    capture_rotate_time = args.capture_rotate_time,
+    capture_compress    = args.capture_compress,
+    no_wait             = args.no_wait,
+    retry_limit         = args.retry_limit,
+    repeat              = args.repeat,
+    accept_broadcast    = args.accept_broadcast,
+    accept_all          = args.accept_all,
+    accept_ack          = args.accept_ack,
+    block_on_send       = args.block_on_send,
+    delivery_peer_quota = args.delivery_peer_quota,
+    delivery_retries    = args.delivery_retries,
+    pmk                 = args.primary_key,
+    lmk                 = args.local_key,
+    peers               = dict(peer.strip().split("=", 1) for peer in args.peer_keys.split(",") if "=" in peer),
+    callback            = generic_callback,
+    decoders            = decoders,
+    mqtt_config         = mqtt_config,
+    stats_port          = args.stats_port,
+    stats_interval      = args.stats_interval,
+    coordinator         = args.coordinator,
+    coordinator_listen  = args.coordinator_listen,
+    coordinator_window  = args.coordinator_window)
 
   espnow.add_signature("wizmote", wizmote_callback, data="dict")
   espnow.add_signature("wiz_motion", wiz_motion_callback, data="dict")
@@ -924,13 +4591,20 @@ def main():
     time.sleep(15)                                 # Wait for a response
     espnow.esp_now_rx_callback = original_callback # Restore previous callback
 
+  if args.encryption_benchmark and len(eb := args.encryption_benchmark.split(",")) == 3:
+    encryption_benchmark(espnow, *eb)
+
   espnow.prepare()
 
-  print(f"{espnow.interface} {espnow.local_mac}")
+  print(f"{','.join(radio.interface for radio in espnow.radios) or espnow.interface} {espnow.local_mac}")
 
   espnow.start()
 
-
+  # Capture file replays once
+  if args.pcap_file:
+    espnow.listener.join()
+    espnow.stop_capture()
+    quit()
 
   # Wait for exit
   signal.signal(signal.SIGTERM, lambda s, f: sys.exit(0))
@@ -938,6 +4612,7 @@ def main():
     signal.pause()
   except:
     pass
+  espnow.stop_capture()
   print()
 
 
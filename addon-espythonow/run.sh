@@ -13,6 +13,9 @@ else
       --mtu="${MTU}" \
       --rate="${RATE}" \
       --send_raw="${SEND_RAW}" \
+      --recv_raw="${RECV_RAW:-false}" \
+      --recv_ring="${RECV_RING:-false}" \
+      --rx_workers="${RX_WORKERS:-0}" \
       --no_wait="${NO_WAIT}" \
       --retry_limit="${RETRY_LIMIT}" \
       --repeat="${REPEAT}" \
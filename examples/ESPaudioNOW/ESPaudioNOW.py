@@ -2,7 +2,6 @@
 
 from ESPythoNOW import *
 import sys, datetime
-from time import sleep, perf_counter
 
 
 
@@ -42,22 +41,13 @@ class ESPaudioNOW:
 
 
   def send(self, f, mac="FF:FF:FF:FF:FF:FF", bitrate=128, loop=False, block=True, burst=0, data=b""):
-    delay = self.chunk_size / ((int(bitrate) * 1000) / 8)
-    next_send = perf_counter()
+    # Rate limit send to MP3 playback speed. Initial burst to fill buffer
+    self.espnow.set_pacing(mac, bytes_per_sec=int(bitrate) * 1000 / 8, burst_bytes=burst * self.chunk_size)
     cnt = 0
 
     while True:
       for chunk in self.chunk_file(f, data):
 
-        # Rate limit send based on calculated MP3 playback speed. Initial burst to fill buffer
-        if burst > 0:
-          burst -= 1
-        else:
-          sleep_time = next_send - perf_counter()
-          if sleep_time > 0:
-            sleep(sleep_time)
-          next_send += delay
-
         # Send
         cnt += 1
         self.espnow.send(mac, chunk, block=block)
@@ -42,10 +42,13 @@ class espnow_led_sender:
 
 
   def start(self):
+    paced = False
     for msgs in self.construct_messages():
       start = time.time()
-      self.espnow.send(self.peer, msgs)
-      time.sleep(max(1.0/self.fps -(time.time() -start),0))
+      if not paced: # Every LED frame is the same number of messages, each batch waits its turn at fps
+        self.espnow.set_pacing(self.peer, frames_per_sec=self.fps*len(msgs), burst_frames=len(msgs))
+        paced = True
+      self.espnow.send_batch(self.peer, msgs)
       print("FPS:", 1.0 / (time.time() - start))
 
 
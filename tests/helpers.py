@@ -0,0 +1,38 @@
+import time
+
+import scapy.all as scapy
+
+from ESPythoNOW import LoopbackL2Socket
+
+LOCAL = "02:00:00:00:00:01"
+PEER  = "24:0A:C4:00:00:02"
+OTHER = "24:0A:C4:00:00:03"
+
+
+# Plaintext ESP-NOW v1.0 frame as a radio hears it, RadioTap with RSSI and FCS
+def frame(src, msg, rand, rssi, dst=LOCAL):
+  body = b"\x7f\x18\xfe\x34" + rand + b"\xdd" + bytes([5 + len(msg)]) + b"\x18\xfe\x34\x04\x01" + msg
+  return scapy.RadioTap(present="Flags+dBm_AntSignal", Flags="FCS", dBm_AntSignal=rssi)/scapy.Dot11FCS(type=0, subtype=13, addr1=dst, addr2=src, addr3="FF:FF:FF:FF:FF:FF")/scapy.Raw(load=body)
+
+
+# Loopback radio recording the destination of every frame put on the air, ACKing unicast like a peer
+class Radio(LoopbackL2Socket):
+
+  def __init__(self):
+    super().__init__()
+    self.on_air = []
+
+  def reader(self):
+    while True:
+      frame  = self.peer.recv(65535)
+      rt_len = frame[2] | frame[3] << 8
+      self.on_air.append(frame[rt_len+4:rt_len+10].hex(":").upper())
+      if not frame[rt_len+4] & 0x01:
+        self.ack(b"\x00\x00\x08\x00\x00\x00\x00\x00\xd4\x00\x00\x00" + frame[rt_len+10:rt_len+16])
+
+
+def wait_for(condition, timeout=5):
+  deadline = time.time() + timeout
+  while not condition() and time.time() < deadline:
+    time.sleep(.01)
+  assert condition()
@@ -0,0 +1,40 @@
+import asyncio
+import types
+
+from ESPythoNOW import AsyncESPythoNow, Metrics
+
+
+# A socket with frames waiting, then nothing
+class Socket:
+
+  def __init__(self, frames):
+    self.frames = list(frames)
+
+  def recv(self, size):
+    if not self.frames:
+      raise BlockingIOError
+    return self.frames.pop(0)
+
+
+def test_full_queue_drops_messages_and_keeps_reading():
+  acks   = []
+  espnow = types.SimpleNamespace(metrics=Metrics())
+
+  def parse_rx_frame(frame):
+    if frame == b"ack":
+      acks.append(frame)
+    else:
+      node.on_message("24:0A:C4:00:00:02", "02:00:00:00:00:01", frame)
+
+  async def run():
+    node.queue = asyncio.Queue(node.queue_size)
+    node.loop  = asyncio.get_running_loop()
+    node.sock  = Socket([b"one", b"two", b"three", b"ack"])
+    node.on_readable()
+    return [(await node.queue.get())[2] for i in range(node.queue.qsize())]
+
+  espnow.parse_rx_frame = parse_rx_frame
+  node                  = AsyncESPythoNow(espnow, queue_size=2)
+  assert asyncio.run(run()) == [b"one", b"two"]
+  assert acks == [b"ack"]
+  assert node.dropped == 1
@@ -0,0 +1,31 @@
+import pytest
+
+import scapy.all as scapy
+
+from ESPythoNOW import ESPythoNow
+
+np = pytest.importorskip("numpy")
+
+PEER    = "24:0A:C4:00:00:02"
+PROFILE = {"tag": {"name": "tag", "struct": "<B4s", "vars": ["type", "tag"], "dict": {"type": True, "tag": True}, "signature": {"length": 5, "bytes": {0: 0x42}}}}
+
+
+def frame(msg, rand, src=PEER):
+  body = b"\x7f\x18\xfe\x34" + rand + b"\xdd" + bytes([5 + len(msg)]) + b"\x18\xfe\x34\x04\x01" + msg
+  return bytes(scapy.RadioTap(present="Flags+dBm_AntSignal", Flags="FCS", dBm_AntSignal=-42)/scapy.Dot11FCS(type=0, subtype=13, addr1="02:00:00:00:00:01", addr2=src, addr3="FF:FF:FF:FF:FF:FF")/scapy.Raw(load=body))
+
+
+def bulk(frames):
+  espnow = ESPythoNow(interface="lo", mac="02:00:00:00:00:01", set_interface=False, decoders=PROFILE)
+  return espnow, espnow.bulk_decode(frames)
+
+
+def test_repeated_copies_are_decoded_once():
+  espnow, out = bulk([frame(b"\x42ab\x00\x00", b"abcd"), frame(b"\x42ab\x00\x00", b"abcd"), frame(b"\x42cd\x00\x00", b"abcd", src="24:0A:C4:00:00:03"), frame(b"\x42ef\x00\x00", b"efgh")])
+  assert list(out["tag"]["src"]) == [PEER, "24:0A:C4:00:00:03", PEER]
+
+
+def test_byte_fields_match_decode():
+  espnow, out = bulk([frame(b"\x42ab\x00\x00", b"abcd"), frame(b"\x42\x00\x00\x00\x00", b"efgh")])
+  assert list(out["tag"]["tag"]) == [espnow.decode(PROFILE["tag"], b"\x42ab\x00\x00")["tag"], b"\x00\x00\x00\x00"]
+  assert list(out["tag"]["tag"]) == [b"ab\x00\x00", b"\x00\x00\x00\x00"]
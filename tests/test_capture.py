@@ -0,0 +1,15 @@
+import pytest
+
+from ESPythoNOW import CaptureWriter, pcap_frames
+
+FRAMES = [b"\x00\x00\x08\x00\x00\x00\x00\x00" + bytes([0xd0, 0, i]) for i in range(3)]
+
+
+@pytest.mark.parametrize("compress", ["", "gzip", "bz2", "lzma"])
+def test_compressed_captures_read_back(tmp_path, compress):
+  writer = CaptureWriter(str(tmp_path / "capture.pcapng"), compress=compress)
+  for i, frame in enumerate(FRAMES):
+    writer.write(frame, True, timestamp=1000 + i)
+  writer.close()
+
+  assert [(timestamp, bytes(frame)) for timestamp, frame in pcap_frames(writer.file_name)] == [(1000 + i, frame) for i, frame in enumerate(FRAMES)]
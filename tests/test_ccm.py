@@ -0,0 +1,39 @@
+import os
+import threading
+
+from Crypto.Cipher import AES
+
+from ESPythoNOW import CCMContext, ccm_aad_block
+
+
+KEY = bytes(range(16))
+AAD = bytes(22)
+
+
+# Encrypted data + MIC from pycryptodome's own CCM
+def reference(nonce, plaintext):
+  cipher = AES.new(KEY, AES.MODE_CCM, nonce=nonce.to_bytes(13, 'big'), mac_len=8)
+  cipher.update(AAD)
+  data, mic = cipher.encrypt_and_digest(plaintext)
+  return data + mic
+
+
+def test_concurrent_encrypt_matches_reference():
+  ccm    = CCMContext(KEY)
+  aad    = ccm_aad_block(AAD)
+  errors = []
+
+  def sender(offset):
+    for i in range(2000):
+      nonce     = (offset << 32) | i
+      plaintext = os.urandom(1 + i % 250)
+      if ccm.encrypt(nonce, plaintext, aad) != reference(nonce, plaintext):
+        errors.append(nonce)
+
+  threads = [threading.Thread(target=sender, args=(n,)) for n in range(2)]
+  for thread in threads:
+    thread.start()
+  for thread in threads:
+    thread.join()
+
+  assert not errors
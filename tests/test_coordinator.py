@@ -0,0 +1,58 @@
+import time
+
+import scapy.all as scapy
+
+from ESPythoNOW import ESPythoNow
+from helpers import LOCAL, OTHER, PEER, Radio, frame, wait_for
+
+
+# Coordinator on a Unix socket, radio worker a hears PEER weakly and OTHER, worker b hears PEER strongly
+def test_two_workers(tmp_path):
+  address  = str(tmp_path / "coordinator.sock")
+  received = []
+  scapy.wrpcap(str(tmp_path / "a.pcap"), [frame(PEER, b"m%d" % i, bytes([i, 0, 0, 1]), -70) for i in range(4)] + [frame(OTHER, b"only a", b"aaaa", -50)])
+  scapy.wrpcap(str(tmp_path / "b.pcap"), [frame(PEER, b"m%d" % i, bytes([i, 0, 0, 1]), -40) for i in range(4)])
+
+  coordinator = ESPythoNow(interface="", set_interface=False, mac=LOCAL, coordinator_listen=address, coordinator_window=.1, callback=lambda from_mac, to_mac, msg: received.append((from_mac, msg, coordinator.rssi)))
+  assert coordinator.start()
+
+  sockets, workers = {}, {}
+  for name in ("a", "b"):
+    sockets[name] = sock = Radio()
+    workers[name] = worker = ESPythoNow(interface="", set_interface=False, mac=LOCAL, pcap_file=str(tmp_path / f"{name}.pcap"), l2_socket=sock, coordinator=address)
+    sock.answer(worker.parse_rx_frame)
+    worker.start()
+    worker.listener.join()
+    if name == "a": # a's copies are first, b's must replace them on RSSI
+      wait_for(lambda: coordinator.stats()["coordinator"]["received"] == 5)
+
+  wait_for(lambda: len(received) == 5)
+  time.sleep(.2)
+
+  # Each message once, the best RSSI copy
+  assert sorted(received) == sorted([(PEER, b"m%d" % i, -40) for i in range(4)] + [(OTHER, b"only a", -50)])
+  stats = coordinator.stats()["coordinator"]
+  assert stats["duplicates"] == 4 and stats["replaced"] == 4
+
+  # Sends go out the radio that last heard the destination, broadcast out both
+  routes = coordinator.routes()
+  assert routes[PEER] != routes[OTHER]
+  assert coordinator.send(PEER, b"to peer", block=True)
+  assert coordinator.send(OTHER, b"to other")
+  assert coordinator.send("FF:FF:FF:FF:FF:FF", b"to all")
+  wait_for(lambda: len(sockets["a"].on_air) + len(sockets["b"].on_air) == 4)
+  assert sockets["a"].on_air == [OTHER, "FF:FF:FF:FF:FF:FF"]
+  assert sockets["b"].on_air == [PEER, "FF:FF:FF:FF:FF:FF"]
+
+  # Too large for a coordinator record, fails without reaching the worker
+  assert coordinator.send_async(PEER, [bytes(3000)])[0].result(timeout=5) is False
+
+  # A send the worker can't make reports failure, the link stays up
+  def too_large(mac, msg):
+    raise ValueError("Message too large")
+
+  workers["b"].send_async = too_large
+  assert coordinator.send_async(PEER, [b"fails"])[0].result(timeout=5) is False
+  del workers["b"].send_async
+  assert coordinator.send_async(PEER, [b"still linked"])[0].result(timeout=5) is True
+  assert workers["b"].stats()["coordinator"]["connected"]
@@ -0,0 +1,84 @@
+import random
+import struct
+
+import pytest
+
+from ESPythoNOW import ESPythoNow, LoopbackL2Socket
+from helpers import LOCAL, PEER, frame
+
+np = pytest.importorskip("numpy")
+
+CODES  = "c b B ? h H i I l L q Q e f d 4s 5p".split()
+NATIVE = ["n", "N"]
+
+
+# The decode before compiled decoders, every struct value zipped to its name, then mapped
+def reference_decode(sig, msg):
+  data = dict(zip(sig["vars"], struct.unpack(sig["struct"], msg)))
+  out  = {}
+  for k, v in sig["dict"].items():
+    if k not in sig["vars"]:
+      continue
+    if isinstance(v, bool) and v:
+      out[k] = data[k]
+    elif isinstance(v, dict):
+      for kk, vv in v.items():
+        if data[k] == kk:
+          out[k] = vv
+  return out
+
+
+def value(code, rng):
+  if code == "c":  return bytes([rng.randrange(256)])
+  if code == "?":  return rng.random() < .5
+  if code in "ef": return float(np.float16(rng.uniform(-1000, 1000))) if code == "e" else float(np.float32(rng.uniform(-1e6, 1e6)))
+  if code == "d":  return rng.uniform(-1e12, 1e12)
+  if code[-1] in "sp":
+    size = int(code[:-1]) - (code[-1] == "p")
+    return bytes(rng.choice((0, 0, 65, 66)) for i in range(rng.randrange(size + 1))) # Trailing NULs included
+  bits = struct.calcsize("<" + code.replace("n", "q").replace("N", "Q")) * 8
+  return rng.randrange(-(1 << bits - 1), 1 << bits - 1) if code.islower() else rng.randrange(1 << bits)
+
+
+# One decoder per byte order prefix, marked by its first byte. Every value named, plus a padding byte, a mapped field and a repeated name
+def profiles():
+  out = {}
+  for marker, prefix in enumerate("@=<>!", 1):
+    codes = CODES + (NATIVE if prefix == "@" else [])
+    out[f"prefix{marker}"] = {
+      "name":      prefix,
+      "struct":    prefix + "B" + "".join(codes) + "xBBB",
+      "vars":      ["marker"] + [f"v_{code}" for code in codes] + ["mode", "dup", "dup"],
+      "dict":      {"marker": True, **{f"v_{code}": True for code in codes}, "mode": {1: "on", 2: "off"}, "dup": True},
+      "signature": {"length": struct.calcsize(prefix + "B" + "".join(codes) + "xBBB"), "bytes": {0: marker}}}
+  return out
+
+
+def messages(decoders, rng):
+  out = []
+  for marker, (name, sig) in enumerate(decoders.items(), 1):
+    codes = [v[2:] for v in sig["vars"][1:-3]]
+    for i in range(50):
+      values = [marker] + [value(code, rng) for code in codes] + [rng.randrange(4), rng.randrange(256), rng.randrange(256)]
+      out.append((name, struct.pack(sig["struct"], *values)))
+  return out
+
+
+def test_compiled_and_bulk_decode_match_struct_unpack():
+  rng      = random.Random(7)
+  decoders = profiles()
+  espnow   = ESPythoNow(interface="", set_interface=False, mac=LOCAL, l2_socket=LoopbackL2Socket(), decoders=decoders)
+  espnow.prepare()
+  sent     = messages(decoders, rng)
+
+  expected = {}
+  for name, msg in sent:
+    expected.setdefault(name, []).append(reference_decode(decoders[name], msg))
+    assert espnow.decode(espnow.check_decoders(msg), msg) == expected[name][-1]
+
+  out = espnow.bulk_decode([bytes(frame(PEER, msg, i.to_bytes(4, "little"), -40)) for i, (name, msg) in enumerate(sent)])
+  for name, rows in expected.items():
+    columns = out[name]
+    fields  = [k for k in columns if k not in ("timestamp", "src", "dst", "rssi")]
+    bulk    = [{k: columns[k][i].item() if hasattr(columns[k][i], "item") else columns[k][i] for k in fields} for i in range(len(rows))]
+    assert [{k: v for k, v in row.items() if v is not None} for row in bulk] == rows
@@ -0,0 +1,33 @@
+from ESPythoNOW import ESPythoNow, LoopbackL2Socket
+from helpers import LOCAL
+
+OLD = {"name": "old", "struct": "<BB", "vars": ["type", "value"], "dict": {"value": True}, "signature": {"length": 2, "bytes": {0: 0x42}}}
+NEW = {"name": "new", "struct": "<BB", "vars": ["type", "level"], "dict": {"level": True}, "signature": {"length": 2, "bytes": {0: 0x42}}}
+
+
+def node(decoders):
+  received = []
+  espnow   = ESPythoNow(interface="", set_interface=False, mac=LOCAL, l2_socket=LoopbackL2Socket(), decoders=decoders, callback=lambda from_mac, to_mac, msg: received.append(msg))
+  espnow.prepare()
+  return espnow, received
+
+
+def test_decoder_replaced_in_place_is_used():
+  espnow, received = node({"sensor": OLD})
+  assert espnow.check_decoders(b"\x42\x07") is OLD
+
+  espnow.decoders["sensor"] = NEW
+  assert espnow.check_decoders(b"\x42\x07") is NEW
+  assert espnow.decode(espnow.check_decoders(b"\x42\x07"), b"\x42\x07") == {"level": 7}
+
+
+def test_decoders_assigned_and_removed():
+  espnow, received = node({})
+  espnow.decoders = {"sensor": OLD}
+  assert espnow.check_decoders(b"\x42\x07") is OLD
+
+  espnow.decoders["sensor"] = NEW
+  assert espnow.check_decoders(b"\x42\x07") is NEW
+
+  del espnow.decoders["sensor"]
+  assert espnow.check_decoders(b"\x42\x07") is None
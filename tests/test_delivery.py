@@ -0,0 +1,58 @@
+import queue
+import threading
+
+from ESPythoNOW import DeliveryTracker, ESPythoNow, LoopbackL2Socket
+
+
+# Frames are acked by a separate thread in the order sent, like a peer on the air. drop is (message index, attempt) pairs never acked
+def run(retries, drop):
+  sent    = []
+  frames  = queue.Queue()
+  tracker = None
+
+  def send_frame(frame, raw):
+    sent.append(frame[2])
+    frames.put((frame[2], frame[1] & 0x08))
+
+  def peer():
+    attempts = {}
+    while True:
+      index, retry = frames.get()
+      attempts[index] = attempts.get(index, -1) + 1
+      if (index, attempts[index]) not in drop:
+        tracker.ack()
+
+  tracker = DeliveryTracker(send_frame, quota=8, timeout=.05, retries=retries)
+  threading.Thread(target=peer, daemon=True).start()
+  futures = [tracker.submit("24:0A:C4:00:00:02", bytearray(b"\xd0\x00" + bytes([i])), 0) for i in range(5)]
+  return [future.result(timeout=5) for future in futures], sent, tracker.stats()
+
+
+def test_dropped_middle_frame_is_resent():
+  results, sent, stats = run(retries=1, drop={(1, 0)})
+  assert results == [True] * 5
+  assert sent == [0, 1, 1, 2, 3, 4]
+  assert stats["resent"] == 1 and stats["failed"] == 0 and stats["confirmed"] == 5
+
+
+def test_dropped_middle_frame_fails_without_retries():
+  results, sent, stats = run(retries=0, drop={(1, 0)})
+  assert results == [True, False, True, True, True]
+  assert sent == [0, 1, 2, 3, 4]
+  assert stats["failed"] == 1 and stats["confirmed"] == 4
+
+
+def test_blocking_send_honours_raw():
+  sock   = LoopbackL2Socket()
+  espnow = ESPythoNow(interface="", set_interface=False, mac="02:00:00:00:00:01", l2_socket=sock)
+  sock.answer(espnow.parse_rx_frame)
+  espnow.prepare()
+
+  through_scapy = []
+  scapy_send    = sock.send
+  sock.send     = lambda frame: through_scapy.append(frame) or scapy_send(frame)
+
+  assert espnow.send("24:0A:C4:00:00:02", [b"one", b"two"], block=True, raw=False)
+  assert len(through_scapy) == 2
+  assert espnow.send("24:0A:C4:00:00:02", b"three", block=True, raw=True)
+  assert len(through_scapy) == 2
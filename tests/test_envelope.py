@@ -0,0 +1,66 @@
+import threading
+import time
+
+import pytest
+
+from ESPythoNOW import ENVELOPE_FRAME, ENVELOPE_HEADER, EnvelopeBatcher, decode_envelope, encode_envelope
+from helpers import LOCAL, OTHER, PEER
+
+
+FRAMES = [(1700000000.25,     PEER,  LOCAL,               -40,  b"first"),
+          (1700000000.250001, OTHER, "FF:FF:FF:FF:FF:FF", None, b""),
+          (1700000001.5,      PEER,  LOCAL,               -300, bytes(range(256)) * 4),
+          (1700000002,        OTHER, LOCAL,               200,  b"\x00")]
+
+
+def test_round_trip_keeps_every_field():
+  decoded = decode_envelope(encode_envelope(FRAMES))
+
+  assert [(frame["from_mac"], frame["to_mac"], frame["msg"]) for frame in decoded] == [(src, dst, msg) for _, src, dst, _, msg in FRAMES]
+  assert [frame["rssi"] for frame in decoded] == [-40, None, None, 127] # Out of range values are clamped, -128 reads back as unknown
+  for frame, (timestamp, *_) in zip(decoded, FRAMES):
+    assert frame["timestamp"] == pytest.approx(timestamp, abs=1e-6)
+
+
+def test_empty_envelope():
+  assert decode_envelope(encode_envelope([])) == []
+
+
+def test_truncated_or_corrupt_envelopes_are_rejected():
+  payload = encode_envelope(FRAMES)
+
+  for length in (0, ENVELOPE_HEADER.size - 1, ENVELOPE_HEADER.size, ENVELOPE_HEADER.size + ENVELOPE_FRAME.size, len(payload) - 1):
+    with pytest.raises(ValueError):
+      decode_envelope(payload[:length])
+
+  with pytest.raises(ValueError):
+    decode_envelope(payload + b"\x00")
+  with pytest.raises(ValueError):
+    decode_envelope(b"\x00" + payload[1:]) # Magic
+  with pytest.raises(ValueError):
+    decode_envelope(payload[:2] + b"\x09" + payload[3:]) # Version
+
+
+def test_batcher_publishes_at_max_frames():
+  published = []
+  batcher   = EnvelopeBatcher(published.append, window=60, max_frames=2)
+  for frame in FRAMES:
+    batcher.add(*frame)
+
+  assert [len(decode_envelope(payload)) for payload in published] == [2, 2]
+  assert [frame["msg"] for payload in published for frame in decode_envelope(payload)] == [frame[4] for frame in FRAMES]
+
+
+def test_batcher_flushes_when_the_window_closes():
+  published = []
+  done      = threading.Event()
+  batcher   = EnvelopeBatcher(lambda payload: (published.append((time.perf_counter(), payload)), done.set()), window=.05, max_frames=64)
+
+  started = time.perf_counter()
+  batcher.add(*FRAMES[0])
+  batcher.add(*FRAMES[1])
+  assert done.wait(5)
+
+  flushed, payload = published[0]
+  assert flushed - started >= .05
+  assert [frame["msg"] for frame in decode_envelope(payload)] == [b"first", b""]
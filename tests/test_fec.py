@@ -0,0 +1,26 @@
+import random
+
+import pytest
+
+from ESPythoNOW import ESPNOW_HEADER, ESPNOW_V1_HEADERS, FEC_HEADER, FecStream, fec_benchmark
+
+
+def test_largest_message_and_parity_fit_v1():
+  stream   = FecStream(None, group=2)
+  messages = stream.encode("", b"a" * stream.max_size) + stream.encode("", b"b" * stream.max_size)
+  assert max(len(message) for message in messages) == 250
+
+
+def test_oversized_message_is_refused():
+  stream = FecStream(None, group=2)
+  assert stream.encode("", b"a" * (stream.max_size + 1)) is None
+  assert stream.encode("", b"a") is not None
+
+
+def test_benchmark_airtime_counts_headers():
+  random.seed(1)
+  header  = ESPNOW_HEADER.size + len(ESPNOW_V1_HEADERS[0])
+  results = fec_benchmark(0, 4, 1, count=8, size=100)
+  assert results["fec group=4"][0] == pytest.approx(8 * 100 / (8 * (header + FEC_HEADER.size + 100) + 2 * (header + FEC_HEADER.size + 102)))
+  assert results["repeat=0"][0] == pytest.approx(100 / (header + 100)) # Same per-message headers as FEC
+  assert results["repeat=1"][0] == pytest.approx(100 / (2 * (header + 100)))
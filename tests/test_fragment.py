@@ -0,0 +1,45 @@
+import types
+
+from ESPythoNOW import FragmentTransport
+
+LOCAL = "02:00:00:00:00:01"
+PEER  = "24:0A:C4:00:00:02"
+
+
+# Two transports wired back to back. The first round of the sender loses every fragment in lost
+def pair(lost, retries):
+  blobs  = []
+  rounds = [0]
+
+  def node(mac):
+    return types.SimpleNamespace(decoders={}, local_mac=mac, format_mac=str.upper, is_broadcast=lambda mac: False)
+
+  sender_node, receiver_node = node(LOCAL), node(PEER)
+  sender   = FragmentTransport(sender_node, retries=retries)
+  receiver = FragmentTransport(receiver_node, callback=lambda from_mac, to_mac, blob: blobs.append(blob))
+
+  def send(mac, fragments, block=False):
+    rounds[0] += 1
+    for fragment in fragments:
+      index = int.from_bytes(fragment[5:7], "little")
+      if rounds[0] > 1 or index not in lost:
+        receiver.on_message(LOCAL, PEER, fragment)
+
+  sender_node.send          = send
+  receiver_node.send_queued = lambda mac, msg, priority: sender.on_message(PEER, LOCAL, msg)
+  return sender, blobs, rounds
+
+
+def test_long_nack_lists_count_as_progress():
+  blob                  = bytes(range(256)) * 400
+  sender, blobs, rounds = pair(lost=set(range(10, 410)), retries=1)
+  assert sender.send(PEER, blob)
+  assert blobs == [blob]
+  assert rounds[0] == 5 # All, then four NACKs of at most 120 fragments each
+
+
+def test_no_progress_gives_up():
+  sender, blobs, rounds = pair(lost=set(range(1000)), retries=1)
+  sender.espnow.send    = lambda mac, fragments, block=False: rounds.__setitem__(0, rounds[0] + 1)
+  assert not sender.send(PEER, b"x" * 1000)
+  assert rounds[0] == 2
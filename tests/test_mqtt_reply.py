@@ -0,0 +1,81 @@
+import concurrent.futures
+import json
+import queue
+import types
+
+from ESPythoNOW import ESPythoNow, LoopbackL2Socket
+
+
+def reply(futures):
+  published = []
+  node      = types.SimpleNamespace(mqtt_topic_base="espnow", mqtt_qos={"reply": 1}, mqtt_publish=lambda topic, payload, qos: published.append((topic, json.loads(payload))))
+  ESPythoNow.mqtt_reply(node, "req-42", futures)
+  return published
+
+
+def resolved(result):
+  future = concurrent.futures.Future()
+  future.set_result(result)
+  return future
+
+
+def test_empty_batch_replies_at_once():
+  assert reply([]) == [("espnow/reply/req-42", {"id": "req-42", "results": [], "delivered": 0, "failed": 0, "unconfirmed": 0})]
+
+
+def test_unconfirmable_sends_are_not_delivered():
+  published = reply([(resolved(True), True), (resolved(False), True), (resolved(True), False), (resolved(False), False)])
+  assert published[0][1] == {"id": "req-42", "results": [True, False, None, False], "delivered": 1, "failed": 2, "unconfirmed": 1}
+
+
+def test_reply_waits_for_every_future():
+  pending   = concurrent.futures.Future()
+  published = reply([(resolved(True), True), (pending, True)])
+  assert published == []
+  pending.set_result(True)
+  assert published[0][1]["delivered"] == 2
+
+
+# Loopback peer that ACKs every unicast frame except those to silent
+class PartialPeer(LoopbackL2Socket):
+
+  def __init__(self, silent):
+    super().__init__()
+    self.silent = silent
+
+  def reader(self):
+    while True:
+      frame  = self.peer.recv(65535)
+      rt_len = frame[2] | frame[3] << 8
+      if not frame[rt_len+4] & 0x01 and frame[rt_len+4:rt_len+10] != self.silent:
+        self.ack(b"\x00\x00\x08\x00\x00\x00\x00\x00\xd4\x00\x00\x00" + frame[rt_len+10:rt_len+16])
+
+
+def mqtt_node():
+  sock      = PartialPeer(bytes.fromhex("240AC4000002"))
+  espnow    = ESPythoNow(interface="", set_interface=False, mac="02:00:00:00:00:01", l2_socket=sock, mqtt_config={"base_topic": "espnow"})
+  published = queue.Queue()
+  sock.answer(espnow.parse_rx_frame)
+  espnow.prepare()
+  espnow.mqtt_publish = lambda topic, payload, qos=1, coalesce=False: published.put((topic, json.loads(payload)))
+  espnow.delivery_timeout = .05
+  return espnow, published
+
+
+def on_message(espnow, topic, payload):
+  espnow.mqtt_on_message(None, None, types.SimpleNamespace(topic=topic, payload=payload))
+
+
+def test_untracked_unicast_ack_does_not_confirm_request():
+  espnow, published = mqtt_node()
+  on_message(espnow, "espnow/send/24:0A:C4:00:00:02/req-1", b"to the silent peer")
+  on_message(espnow, "espnow/send/24:0A:C4:00:00:03", b"no request id, ACKed")
+  assert published.get(timeout=5)[1]["results"] == [False]
+
+
+def test_oversized_send_publishes_failure():
+  espnow, published = mqtt_node()
+  on_message(espnow, "espnow/send/24:0A:C4:00:00:03/req-2", bytes(5000))
+  assert published.get(timeout=5)[1] == {"id": "req-2", "results": [False], "delivered": 0, "failed": 1, "unconfirmed": 0}
+  on_message(espnow, "espnow/send/24:0A:C4:00:00:03/req-3", b"still handled")
+  assert published.get(timeout=5)[1]["results"] == [True]
@@ -0,0 +1,95 @@
+import statistics
+import threading
+import time
+
+import pytest
+
+from ESPythoNOW import PRIORITY_BULK, PRIORITY_CONTROL, PRIORITY_NORMAL, ESPythoNow, LoopbackL2Socket, Pacer, TokenBucket, TxScheduler, sleep_until
+from helpers import LOCAL, PEER, Radio, wait_for
+
+
+def test_bucket_refills_at_rate_up_to_burst():
+  bucket = TokenBucket(100, burst=10, now=0)
+  assert bucket.delay(10, 0) == 0
+  bucket.take(10, 0)
+  assert bucket.delay(1, 0) == pytest.approx(.01)
+  assert bucket.delay(1, .01) == 0
+  assert bucket.delay(10, 60) == 0 and bucket.tokens == 10 # Idle time refills only up to burst
+
+
+def test_request_over_burst_waits_for_full_bucket_and_leaves_debt():
+  bucket = TokenBucket(100, burst=10, now=0)
+  bucket.take(10, 0)
+  assert bucket.delay(50, 0) == pytest.approx(.1) # Waits for burst, not for 50
+  bucket.take(50, .1)
+  assert bucket.delay(1, .1) == pytest.approx(.41) # 40 in debt, plus the one unit
+
+
+def test_pacer_applies_overall_and_per_destination_limits():
+  now   = [0.0]
+  pacer = Pacer(clock=lambda: now[0])
+  pacer.configure(None, frames_per_sec=100, burst_frames=1)
+  pacer.configure(PEER, bytes_per_sec=1000, burst_bytes=100)
+
+  assert pacer.delay(PEER, 100) == 0
+  pacer.take(PEER, 100)
+  assert pacer.delay(PEER, 100) == pytest.approx(.1)  # Bytes limit of the destination
+  assert pacer.delay("24:0A:C4:00:00:09", 100) == pytest.approx(.01) # Overall messages limit only
+
+  now[0] = .1
+  assert pacer.delay(PEER, 100) == 0
+
+  pacer.configure(PEER)
+  pacer.configure(None)
+  assert not pacer.buckets and pacer.delay(PEER, 10000) == 0
+
+
+def test_priorities_go_first_and_rate_limited_destinations_are_skipped():
+  sent  = []
+  open_ = threading.Event()
+  pacer = Pacer()
+  pacer.configure("SLOW", frames_per_sec=20, burst_frames=1)
+
+  def send(mac, msg):
+    if mac == "GATE":
+      open_.wait(5)
+    else:
+      sent.append(msg)
+    return True
+
+  scheduler = TxScheduler(send, pacer)
+  futures   = [scheduler.submit("GATE", b"gate")]
+  futures  += [scheduler.submit("BULK", b"bulk%d" % i, PRIORITY_BULK) for i in range(2)]
+  futures  += [scheduler.submit("SLOW", b"slow%d" % i, PRIORITY_NORMAL) for i in range(2)]
+  futures  += [scheduler.submit("FAST", b"fast%d" % i, PRIORITY_NORMAL) for i in range(2)]
+  futures  += [scheduler.submit("CTRL", b"ctrl", PRIORITY_CONTROL)]
+  open_.set()
+  assert all(future.result(timeout=5) for future in futures)
+
+  # The second SLOW message waits 50 ms for its bucket, FAST and then BULK go meanwhile
+  assert sent == [b"ctrl", b"slow0", b"fast0", b"fast1", b"bulk0", b"bulk1", b"slow1"]
+
+
+def test_sleep_until_never_wakes_early():
+  overshoot = []
+  for i in range(20):
+    deadline = time.perf_counter() + .003
+    sleep_until(deadline)
+    overshoot.append(time.perf_counter() - deadline)
+  assert min(overshoot) >= 0
+  assert statistics.median(overshoot) < .002
+
+
+def test_paced_send_keeps_the_rate_on_the_air():
+  sock   = Radio()
+  espnow = ESPythoNow(interface="", set_interface=False, mac=LOCAL, l2_socket=sock, no_wait=True)
+  sock.answer(lambda ack: None)
+  espnow.set_pacing(PEER, frames_per_sec=200, burst_frames=1)
+
+  start = time.perf_counter()
+  for i in range(21):
+    espnow.send(PEER, b"paced %d" % i)
+  elapsed = time.perf_counter() - start
+
+  wait_for(lambda: len(sock.on_air) == 21)
+  assert .095 <= elapsed < .5 # 20 intervals of 5 ms after the first message
@@ -0,0 +1,61 @@
+from ESPythoNOW import ESPythoNow
+from helpers import LOCAL, OTHER, PEER, Radio, frame, wait_for
+
+
+# ESPythoNow on two interfaces, each radio on a loopback socket that ACKs like a peer
+def two_radios(**kwargs):
+  received = []
+  espnow   = ESPythoNow(interface=["lo", "lo"], set_interface=False, mac=LOCAL, callback=lambda from_mac, to_mac, msg: received.append((from_mac, to_mac, msg, espnow.rssi)), **kwargs)
+  for radio in espnow.radios:
+    radio.l2_socket.close()
+    radio.l2_socket = Radio()
+    radio.l2_socket.answer(radio.parse_rx_frame)
+  espnow.prepare()
+  espnow.radio_coordinator.serve()
+  return espnow, received
+
+
+def hear(radio, src, msg, rand, rssi):
+  radio.parse_rx_frame(bytes(frame(src, msg, rand, rssi)))
+
+
+def test_same_frame_on_two_radios_is_delivered_once():
+  espnow, received = two_radios(coordinator_window=.05)
+  first, second    = espnow.radios
+  hear(first,  PEER, b"hello", b"abcd", -70)
+  hear(second, PEER, b"hello", b"abcd", -40)
+  wait_for(lambda: received)
+  wait_for(lambda: espnow.stats()["coordinator"]["pending"] == 0)
+
+  assert received == [(PEER, LOCAL, b"hello", -40)]
+  assert espnow.stats()["coordinator"]["duplicates"] == 1
+
+
+def test_sends_go_to_the_radio_that_last_heard_the_peer():
+  espnow, received = two_radios(coordinator_window=0)
+  first, second    = espnow.radios
+  hear(second, PEER,  b"one", b"aaaa", -40)
+  hear(first,  OTHER, b"two", b"bbbb", -50)
+
+  assert espnow.send(PEER, b"to peer")
+  assert espnow.send(OTHER, b"to other")
+  assert espnow.send("FF:FF:FF:FF:FF:FF", b"to all")
+  assert espnow.send("24:0A:C4:00:00:04", b"never heard")
+  wait_for(lambda: len(first.l2_socket.on_air) + len(second.l2_socket.on_air) == 6)
+
+  # Broadcast goes through the TX queue thread, unicast is tracked, so only the set of frames is fixed
+  assert sorted(first.l2_socket.on_air)  == sorted([OTHER, "FF:FF:FF:FF:FF:FF", "24:0A:C4:00:00:04"])
+  assert sorted(second.l2_socket.on_air) == sorted([PEER,  "FF:FF:FF:FF:FF:FF", "24:0A:C4:00:00:04"])
+
+
+def test_acks_reach_the_parent():
+  acks             = []
+  espnow, received = two_radios(coordinator_window=0, accept_ack=True)
+  espnow.delivery_callback = acks.append
+  hear(espnow.radios[1], PEER, b"one", b"aaaa", -40)
+
+  assert espnow.send(PEER, b"to peer", block=True)
+  wait_for(lambda: acks)
+  assert acks == [LOCAL]
+  assert [entry[:3] for entry in received if entry[2] == "ack"] == [(False, LOCAL, "ack")]
+  assert espnow.delivery_event.is_set()
@@ -0,0 +1,85 @@
+import pytest
+import scapy.all as scapy
+
+from ESPythoNOW import ESPNOW_V1_HEADERS, ESPNOW_V2_MORE_HEADER, ESPythoNow, LoopbackL2Socket
+from helpers import LOCAL, OTHER, PEER
+
+
+KEY      = "ESPythoNOW test!"
+MESSAGES = {size: bytes(i % 251 for i in range(size)) for size in (5, 250, 300, 1280)}
+
+
+def node(mac, encrypted, key=KEY):
+  received = []
+  espnow   = ESPythoNow(interface="", set_interface=False, mac=mac, l2_socket=LoopbackL2Socket(), pmk=key if encrypted else "", lmk=key if encrypted else "", callback=lambda from_mac, to_mac, msg: received.append((from_mac, to_mac, msg)))
+  espnow.prepare()
+  return espnow, received
+
+
+def frame_for(msg, encrypted, dst=LOCAL):
+  sender, _ = node(PEER, encrypted)
+  return bytes(next(iter(sender.build_frames(dst, [msg])))[1])
+
+
+@pytest.mark.parametrize("encrypted", (False, True))
+@pytest.mark.parametrize("size", sorted(MESSAGES))
+def test_round_trip(size, encrypted):
+  msg   = MESSAGES[size]
+  frame = frame_for(msg, encrypted)
+  if not encrypted: # v1.0 single element up to 250 bytes, v2.0 elements beyond
+    assert (ESPNOW_V1_HEADERS[size] if size <= 250 else ESPNOW_V2_MORE_HEADER) in frame
+
+  receiver, received = node(LOCAL, encrypted)
+  assert receiver.parse_rx_frame(frame)
+  receiver.recent_rand_values.clear() # Same frame again, through scapy dissection
+  assert receiver.parse_rx_packet(scapy.RadioTap(frame))
+
+  assert received == [(PEER, LOCAL, msg)] * 2
+  assert not receiver.metrics.counters["decrypt_failures"]
+
+
+@pytest.mark.parametrize("encrypted", (False, True))
+@pytest.mark.parametrize("size", (5, 300))
+def test_truncated_frames_are_dropped(size, encrypted):
+  frame              = frame_for(MESSAGES[size], encrypted)
+  receiver, received = node(LOCAL, encrypted)
+
+  for length in range(len(frame) - 4): # Cut anywhere before the FCS
+    receiver.parse_rx_frame(frame[:length])
+    if length >= 8: # Shorter RadioTap headers fail scapy's own dissection
+      receiver.parse_rx_packet(scapy.RadioTap(frame[:length]))
+
+  assert received == []
+  assert receiver.metrics.counters["malformed_dropped"]
+
+
+def test_malformed_frames_are_dropped():
+  frame              = frame_for(MESSAGES[300], False)
+  receiver, received = node(LOCAL, False)
+  body               = frame.index(b"\x7f\x18\xfe\x34")
+
+  def corrupt(index, value):
+    return frame[:index] + bytes([value]) + frame[index+1:]
+
+  for bad in (corrupt(body + 8, 0xDE),                  # Not a vendor element
+              corrupt(body + 10, 0x00),                 # Not the Espressif OUI
+              corrupt(body + 9, 4),                     # Element shorter than its own header
+              corrupt(body + 8 + 257 + 1, 250),         # Last element longer than the frame
+              corrupt(2, 0xff),                         # RadioTap header longer than the frame
+              frame[:body] + frame[body:body+15+250+7]): # More to follow, but no further element
+    receiver.parse_rx_frame(bad)
+    receiver.parse_rx_packet(scapy.RadioTap(bad))
+
+  assert received == []
+
+
+def test_wrong_key_and_foreign_destinations():
+  receiver, received = node(LOCAL, True, key="Some other key!!")
+  receiver.parse_rx_frame(frame_for(MESSAGES[5], True))
+  assert received == [(PEER, LOCAL, b"Encrypted Message")]
+  assert receiver.metrics.counters["decrypt_failures"] == 1
+
+  receiver, received = node(LOCAL, False)
+  assert not receiver.parse_rx_frame(frame_for(MESSAGES[5], False, dst=OTHER))
+  assert not receiver.parse_rx_packet(scapy.RadioTap(frame_for(MESSAGES[5], False, dst=OTHER)))
+  assert received == []
@@ -0,0 +1,52 @@
+import socket
+
+import pytest
+import scapy.all as scapy
+
+from ESPythoNOW import TP_STATUS_USER, TPACKET3_HDR, TPACKET_BLOCK_PKTS, TPACKET_BLOCK_STATUS, ESPythoNow, LoopbackL2Socket
+from helpers import LOCAL, PEER, wait_for
+
+
+BLOCK = 4096
+
+
+# A TPACKET_V3 ring as the kernel leaves it, every block retired to user space with its frames
+def ring_of(blocks):
+  ring = bytearray(BLOCK * len(blocks))
+  for n, frames in enumerate(blocks):
+    offset = n * BLOCK
+    pkt    = 48
+    TPACKET_BLOCK_STATUS.pack_into(ring, offset + 8, TP_STATUS_USER)
+    TPACKET_BLOCK_PKTS.pack_into(ring, offset + 12, len(frames), pkt)
+    for frame in frames:
+      size = (32 + len(frame) + 15) & ~15
+      TPACKET3_HDR.pack_into(ring, offset + pkt, size, len(frame), 32)
+      ring[offset + pkt + 32:offset + pkt + 32 + len(frame)] = frame
+      pkt += size
+  return ring
+
+
+@pytest.mark.parametrize("rx_workers", (0, 1))
+def test_ring_frames_are_copied_before_blocks_go_back(rx_workers):
+  sender   = ESPythoNow(interface="", set_interface=False, mac=PEER, l2_socket=LoopbackL2Socket())
+  sender.prepare()
+  messages = [b"first", bytes(range(250)), bytes(300), b"last"]
+  frames   = [bytes(frame) for i, frame in sender.build_frames(LOCAL, messages)]
+
+  received = []
+  espnow   = ESPythoNow(interface="", set_interface=False, mac=LOCAL, l2_socket=LoopbackL2Socket(), rx_workers=rx_workers, callback=lambda from_mac, to_mac, msg: received.append(msg))
+  espnow.ring_block_size = BLOCK
+  espnow.prepare()
+  if rx_workers:
+    espnow.start_rx_workers()
+
+  ring = ring_of([frames[:2], [frames[2][:100], frames[2], frames[3]]]) # A truncated copy among them
+  sock, other = socket.socketpair()
+  scapy.threading.Thread(target=espnow.ring_listener, args=(sock, ring), daemon=True).start()
+
+  wait_for(lambda: not any(TPACKET_BLOCK_STATUS.unpack_from(ring, n * BLOCK + 8)[0] for n in range(2)))
+  ring[:] = bytes(len(ring)) # The kernel reuses the blocks
+  wait_for(lambda: len(received) == 4)
+
+  assert received == messages
+  assert espnow.metrics.counters["malformed_dropped"] == 1
@@ -0,0 +1,37 @@
+import threading
+import time
+
+import scapy.all as scapy
+
+from ESPythoNOW import ESPythoNow, LoopbackL2Socket
+from helpers import LOCAL, OTHER, PEER, frame
+
+
+# Two thread workers replaying a capture with interleaved sources, every frame but the last resent once
+def test_sharded_workers_keep_order_and_dedupe(tmp_path):
+  frames = []
+  for i in range(20):
+    for src in (PEER, OTHER):
+      copy = frame(src, b"m%d" % i, bytes([i, 0, 0, 1]), -50)
+      frames += [copy, copy] if i < 19 else [copy]
+  scapy.wrpcap(str(tmp_path / "rx.pcap"), frames)
+
+  received = []
+  def callback(from_mac, to_mac, msg):
+    time.sleep(.1 if msg == b"m19" else .002) # Last messages still processing after the queues are empty
+    received.append((from_mac, msg, threading.current_thread()))
+
+  espnow = ESPythoNow(interface="", set_interface=False, mac=LOCAL, pcap_file=str(tmp_path / "rx.pcap"), l2_socket=LoopbackL2Socket(), rx_workers=2, callback=callback)
+  espnow.start()
+  espnow.listener.join()
+
+  # Drained before the replay reports, each message once
+  assert len(received) == 40
+  assert all(stats["depth"] == 0 for stats in espnow.rx_worker_stats())
+
+  for src in (PEER, OTHER):
+    messages = [item for item in received if item[0] == src]
+    assert [msg for _, msg, _ in messages] == [b"m%d" % i for i in range(20)]
+    assert len({worker for _, _, worker in messages}) == 1
+
+  assert len({worker for _, _, worker in received}) == 2 # One shard per source
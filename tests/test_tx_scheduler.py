@@ -0,0 +1,58 @@
+import threading
+
+from ESPythoNOW import Pacer, TxScheduler
+
+
+# Scheduler whose first send, to GATE, waits until released, so everything submitted meanwhile is sorted at once
+class Gated:
+
+  def __init__(self, queue_size=1024, pacer=None):
+    self.sent      = []
+    self.open      = threading.Event()
+    self.scheduler = TxScheduler(self.send, pacer or Pacer(), queue_size)
+    self.gate      = self.scheduler.submit("GATE", b"gate")
+
+  def send(self, mac, msg):
+    if mac == "GATE":
+      self.open.wait(5)
+    else:
+      self.sent.append(msg)
+    return True
+
+  def release(self, futures):
+    self.open.set()
+    return [future.result(timeout=5) for future in futures]
+
+
+def test_destinations_take_turns():
+  gated   = Gated()
+  futures = [gated.scheduler.submit(mac, f"{mac}{i}".encode()) for mac, count in (("A", 4), ("B", 2), ("C", 1)) for i in range(count)]
+  assert all(gated.release(futures))
+  assert gated.sent == [b"A0", b"B0", b"C0", b"A1", b"B1", b"A2", b"A3"]
+
+
+def test_full_destination_queue_rejects_only_that_destination():
+  gated   = Gated(queue_size=2)
+  futures = [gated.scheduler.submit("A", b"a%d" % i) for i in range(4)] + [gated.scheduler.submit("B", b"b0")]
+  assert gated.release(futures) == [True, True, False, False, True]
+  assert gated.scheduler.stats()["rejected"] == 2
+
+
+def test_concurrent_submitters_keep_their_own_order():
+  gated   = Gated()
+  futures = {}
+
+  def submit(mac):
+    futures[mac] = [gated.scheduler.submit(mac, b"%s%d" % (mac.encode(), i)) for i in range(200)]
+
+  threads = [threading.Thread(target=submit, args=(mac,)) for mac in ("A", "B", "C", "D")]
+  for thread in threads:
+    thread.start()
+  for thread in threads:
+    thread.join()
+
+  assert all(gated.release([future for mac in futures for future in futures[mac]]))
+  for mac in ("A", "B", "C", "D"):
+    assert [msg for msg in gated.sent if msg.startswith(mac.encode())] == [b"%s%d" % (mac.encode(), i) for i in range(200)]
+  stats = gated.scheduler.stats()
+  assert stats["sent"] == 801 and stats["depth"] == 0 and stats["peers"]["A"]["sent"] == 200